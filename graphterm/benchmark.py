@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+"""benchmark: Performance benchmarks for GraphTerm components
+
+Usage: python benchmark.py [-h ... options] [benchmark_name ...]
+"""
+
+import gc
+import logging
+import os
+import sys
+import time
+
+import lineterm
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """Decorator to register benchmark function"""
+    BENCHMARKS.append(func)
+    return func
+
+def null_callback(term_name, response_id, command, arg):
+    pass
+
+def new_terminal(height=25, width=80, screen_callback=null_callback):
+    """Return lineterm.Terminal instance not attached to a pty"""
+    return lineterm.Terminal("tty1", -1, 0, screen_callback, height=height, width=width,
+                             host="localhost", pdelim=["", "$"], term_params={})
+
+def log_data(nbytes, colors=False):
+    """Return approximately nbytes of log-like output (optionally colorized)"""
+    lines = []
+    size = 0
+    count = 0
+    while size < nbytes:
+        count += 1
+        if colors:
+            line = "\x1b[1m[%06d]\x1b[0m \x1b[32mPASS\x1b[0m test_module.TestCase.test_%d ... \x1b[33m%.3fs\x1b[0m\r\n" % (count, count, count*0.001)
+        else:
+            line = "%06d 2013-07-04 12:00:00 INFO Processing request %d from host%d.example.com\r\n" % (count, count, count % 97)
+        lines.append(line)
+        size += len(line)
+    return "".join(lines)
+
+def timed_write(term, data, chunk_bytes=65536, update=False):
+    """Write data to terminal in chunks (as read from pty), returning elapsed time"""
+    start_time = time.time()
+    for offset in xrange(0, len(data), chunk_bytes):
+        term.write(data[offset:offset+chunk_bytes])
+        if update:
+            term.update()
+    return time.time() - start_time
+
+@benchmark
+def write(options):
+    """Terminal.write throughput (MB/s) for plain and colorized output"""
+    nbytes = int(options.megabytes * 1000000)
+    for label, colors in (("plain", False), ("colors", True)):
+        data = log_data(nbytes, colors=colors)
+        elapsed = timed_write(new_terminal(), data)
+        print "write %-8s %8.2f MB/s  (%d bytes in %.2fs)" % (label, len(data)/elapsed/1.0e6, len(data), elapsed)
+
+@benchmark
+def scroll(options):
+    """Terminal.write throughput (MB/s) for output scrolling within alt screen region"""
+    nbytes = int(options.megabytes * 1000000)
+    data = log_data(nbytes)
+    for label, height in (("25 rows", 25), ("100 rows", 100)):
+        term = new_terminal(height=height, width=132)
+        term.write("\x1b[?1049h\x1b[2;%dr\x1b[%d;1H" % (height-1, height-1))
+        elapsed = timed_write(term, data)
+        print "scroll %-8s %8.2f MB/s  (%d bytes in %.2fs)" % (label, len(data)/elapsed/1.0e6, len(data), elapsed)
+
+@benchmark
+def richtext(options):
+    """ScreenBuf.dumprichtext/dumpmarkup rate (rows/s) for colorized rows"""
+    term = new_terminal()
+    term.write(log_data(term.width*term.height, colors=True))
+    rows = [term.main_screen.rows[j] for j in xrange(term.height)]
+    count = 200
+    for label, func in (("richtext", term.screen_buf.dumprichtext), ("markup", term.screen_buf.dumpmarkup)):
+        start_time = time.time()
+        for j in xrange(count):
+            for row in rows:
+                func(row, trim=True)
+        elapsed = time.time() - start_time
+        print "richtext %-8s %8.0f rows/s" % (label, count*len(rows)/elapsed)
+
+@benchmark
+def update(options):
+    """Terminal.update cost (ms) for idle and single-row changes on a full screen"""
+    term = new_terminal()
+    term.write(log_data(term.width*term.height))
+    term.update()
+    count = 2000
+    for label, data in (("idle", ""), ("one-row", "x")):
+        start_time = time.time()
+        for j in xrange(count):
+            if data:
+                term.write(data)
+            term.update()
+        elapsed = time.time() - start_time
+        print "update %-8s %8.3f ms/update" % (label, 1000.0*elapsed/count)
+
+class EchoTimer(object):
+    """Measures keystroke echo latency for terminal tty1 of a Multiplex (with cat as the command)"""
+    def __init__(self, command="cat"):
+        import threading
+        self.echoed = threading.Event()
+        self.multiplex = lineterm.Multiplex(self.screen_callback, command=command, term_params={"lc_export": ""})
+
+    def screen_callback(self, term_name, response_id, command, arg):
+        if term_name == "tty1" and command == "row_update":
+            self.echoed.set()
+
+    def measure(self, keystrokes):
+        """Returns list of echo latencies (in seconds)"""
+        latencies = []
+        for j in xrange(keystrokes):
+            self.echoed.clear()
+            start_time = time.time()
+            self.multiplex.term_write("tty1", "x" if j % 40 else "\n")
+            if self.echoed.wait(1.0):
+                latencies.append(time.time() - start_time)
+            time.sleep(lineterm.UPDATE_INTERVAL)   # Typing pace (avoid update rate limiting)
+        return sorted(latencies)
+
+def latency_summary(latencies, keystrokes):
+    median = latencies[len(latencies)//2] if latencies else 0
+    return "%7.2f ms median, %7.2f ms max  (%d/%d echoed)" % (1000*median, 1000*max(latencies or [0]), len(latencies), keystrokes)
+
+@benchmark
+def echo(options):
+    """Keystroke echo latency (ms) and idle CPU usage, with increasing number of idle terminals (requires ptys)"""
+    timer = EchoTimer()
+    try:
+        term_count = 0
+        for count in [int(x) for x in options.terminals.split(",")]:
+            while term_count < count:
+                timer.multiplex.terminal(height=25, width=80)
+                term_count += 1
+            time.sleep(0.5)
+            cpu_time = sum(os.times()[:2])
+            time.sleep(1.0)
+            idle_cpu = sum(os.times()[:2]) - cpu_time
+            latencies = timer.measure(options.keystrokes)
+            print "echo %4d terminals  %s; idle CPU %5.1f%%" % (count, latency_summary(latencies, options.keystrokes), 100*idle_cpu)
+    finally:
+        timer.multiplex.shutdown()
+
+@benchmark
+def flood(options):
+    """Keystroke echo latency (ms) on a quiet terminal, while other terminals run 'yes' (requires ptys)"""
+    timer = EchoTimer()
+    try:
+        timer.multiplex.terminal(height=25, width=80)
+        time.sleep(0.5)
+        for count in (0, 1, 3):
+            while len(timer.multiplex.term_names()) < count+1:
+                timer.multiplex.terminal(height=25, width=80, command="yes")
+            time.sleep(0.5)
+            latencies = timer.measure(options.keystrokes)
+            print "flood %d neighbours  %s" % (count, latency_summary(latencies, options.keystrokes))
+    finally:
+        timer.multiplex.shutdown()
+
+def deep_size(obj, seen=None):
+    """Return approximate memory size (bytes) of obj and all objects it references (counting shared objects once)"""
+    seen = set() if seen is None else seen
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+@benchmark
+def scrollback(options):
+    """Scroll buffer memory (bytes/line) and write throughput (MB/s) with a full buffer of --scroll-lines lines"""
+    saved_max = lineterm.MAX_SCROLL_LINES
+    lineterm.MAX_SCROLL_LINES = options.scroll_lines
+    try:
+        for label, colors in (("plain", False), ("colors", True)):
+            term = new_terminal()
+            timed_write(term, log_data(options.scroll_lines*90, colors=colors), update=True)
+            scroll_lines = term.screen_buf.scroll_lines
+            line_bytes = deep_size(scroll_lines) / max(1, len(scroll_lines))
+            data = log_data(int(options.megabytes * 1000000), colors=colors)
+            elapsed = timed_write(term, data, update=True)
+            print "scrollback %-8s %6d bytes/line  %8.2f MB/s  (%d lines buffered)" % (label, line_bytes, len(data)/elapsed/1.0e6, len(scroll_lines))
+    finally:
+        lineterm.MAX_SCROLL_LINES = saved_max
+
+@benchmark
+def blobcache(options):
+    """Blob cache add/get rate (ops/sec) for --blobs blobs, with a byte budget holding half of them"""
+    import random
+    import gtermhost
+    blob_bytes = 1024
+    blob_cache = gtermhost.BlobCache(max_bytes=options.blobs*blob_bytes//2)
+    blob_ids = ["%016x" % j for j in range(options.blobs)]
+    start = time.time()
+    for blob_id in blob_ids:
+        blob_cache.add_blob(blob_id, {"content_type": "text/plain"}, blob_id*(blob_bytes//len(blob_id)))
+    add_elapsed = time.time() - start
+    lookups = [random.choice(blob_ids) for j in range(options.blobs)]
+    start = time.time()
+    for blob_id in lookups:
+        blob_cache.get_blob(blob_id)
+    get_elapsed = time.time() - start
+    stats = blob_cache.stats()
+    print "blobcache %6d blobs  add %9.0f ops/sec  get %9.0f ops/sec  (hits %d, misses %d, evictions %d)" % (options.blobs, options.blobs/add_elapsed, options.blobs/get_elapsed, stats["hits"], stats["misses"], stats["evictions"])
+
+@benchmark
+def fanout(options):
+    """Server remote_response rate (responses/sec) for a terminal with --watchers websocket watchers"""
+    import gtermserver
+
+    class NullSocket(object):
+        wildcard = False
+        remote_path = "bench/tty1"
+        def __init__(self):
+            self.nbytes = 0
+        def gterm_write(self, data, binary=False):
+            self.nbytes += len(data)
+        def get_terminal_control_set(self, path):
+            return set()
+
+    term_path = NullSocket.remote_path
+    connection = gtermserver.TerminalConnection.__new__(gtermserver.TerminalConnection)
+    connection.connection_id = term_path.split("/")[0]
+    msg_list = [["terminal", "row_update", [False, 25, 80, [0, 0], "", "", j, "", [[j, [[[], "line %d %s" % (j, "x"*60)]]]], []]] for j in range(10)]
+    saved_watchers = gtermserver.GTSocket._watch_dict.pop(term_path, None)
+    try:
+        for count in [int(x) for x in options.watchers.split(",")]:
+            sockets = dict(("bench%d" % j, NullSocket()) for j in range(count))
+            gtermserver.GTSocket._all_websockets.update(sockets)
+            gtermserver.GTSocket._watch_dict[term_path] = dict((ws_id, "") for ws_id in sockets)
+            nresponses = max(10, 10000//count)
+            start = time.time()
+            for j in range(nresponses):
+                connection.remote_response("tty1", "", msg_list)
+            elapsed = time.time() - start
+            for ws_id in sockets:
+                del gtermserver.GTSocket._all_websockets[ws_id]
+            print "fanout %4d watchers  %8.0f responses/sec  %8.2f MB/s written" % (count, nresponses/elapsed, sum(ws.nbytes for ws in sockets.values())/elapsed/1.0e6)
+    finally:
+        gtermserver.GTSocket._watch_dict.pop(term_path, None)
+        if saved_watchers is not None:
+            gtermserver.GTSocket._watch_dict[term_path] = saved_watchers
+
+class NullStream(object):
+    """Counts frames and bytes written to packet connection stream (optionally saving the frames)"""
+    def __init__(self, save=False):
+        self.frames = 0
+        self.nbytes = 0
+        self.saved = [] if save else None
+
+    def write(self, data, callback=None):
+        self.frames += 1
+        self.nbytes += len(data)
+        if self.saved is not None:
+            self.saved.append(data)
+
+def new_rpc_link(compress=None):
+    """Return validated packetserver.RPCLink instance writing to a NullStream"""
+    import packetserver
+
+    class NullLink(packetserver.RPCLink, packetserver.PacketConnector):
+        _all_connections = {}
+
+    link = NullLink(server_type="frame", max_packet_buf=packetserver.RESEND_PACKETS)
+    link.stream = NullStream()
+    link.rpc_ready = True
+    link.set_compression(compress)
+    return link
+
+def run_in_ioloop(func, *args):
+    """Return value of func(*args), invoked in the IOLoop thread (needed to send packets)"""
+    from tornado import ioloop
+    results = []
+    io_loop = ioloop.IOLoop.instance()
+    def callback():
+        try:
+            results.append(func(*args))
+        finally:
+            io_loop.stop()
+    io_loop.add_callback(callback)
+    io_loop.start()
+    return results[0]
+
+def screen_ticks(data, count, chunk_bytes=1000):
+    """Return lists of host RPC requests for screen events in each IOLoop iteration,
+    during which each of count terminals receives a chunk of data as output
+    """
+    ticks = []
+    def screen_callback(term_name, response_id, command, arg):
+        ticks[-1].append( ("response", (term_name, response_id, [["terminal", command, arg]]), {}) )
+    terms = [new_terminal(screen_callback=screen_callback) for j in range(count)]
+    for j in range(max(20, len(data)//(count*chunk_bytes))):
+        ticks.append([])
+        offset = (j*chunk_bytes) % len(data)
+        for term in terms:
+            term.write(data[offset:offset+chunk_bytes])
+            term.update()
+    return ticks
+
+def send_ticks(link, ticks, batched=False):
+    """Sends screen event requests over link (in IOLoop thread), returning elapsed time"""
+    start = time.time()
+    for tick in ticks:
+        for method, args, kwargs in tick:
+            if batched:
+                link.send_request_threadsafe(method, *args, **kwargs)
+            else:
+                link.send_request(method, *args, **kwargs)
+        if batched:
+            link.flush_requests()
+    return time.time() - start
+
+@benchmark
+def batching(options):
+    """Host RPC frames/sec for screen updates from --terminals terminals, with and without request batching"""
+    data = log_data(int(options.megabytes * 100000))
+    for count in [int(x) for x in options.terminals.split(",")]:
+        ticks = screen_ticks(data, count)
+        nevents = sum(len(tick) for tick in ticks)
+
+        for label, batched in (("unbatched", False), ("batched", True)):
+            link = new_rpc_link()
+            elapsed = run_in_ioloop(send_ticks, link, ticks, batched)
+            print "batching %4d terminals %-9s %6d events  %6d frames  %8.0f frames/sec  %8.0f events/sec  %6.2f MB/s" % (count, label, nevents, link.stream.frames, link.stream.frames/elapsed, nevents/elapsed, link.stream.nbytes/elapsed/1.0e6)
+
+@benchmark
+def compression(options):
+    """Host RPC bytes per screen update (and updates/sec), with and without compression"""
+    import packetserver
+    nbytes = int(options.megabytes * 100000)
+    for label, colors in (("plain", False), ("colors", True)):
+        ticks = screen_ticks(log_data(nbytes, colors=colors), 1)
+        nevents = sum(len(tick) for tick in ticks)
+        for compress in (None, packetserver.COMPRESS_ZLIB):
+            link = new_rpc_link(compress=compress)
+            elapsed = run_in_ioloop(send_ticks, link, ticks)
+            print "compression %-8s %-5s %6d updates  %8.0f bytes/update  %8.0f updates/sec" % (label, compress or "none", nevents, float(link.stream.nbytes)/nevents, nevents/elapsed)
+
+@benchmark
+def serialization(options):
+    """Host RPC encode and decode rates (requests/sec) for screen updates and file chunks, for each available serializer"""
+    import packetserver
+    updates = sum(screen_ticks(log_data(int(options.megabytes * 100000), colors=True), 1), [])
+    chunk = os.urandom(262144)
+    chunks = [("response", ("", "", [["file_chunk", j, False]]), {"_content": chunk}) for j in range(50)]
+    for name, serializer in packetserver.SERIALIZERS.items():
+        for label, requests in (("updates", updates), ("chunks", chunks)):
+            link = new_rpc_link()
+            link.rpc_serializer = serializer
+            link.stream = NullStream(save=True)
+            encode_elapsed = run_in_ioloop(send_ticks, link, [[request] for request in requests])
+            texts = []
+            for frame in link.stream.saved:
+                # Frame text, as read from stream (separately from any binary content)
+                frame_len, content_len = link.unpack_header(frame[:link.fmt_size])
+                texts.append(frame[link.fmt_size:link.fmt_size+frame_len-content_len])
+            start = time.time()
+            for text in texts:
+                link.decode_packet(text)
+            decode_elapsed = time.time() - start
+            print "serialization %-8s %-8s %6d requests  encode %9.0f requests/sec  decode %9.0f requests/sec" % (name, label, len(requests), len(requests)/encode_elapsed, len(requests)/decode_elapsed)
+
+def main(args=None):
+    from optparse import OptionParser
+    usage = "usage: benchmark.py [-h ... options] [%s]" % "|".join(func.__name__ for func in BENCHMARKS)
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("", "--megabytes", dest="megabytes", default=2.0,
+                      help="Megabytes of data for throughput benchmarks (default: 2)", type="float")
+
+    parser.add_option("", "--scroll-lines", dest="scroll_lines", default=10000,
+                      help="Scroll buffer lines for scrollback benchmark (default: 10000)", type="int")
+    parser.add_option("", "--blobs", dest="blobs", default=10000,
+                      help="Number of blobs for blobcache benchmark (default: 10000)", type="int")
+
+    parser.add_option("", "--terminals", dest="terminals", default="1,10,100",
+                      help="Comma-separated terminal counts for latency and batching benchmarks (default: 1,10,100)")
+    parser.add_option("", "--keystrokes", dest="keystrokes", default=100,
+                      help="Keystrokes per latency measurement (default: 100)", type="int")
+    parser.add_option("", "--watchers", dest="watchers", default="1,10,100",
+                      help="Comma-separated watcher counts for fanout benchmark (default: 1,10,100)")
+
+    (options, args) = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.ERROR)
+    names = set(args)
+    for func in BENCHMARKS:
+        if not names or func.__name__ in names:
+            func(options)
+
+if __name__ == "__main__":
+    main()
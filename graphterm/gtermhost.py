@@ -11,6 +11,7 @@ import datetime
 import email.utils
 import functools
 import hashlib
+import heapq
 import logging
 import mimetypes
 import otrace
@@ -47,6 +48,11 @@ import packetserver
 
 RETRY_SEC = 15
 
+MAX_SENT_DIGESTS = 1000   # Blob content digests remembered as already sent to server (and probably cached there)
+
+FILE_CHUNK_BYTES = 262144   # Files larger than this are streamed to server in chunks
+FILE_CHUNK_RETRY = 0.05     # Delay (sec) before sending next chunk, if previous chunk is still being written
+
 AJAX_EDITORS = set(["ace", "ckeditor", "textarea"])
 
 OSHELL_NAME = "osh"
@@ -76,6 +82,28 @@ def str2datetime(datetime_str):
     """Return datetime object from string, formatted for last-modified"""
     date_tuple = email.utils.parsedate(datetime_str)
     return datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+
+def file_etag(filestat):
+    """Return ETag for file, derived from its inode, size and modification time (without reading it)"""
+    return '"%x-%x-%x"' % (filestat.st_ino, filestat.st_size, int(filestat.st_mtime*1000000))
+
+def etag_matches(etag, if_none_match):
+    """Return True if etag matches If-None-Match header value"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or ("W/"+etag) in tags
+
+def file_range(file_size, byte_range):
+    """Return (first, last) byte positions (inclusive) for byte_range, [first, last] (with first=None for suffix length
+    and last=None for end of file), or None if the range cannot be satisfied
+    """
+    if not byte_range:
+        return (0, file_size-1)
+    first, last = byte_range
+    if first is None:
+        first, last = max(0, file_size-last), file_size-1
+    elif last is None or last >= file_size:
+        last = file_size-1
+    return (first, last) if first <= last else None
     
 def dict2kwargs(dct, unicode2str=False):
     """Converts unicode keys in a dict to ascii, to allow it to be used for keyword args.
@@ -94,44 +122,164 @@ class HtmlWrapper(object):
         return HTML_ESCAPES[0] + self.lterm_cookie + HTML_ESCAPES[1]  + html + HTML_ESCAPES[-1]
 
 class BlobCache(object):
-    def __init__(self, max_bytes=10000000, max_time=5400):
+    """LRU cache of blobs, limited by total content size (max_bytes) and age (max_time sec).
+    Content is stored once per SHA-256 digest, with blob ids as reference-counted aliases (only unique content counts towards max_bytes).
+    The cache is ordered from least to most recently used; expiry times are kept in a heap (entries are removed lazily).
+    Least recently used blobs are evicted only as needed to fit a new blob (a blob larger than max_bytes is still added).
+    If max_group_bytes, blobs may be added to a group (e.g., a host), and the content added by each group is limited to max_group_bytes
+    (with least recently used blobs in the group being evicted first).
+    May be accessed from multiple threads.
+    """
+    def __init__(self, max_bytes=10000000, max_time=5400, max_group_bytes=0):
         self.max_bytes = max_bytes
         self.max_time = max_time
-        self.cache = OrderedDict()
+        self.max_group_bytes = max_group_bytes
+        self.cache = OrderedDict()  # blob_id -> (add_time, headers, digest, group)
+        self.contents = {}          # digest -> [content, ref_count, group]
+        self.group_blobs = {}       # group -> OrderedDict of blob_ids (least recently used first)
+        self.group_sizes = {}       # group -> size of content added by group
         self.cache_size = 0
+        self.expiry_heap = []   # (expiry_time, blob_id, add_time)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.dedups = 0
+
+    def stats(self):
+        """Return dict of cache counters (for monitoring)"""
+        with self.lock:
+            return dict(blobs=len(self.cache), contents=len(self.contents), bytes=self.cache_size, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations,
+                        dedups=self.dedups)
 
     def get_blob(self, blob_id):
         """Return (mod_time, headers, content)"""
-        return self.cache.get(blob_id) or (None, None, None)
-
-    def add_blob(self, blob_id, headers, content):
-        """Add blob, refreshing cache, if need be"""
-        if blob_id in self.cache:
-            self.delete_blob(blob_id)
-
-        self.cache_size += len(content)
+        with self.lock:
+            self.expire(time.time())
+            entry = self.cache.pop(blob_id, None)
+            if not entry:
+                self.misses += 1
+                return (None, None, None)
+            self.hits += 1
+            self.cache[blob_id] = entry   # Most recently used
+            btime, bheaders, digest, group = entry
+            if group is not None:
+                group_blobs = self.group_blobs[group]
+                del group_blobs[blob_id]
+                group_blobs[blob_id] = 1
+            return (btime, bheaders, self.contents[digest][0])
+
+    def get_digest(self, blob_id):
+        """Return content digest for blob (or None)"""
+        with self.lock:
+            entry = self.cache.get(blob_id)
+            return entry[2] if entry else None
+
+    def get_content(self, digest):
+        """Return cached content with digest (or None)"""
+        with self.lock:
+            content_refs = self.contents.get(digest)
+            return content_refs[0] if content_refs else None
+
+    def add_blob(self, blob_id, headers, content, digest=None, group=None):
+        """Add blob, refreshing cache, if need be (digest is the SHA-256 hexdigest of content, if already known)"""
+        if not digest:
+            digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            self.add(blob_id, headers, content, digest, group)
+
+    def alias_blob(self, blob_id, headers, digest, group=None):
+        """Add blob with already cached content; return False if content is not cached"""
+        with self.lock:
+            content_refs = self.contents.get(digest)
+            if not content_refs:
+                return False
+            self.add(blob_id, headers, content_refs[0], digest, group)
+            return True
+
+    def add(self, blob_id, headers, content, digest, group):
+        """Add blob (lock must be held)"""
+        self.remove(blob_id)
         cur_time = time.time()
-        for bid in self.cache.keys():
-            btime, bheaders, bcontent = self.cache[bid]
-            if (cur_time - btime) > self.max_time or self.cache_size > self.max_bytes:
-                self.cache.pop(bid)
-                self.cache_size -= len(bcontent)
-        self.cache[blob_id] = (cur_time, headers, content)
+        self.expire(cur_time)
+        content_refs = self.contents.get(digest)
+        if content_refs:
+            self.dedups += 1
+        else:
+            if group is not None and self.max_group_bytes:
+                group_blobs = self.group_blobs.get(group)
+                while group_blobs and self.group_sizes.get(group, 0) + len(content) > self.max_group_bytes:
+                    self.remove(next(iter(group_blobs)))
+                    self.evictions += 1
+            while self.cache and self.cache_size + len(content) > self.max_bytes:
+                self.remove(next(iter(self.cache)))
+                self.evictions += 1
+            content_refs = self.contents[digest] = [content, 0, group]
+            self.cache_size += len(content)
+            if group is not None:
+                self.group_sizes[group] = self.group_sizes.get(group, 0) + len(content)
+        content_refs[1] += 1
+        self.cache[blob_id] = (cur_time, headers, digest, group)
+        if group is not None:
+            self.group_blobs.setdefault(group, OrderedDict())[blob_id] = 1
+        if len(self.expiry_heap) > 2*len(self.cache) + 100:
+            # Discard heap entries of evicted/deleted blobs
+            self.expiry_heap = [(entry[0]+self.max_time, bid, entry[0]) for bid, entry in self.cache.iteritems()]
+            heapq.heapify(self.expiry_heap)
+        else:
+            heapq.heappush(self.expiry_heap, (cur_time+self.max_time, blob_id, cur_time))
 
     def delete_blob(self, blob_id):
-        if blob_id in self.cache:
-            btime, bheaders, bcontent = self.cache.pop(blob_id)
-            self.cache_size -= len(bcontent)
+        with self.lock:
+            self.remove(blob_id)
+
+    def remove(self, blob_id):
+        """Remove blob (lock must be held)"""
+        entry = self.cache.pop(blob_id, None)
+        if not entry:
+            return
+        btime, bheaders, digest, group = entry
+        if group is not None:
+            group_blobs = self.group_blobs[group]
+            del group_blobs[blob_id]
+            if not group_blobs:
+                del self.group_blobs[group]
+        self.release(digest)
+
+    def release(self, digest):
+        """Release reference to content, discarding unreferenced content (lock must be held)"""
+        content_refs = self.contents[digest]
+        content_refs[1] -= 1
+        if not content_refs[1]:
+            del self.contents[digest]
+            self.cache_size -= len(content_refs[0])
+            group = content_refs[2]
+            if group is not None:
+                self.group_sizes[group] -= len(content_refs[0])
+                if not self.group_sizes[group]:
+                    del self.group_sizes[group]
+
+    def expire(self, cur_time):
+        """Remove blobs older than max_time (lock must be held)"""
+        while self.expiry_heap and self.expiry_heap[0][0] < cur_time:
+            expiry_time, blob_id, add_time = heapq.heappop(self.expiry_heap)
+            entry = self.cache.get(blob_id)
+            if entry and entry[0] == add_time:
+                self.remove(blob_id)
+                self.expirations += 1
 
 class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
     _all_connections = {}
     all_cookies = {}
     def __init__(self, host, port, host_secret="", io_loop=None, ssl_options={},
-                 key_secret=None, key_version=None, key_id=None, lterm_logfile=""):
+                 key_secret=None, key_version=None, key_id=None, lterm_logfile="", compress=False):
         super(TerminalClient, self).__init__(host, port, io_loop=io_loop,
-                                             ssl_options=ssl_options, max_packet_buf=3,
+                                             ssl_options=ssl_options, max_packet_buf=packetserver.RESEND_PACKETS,
                                              reconnect_sec=RETRY_SEC, server_type="frame",
-                                             key_secret=key_secret, key_version=key_version, key_id=key_id)
+                                             key_secret=key_secret, key_version=key_version, key_id=key_id,
+                                             compress=compress)
         self.host_secret = host_secret
 
         self.lterm_logfile = lterm_logfile
@@ -141,6 +289,8 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
         self.blob_server = ""
         self.osh_cookie = lineterm.make_lterm_cookie()
         self.blob_cache = BlobCache()
+        self.sent_digests = OrderedDict()
+        self.file_streams = {}  # Open files being streamed to server, by request_id
         self.host_settings = {}
         self.widget_port = 0
         self.log_filename = ""
@@ -152,6 +302,11 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
         self.lineterm = None
 
     def connection_validated(self):
+        self.sent_digests.clear()
+        for file, remaining in self.file_streams.itervalues():
+            # Streams requested over previous connection
+            file.close()
+        self.file_streams.clear()
         normalized_host = get_normalized_host(self.connection_id)
         host_params = {"host_secret": self.host_secret, "host_email": gterm.read_email()}
         self.remote_response("", "", [["term_params", {"version": about.version,
@@ -200,7 +355,8 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                                                term_type=self.host_settings["term_type"],
                                                api_version=version_str, widget_port=self.widget_port,
                                                prompt_list=self.host_settings["prompt_list"], blob_server=self.blob_server,
-                                               term_params=self.host_settings["lterm_params"], logfile=self.lterm_logfile)
+                                               term_params=self.host_settings["lterm_params"], logfile=self.lterm_logfile,
+                                               writable=self.output_writable)
         term_name, lterm_cookie, alert_msg = self.lineterm.terminal(term_name, height=height, width=width,
                                                                     winheight=winheight, winwidth=winwidth,
                                                                     parent=parent)
@@ -223,6 +379,42 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
             except Exception, excp:
                 logging.warning("Error in paste_command: %s", excp)
 
+    def send_file_chunk(self, term_name, request_id):
+        """Send next chunk of streamed file.
+        The first chunk is sent with the response headers; each subsequent chunk is sent only when the server
+        requests it (file_next), after the previous chunk has been written to the browser.
+        """
+        stream = self.file_streams.get(request_id)
+        if not stream:
+            # Cancelled
+            return
+        file, remaining = stream
+        if not self.connected:
+            del self.file_streams[request_id]
+            file.close()
+            return
+        if self.write_pending():
+            # Wait for previous output to be written, to limit memory usage
+            IO_loop.add_timeout(time.time()+FILE_CHUNK_RETRY, functools.partial(self.send_file_chunk, term_name, request_id))
+            return
+        try:
+            data = file.read(min(FILE_CHUNK_BYTES, remaining))
+        except Exception, excp:
+            logging.warning("Error in reading file chunk: %s", excp)
+            data = ""
+        remaining -= len(data)
+        last = not data or remaining <= 0
+        if last:
+            del self.file_streams[request_id]
+            file.close()
+        else:
+            stream[1] = remaining
+        self.send_request("response", term_name, "", [["file_chunk", request_id, last]], _content=data)
+
+    def output_writable(self):
+        # Invoked in lineterm thread; False while output to server is backed up (flooding terminals are paused)
+        return self.is_writable() and not self.write_pending()
+
     def screen_callback(self, term_name, response_id, command, arg):
         # Invoked in lineterm thread; schedule callback in ioloop
         lterm_cookie, blobs = self.terms.get(term_name, [None, None])
@@ -230,8 +422,8 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
             logging.warning("Error in screen_callback: terminal %s not found for command %s", term_name, command)
             return
         if command == "create_blob":
-            blob_id, headers, content = arg
-            self.blob_cache.add_blob(blob_id, headers, content)
+            blob_id, headers, content, digest = arg
+            self.blob_cache.add_blob(blob_id, headers, content, digest=digest)
             blobs[blob_id] = 1
         elif command == "delete_blob":
             blob_id = arg[0]
@@ -286,6 +478,9 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
           click_paste <text> <file_url> {command:, clear_last:, normalize:, enter:}
           paste_command <text>
           get_finder <kind> <directory>
+          get_elided <response_id> <first_count> <count>
+          get_scroll_page <response_id> <cursor> <count>
+          get_archive <response_id> <start> <count> <pattern>
           save_data <save_params> <filedata>|None
           open_notebook <filepath> <share> <prompts> <content>
           close_notebook <discard>
@@ -470,6 +665,22 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                     if self.lineterm:
                         self.lineterm.clear_last_entry(term_name, long(cmd[0]))
 
+                elif action == "get_elided":
+                    # get_elided: response_id, first_count, count
+                    if self.lineterm:
+                        self.lineterm.get_elided(term_name, long(cmd[1]), int(cmd[2]), response_id=cmd[0])
+
+                elif action == "get_scroll_page":
+                    # get_scroll_page: response_id, cursor, count
+                    if self.lineterm:
+                        self.lineterm.get_scroll_page(term_name, long(cmd[1]), int(cmd[2]), response_id=cmd[0])
+
+                elif action == "get_archive":
+                    # get_archive: response_id, start, count, pattern
+                    if self.lineterm:
+                        self.lineterm.get_archive(term_name, int(cmd[1]), int(cmd[2]), cmd[3] if len(cmd) > 3 else "",
+                                                  response_id=cmd[0])
+
                 elif action == "get_finder":
                     if self.lineterm:
                         self.lineterm.get_finder(term_name, cmd[0], cmd[1])
@@ -538,13 +749,20 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                         resp_list.append(["output", "\n".join(entry_list)])
 
                 elif action == "file_request":
-                    request_id, request_method, file_path, if_mod_since = cmd
+                    request_id, request_method, file_path, if_mod_since = cmd[:4]
+                    send_content = len(cmd) > 4 and cmd[4]  # If true, send content even if server probably has it
+                    byte_range = cmd[5] if len(cmd) > 5 else None  # [first, last] byte positions (inclusive; first=None for suffix)
+                    if_none_match = cmd[6] if len(cmd) > 6 else None
                     status = (404, "Not Found")
                     etag = None
                     last_modified = None
                     content_type = None
                     content_length = None
-                    content_b64 = ""
+                    content = ""
+                    content_omitted = False  # True if content is not sent because the server should have cached it
+                    digest = None
+                    content_range = None
+                    chunked = False
                     remote_modtime = None
                     if if_mod_since:
                         remote_modtime = str2datetime(if_mod_since)
@@ -563,7 +781,15 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                                 content_type = bheaders.get("content_type") or "text/html"
                                 content_length = bheaders["content_length"]
                                 if request_method != "HEAD":
-                                    content_b64 = bcontent # B64 encoded
+                                    digest = self.blob_cache.get_digest(file_path)
+                                    if not digest or send_content or digest not in self.sent_digests:
+                                        content = bcontent
+                                        if digest:
+                                            self.sent_digests[digest] = 1
+                                            if len(self.sent_digests) > MAX_SENT_DIGESTS:
+                                                self.sent_digests.popitem(last=False)
+                                    else:
+                                        content_omitted = True
                                 status = (200, "OK")
                     else:
                         abspath = file_path
@@ -571,9 +797,15 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                             abspath = abspath.replace("/", os.path.sep)
 
                         if os.path.isfile(abspath) and os.access(abspath, os.R_OK):
-                            mod_datetime = datetime.datetime.fromtimestamp(os.path.getmtime(abspath))
+                            filestat = os.stat(abspath)
+                            mod_datetime = datetime.datetime.fromtimestamp(filestat.st_mtime)
+                            etag = file_etag(filestat)
 
-                            if remote_modtime and remote_modtime >= mod_datetime:
+                            if if_none_match:
+                                not_modified = etag_matches(etag, if_none_match)
+                            else:
+                                not_modified = remote_modtime and remote_modtime >= mod_datetime
+                            if not_modified:
                                 status = (304, "Not Modified")
                             else:
                                 # Read file contents
@@ -584,29 +816,54 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                                     if mime_type:
                                         content_type = mime_type
 
-                                    with open(abspath, "rb") as file:
-                                        data = file.read()
-                                        hasher = hashlib.sha1()
-                                        hasher.update(data)
-                                        digest = hasher.hexdigest()
-                                        etag = '"%s"' % digest
-                                        if request_method == "HEAD":
-                                            content_length = len(data)
-                                        else:
-                                            content_b64 = base64.b64encode(data)
-                                        status = (200, "OK")
+                                    file_size = filestat.st_size
+                                    first_last = file_range(file_size, byte_range)
+                                    if not first_last:
+                                        status = (416, "Requested Range Not Satisfiable")
+                                        content_range = "bytes */%d" % file_size
+                                    else:
+                                        first, last = first_last
+                                        content_length = last - first + 1
+                                        if byte_range:
+                                            content_range = "bytes %d-%d/%d" % (first, last, file_size)
+                                        if request_method != "HEAD":
+                                            file = open(abspath, "rb")
+                                            file.seek(first)
+                                            if content_length <= FILE_CHUNK_BYTES:
+                                                content = file.read(content_length)
+                                                file.close()
+                                            else:
+                                                # Large file; stream content in chunks
+                                                self.file_streams[request_id] = [file, content_length]
+                                                chunked = True
+                                        status = (206, "Partial Content") if byte_range else (200, "OK")
                                 except Exception:
                                     pass
 
                     resp_list.append(["file_response", request_id,
                                       dict(status=status, last_modified=last_modified,
-                                           etag=etag,
+                                           etag=etag, digest=digest,
                                            content_type=content_type, content_length=content_length,
-                                           content_b64=None if content_b64 else "")])
-                    if content_b64:
-                        # Send response with file content right away
-                        self.remote_response(term_name, "", resp_list, _content=content_b64)
+                                           content_range=content_range, chunked=chunked,
+                                           content=None if content else "", content_omitted=content_omitted)])
+                    if content:
+                        # Send response with (binary) file content right away
+                        self.remote_response(term_name, "", resp_list, _content=content)
+                        resp_list = []
+                    elif chunked:
+                        # Send response headers right away, followed by content chunks
+                        self.remote_response(term_name, "", resp_list)
                         resp_list = []
+                        IO_loop.add_callback(functools.partial(self.send_file_chunk, term_name, request_id))
+
+                elif action == "file_next":
+                    # file_next <request_id>: Send next chunk of streamed file
+                    self.send_file_chunk(term_name, cmd[0])
+
+                elif action == "file_cancel":
+                    stream = self.file_streams.pop(cmd[0], None)
+                    if stream:
+                        stream[0].close()
 
                 elif action == "errmsg":
                     logging.warning("remote_request: ERROR %s", cmd[0])
@@ -788,6 +1045,9 @@ class WidgetStream(object):
             elif "content_length" not in headers:
                 logging.warning("No content_length specified for create_blob")
             else:
+                if headers.get("x_gterm_encoding") == "base64":
+                    content = base64.b64decode(content)
+                    headers.pop("x_gterm_encoding")
                 host_connection.blob_cache.add_blob(blob_id, headers, content)
 
         else:
@@ -934,7 +1194,8 @@ def run_host(options, args):
                                                                      "key_secret": auth_code or None,
                                                                      "key_version": key_version,
                                                                      "key_id": str(remote_port),
-                                                                     "lterm_logfile": options.lterm_logfile},
+                                                                     "lterm_logfile": options.lterm_logfile,
+                                                                     "compress": options.compress},
                                                          oshell_globals=oshell_globals,
                                                          oshell_unsafe=True,
                                                          oshell_no_input=(not options.oshell_input))
@@ -986,6 +1247,8 @@ def main():
                       help="Allow stdin input otrace/oshell")
     parser.add_option("", "--internal_certfile", dest="internal_certfile", default="",
                       help="Internal SSL certfile")
+    parser.add_option("", "--compress", dest="compress", action="store_true",
+                      help="Compress data sent to/from server (for slow networks)")
     parser.add_option("", "--logging", dest="logging", action="store_true",
                       help="Log to ~/.graphterm/gtermhost.log")
     parser.add_option("", "--lterm_logfile", dest="lterm_logfile", default="",
@@ -13,6 +13,7 @@ import getpass
 import hashlib
 import hmac
 import logging
+import mimetypes
 import os
 import Queue
 import re
@@ -73,7 +74,7 @@ Auto_add_file = os.path.join(gterm.App_dir, "AUTO_ADD_USERS")
 
 Check_state_cookie = False             # Controls checking of state cookie for file access
 
-Cache_files = False                     # Controls caching of files (blobs are always cached)
+Cache_files = True                      # Controls caching of files (blobs are always cached; cached files are revalidated with host)
 
 MAX_COOKIE_STATES = 300
 MAX_WEBCASTS = 500
@@ -86,6 +87,15 @@ COOKIE_TIMEOUT = 86400
 
 REQUEST_TIMEOUT = 15
 
+PROXY_CACHE_BYTES = 20000000       # Size limit for proxy cache of blobs/files
+PROXY_HOST_CACHE_BYTES = 5000000   # Size limit for content cached from each host
+NOT_FOUND_CACHE_TIME = 5           # Sec. for which Not Found responses are cached
+MAX_NOT_FOUND = 1000
+
+HISTORY_REQUESTS = ("get_scroll_page", "get_elided", "get_archive")   # Requests for older scroll lines (allowed for all watchers)
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")   # Single byte range
+
 AUTH_DIGITS = 12    # Form authentication code hex-digits
                     # Note: Less than half of the 32 hex-digit state id should be used for form authentication
 
@@ -918,10 +928,17 @@ class GTSocket(tornado.websocket.WebSocketHandler):
 
     def broadcast(self, path, msg, controller=False, include_self=False):
         ws_ids = self._control_set[path] if controller else self._watch_dict[path]
+        data = None
         for ws_id in ws_ids:
             ws = self.get_websocket(ws_id)
             if ws and (ws_id != self.websocket_id or include_self):
-                ws.write_json([msg])
+                try:
+                    if data is None:
+                        # Encode once for all websockets
+                        data = json.dumps([msg])
+                    ws.gterm_write(data)
+                except Exception, excp:
+                    logging.error("broadcast: ERROR %s", excp)
 
     def on_close(self):
         logging.info("GTSocket.on_close: Closing %s:%s", self.remote_path, get_user(self))
@@ -1026,25 +1043,29 @@ class GTSocket(tornado.websocket.WebSocketHandler):
             self.gterm_await_binary = None
             msg_list = []
 
-        elif is_owner or controller or allow_chat_only or allow_control_request:
+        else:
             # Text message
             if self.gterm_await_binary:
                 logging.error("ERROR Awaiting binary data for command %s", self.gterm_await_binary[0])
                 self.gterm_await_binary = None
             req_list = []
+            allow_requests = is_owner or controller or allow_chat_only or allow_control_request
             try:
                 msg_list = json.loads(message if isinstance(message,str) else message.encode("UTF-8", "replace"))
                 if allow_chat_only:
-                    msg_list = [msg for msg in msg_list if msg[0] == "chat"]
+                    msg_list = [msg for msg in msg_list if msg[0] == "chat" or msg[0] in HISTORY_REQUESTS]
+                elif not allow_requests:
+                    # Watchers may only fetch older scroll lines
+                    msg_list = [msg for msg in msg_list if msg[0] in HISTORY_REQUESTS]
                 elif not controller:
-                    msg_list = [msg for msg in msg_list if msg[0] == "update_params" and msg[1] == "share_control"]
+                    msg_list = [msg for msg in msg_list if (msg[0] == "update_params" and msg[1] == "share_control") or msg[0] in HISTORY_REQUESTS]
             except Exception, excp:
                 logging.warning("GTSocket.on_message: ERROR %s", excp)
                 self.write_json([["errmsg", str(excp)]])
                 return
-        else:
-            self.write_json([["errmsg", "ERROR: Remote path %s not under control" % self.remote_path]])
-            return
+            if not allow_requests and not msg_list:
+                self.write_json([["errmsg", "ERROR: Remote path %s not under control" % self.remote_path]])
+                return
 
         kill_term = False
         try:
@@ -1194,6 +1215,10 @@ class GTSocket(tornado.websocket.WebSocketHandler):
                             msg[4] = tparams["nb_content"]
                             terminal_params["nb_master"] = tempath
 
+                    if msg[0] in HISTORY_REQUESTS:
+                        # Response is sent only to this websocket
+                        msg = [msg[0], self.websocket_id] + msg[1:]
+
                     req_list.append(msg)
                     if msg[0] == "save_prefs":
                         normalized_host = gtermhost.get_normalized_host(remote_host)
@@ -1349,10 +1374,12 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
             except Exception, excp:
                 pass
 
-    def __init__(self, stream, address, server_address, key_secret=None, key_version=None, key_id=None, ssl_options={}):
+    def __init__(self, stream, address, server_address, key_secret=None, key_version=None, key_id=None, ssl_options={},
+                 compress=False):
         super(TerminalConnection, self).__init__(stream, address, server_address, server_type="frame",
                                                  key_secret=key_secret, key_version=key_version, key_id=key_id,
-                                                 ssl_options=ssl_options, max_packet_buf=2)
+                                                 ssl_options=ssl_options, max_packet_buf=packetserver.RESEND_PACKETS,
+                                                 compress=compress)
         self.term_dict = dict()
         self.term_count = 0
         self.allow_chat = dict()
@@ -1419,10 +1446,13 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
                 self.term_dict = dict((key, "") for key in msg[1]["term_names"])
             elif msg[0] == "file_response":
                 kwargs = gtermhost.dict2kwargs(msg[2])
-                if kwargs.get("content_b64") is None and _content is not None:
+                if kwargs.get("content") is None and _content is not None:
                     assert j == len(msg_list)-1, "file_response with content must occur as last message in list"
-                    kwargs["content_b64"] = _content
+                    kwargs["content"] = _content
                 ProxyFileHandler.complete_request(msg[1], **kwargs)
+            elif msg[0] == "file_chunk":
+                assert j == len(msg_list)-1, "file_chunk must occur as last message in list"
+                ProxyFileHandler.receive_chunk(msg[1], _content or "", msg[2])
             elif  msg[0] == "terminal" and msg[1] in ("note_open", "note_close", "note_mod_offset"):
                 args = msg[2]
                 if msg[1] == "note_mod_offset":
@@ -1641,6 +1671,9 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
         self.forward_to_ws(term_path, fwd_list, owners_only_list=owners_only_list, websocket_id=websocket_id)
 
     def forward_to_ws(self, term_path, fwd_list, owners_only_list=[], websocket_id=""):
+        """Each message list is JSON-encoded only once, and the same data written to all websockets
+        (wildcard watchers receive a rewritten list, encoded once per distinct variant)
+        """
         if websocket_id:
             ws_set = set([websocket_id])
         else:
@@ -1649,30 +1682,46 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
             for ws_id, regexp in GTSocket._wildcards.iteritems():
                 if regexp.match(term_path):
                     ws_set.add(ws_id)
-            
+
+        fwd_json = None
+        owners_only_json = None
+        wild_outputs = None
+        wild_json = {}   # Encoded wildcard list, by tuple of ditto flags for outputs
         for ws_id in ws_set:
             ws = GTSocket.get_websocket(ws_id)
             if ws:
                 try:
                     if ws.wildcard:
-                        prefix = '<pre class="output wildpath"><a href="/%s" target="%s">%s</a>' % (term_path, term_path, term_path)
-                        multi_fwd_list = []
-                        for fwd in fwd_list:
-                            if fwd[0] in ("output", "html_output", "log"):
-                                output = fwd[0] + ": " + " ".join(map(str,fwd[1:]))
-                                if ws.last_output == output:
+                        if wild_outputs is None:
+                            wild_outputs = [(fwd, fwd[0] + ": " + " ".join(map(str,fwd[1:]))) for fwd in fwd_list
+                                            if fwd[0] in ("output", "html_output", "log")]
+                        dittos = []
+                        for fwd, output in wild_outputs:
+                            dittos.append(ws.last_output == output)
+                            ws.last_output = output
+                        dittos = tuple(dittos)
+
+                        if dittos and dittos not in wild_json:
+                            prefix = '<pre class="output wildpath"><a href="/%s" target="%s">%s</a>' % (term_path, term_path, term_path)
+                            multi_fwd_list = []
+                            for (fwd, output), ditto in zip(wild_outputs, dittos):
+                                if ditto:
                                     multi_fwd_list.append(["output", prefix + ' ditto</pre>'])
                                 else:
-                                    ws.last_output = output
                                     multi_fwd_list.append([fwd[0], prefix+'</pre>\n'+fwd[1]]+fwd[2:])
-                        
-                        if multi_fwd_list:
-                            ws.write_json(multi_fwd_list)
+                            wild_json[dittos] = json.dumps(multi_fwd_list)
+
+                        if dittos:
+                            ws.gterm_write(wild_json[dittos])
                     else:
                         if fwd_list:
-                            ws.write_json(fwd_list)
+                            if fwd_json is None:
+                                fwd_json = json.dumps(fwd_list)
+                            ws.gterm_write(fwd_json)
                         if owners_only_list and ws_id in ws.get_terminal_control_set(ws.remote_path):
-                            ws.write_json(owners_only_list)
+                            if owners_only_json is None:
+                                owners_only_json = json.dumps(owners_only_list)
+                            ws.gterm_write(owners_only_json)
                 except Exception, excp:
                     logging.error("forward_to_ws: write ERROR %s", excp)
 
@@ -1689,13 +1738,23 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
                 if not owners_only or ws_id in ws.get_terminal_control_set(ws.remote_path):
                     ws.gterm_write(content, binary=True)
 
-Proxy_cache = gtermhost.BlobCache()
+Proxy_cache = gtermhost.BlobCache(max_bytes=PROXY_CACHE_BYTES, max_group_bytes=PROXY_HOST_CACHE_BYTES)
+Proxy_not_found = OrderedDict()   # Paths with recent Not Found responses (path -> expiry time)
 
 class ProxyFileHandler(tornado.web.RequestHandler):
     """Serves file requests
+    Identical concurrent requests are collapsed into a single file_request to the host.
     """
     _async_counter = long(0)
     _async_requests = OrderedDict()
+    _collapsed_requests = {}   # request_key -> list of (follower) handlers awaiting response to the same file_request
+    local_file = None
+    streaming = False
+    follower = False
+    client_not_modified = False
+    request_key = None
+    timeout_callback = None
+    content_retried = False
 
     @classmethod
     def get_async_id(cls):
@@ -1708,7 +1767,34 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         if not request:
             return
         del cls._async_requests[async_id]
+        if kwargs.pop("content_omitted", False):
+            # Content not sent, as it should already be cached (possibly as empty content)
+            kwargs["content"] = Proxy_cache.get_content(kwargs.get("digest"))
+            if kwargs["content"] is None:
+                if request.content_retried:
+                    logging.error("ProxyFileHandler.complete_request: Content omitted again for %s", request.request.path)
+                    kwargs = dict(status=(502, "Bad Gateway"))
+                else:
+                    # Not cached (any more); request again (once), with content
+                    request.content_retried = True
+                    request.send_request(None, send_content=True)
+                    return
+
+        followers = [] if request.follower else cls._collapsed_requests.pop(request.request_key, [])
         request.complete_get(**kwargs)
+        for follower in followers:
+            if kwargs.get("chunked"):
+                # Streamed content is not shared; send separate request
+                follower.send_request(follower.if_mod_since)
+            else:
+                follower.complete_get(**kwargs)
+
+    @classmethod
+    def receive_chunk(cls, async_id, content, last):
+        request = cls._async_requests.get(async_id)
+        if not request:
+            return
+        request.write_chunk(content, last)
 
     ##def write_error(self, status_code, **kwargs):
         ### No error message text
@@ -1733,6 +1819,16 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         if if_mod_since:
             if_mod_since_datetime = gtermhost.str2datetime(if_mod_since)
 
+        if_none_match = self.request.headers.get("If-None-Match")
+        self.byte_range = None
+        range_match = RANGE_RE.match(self.request.headers.get("Range", ""))
+        if range_match and self.request.path.startswith(gterm.FILE_PREFIX) and any(range_match.groups()):
+            # Single byte range (first-last, first-, or -suffix_length)
+            first, last = [int(x) if x else None for x in range_match.groups()]
+            if first is None or last is None or first <= last:
+                # (Invalid range header, with last < first, is ignored)
+                self.byte_range = [first, last]
+
         self.cached_copy = None
         last_modified = None
         last_modified_datetime = None
@@ -1780,23 +1876,192 @@ class ProxyFileHandler(tornado.web.RequestHandler):
             if fpath_hmac != self.get_argument("hmac", ""):
                 raise tornado.web.HTTPError(403, "Unauthorized access to %s (ERR4)", path)
 
-            if bheaders:
-                # File copy is cached
-                if last_modified_datetime and \
-                    if_mod_since_datetime and \
-                    if_mod_since_datetime < last_modified_datetime:
-                        # Remote copy older than cached copy; change if_mod_since to cache copy time
-                        self.cached_copy = (btime, bheaders, bcontent)
-                        if_mod_since = last_modified
+            if host == gterm.LOCAL_HOST and Local_client:
+                # Local host runs in this process; serve file directly
+                self.serve_local_file(if_mod_since_datetime, if_none_match)
+                return
 
+            if bheaders and not self.byte_range and self.request.method != "HEAD":
+                # File copy is cached; revalidate cached copy with host
+                self.cached_copy = (btime, bheaders, bcontent)
+                cached_etag = dict(bheaders).get("Etag")
+                if if_none_match:
+                    self.client_not_modified = bool(cached_etag) and gtermhost.etag_matches(cached_etag, if_none_match)
+                else:
+                    self.client_not_modified = bool(last_modified_datetime and if_mod_since_datetime and
+                                                    if_mod_since_datetime >= last_modified_datetime)
+                if_mod_since = last_modified
+                if_none_match = cached_etag
+
+        not_found_expiry = Proxy_not_found.get(self.request.path)
+        if not_found_expiry:
+            if not_found_expiry > time.time():
+                raise tornado.web.HTTPError(404)
+            del Proxy_not_found[self.request.path]
+
+        self.host = host
+        self.if_mod_since = if_mod_since
+        self.if_none_match = if_none_match
+        self.request_key = (self.request.method, self.request.path, if_mod_since, if_none_match, tuple(self.byte_range or ()))
+        followers = self._collapsed_requests.get(self.request_key)
+        if followers is not None:
+            # Identical request already sent to host; share its response
+            self.follower = True
+            followers.append(self)
+            self.timeout_callback = IO_loop.add_timeout(time.time()+REQUEST_TIMEOUT, self.follower_timeout)
+            return
+        self._collapsed_requests[self.request_key] = []
+        self.send_request(if_mod_since)
+
+    def serve_local_file(self, if_mod_since_datetime, if_none_match):
+        """Serve file directly (streaming it in chunks), with ETag derived from file stats"""
+        abspath = self.file_path
+        if os.path.sep != "/":
+            abspath = abspath.replace("/", os.path.sep)
+        if not os.path.isfile(abspath) or not os.access(abspath, os.R_OK):
+            raise tornado.web.HTTPError(404)
+
+        filestat = os.stat(abspath)
+        etag = gtermhost.file_etag(filestat)
+        mod_datetime = datetime.datetime.fromtimestamp(filestat.st_mtime)
+        self.set_header("Etag", etag)
+        self.set_header("Last-Modified", gtermhost.datetime2str(mod_datetime))
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Cache-Control", "private, max-age=0, must-revalidate")
+        if if_none_match:
+            not_modified = gtermhost.etag_matches(etag, if_none_match)
+        else:
+            not_modified = if_mod_since_datetime and if_mod_since_datetime >= mod_datetime
+        if not_modified:
+            self.set_status(304)
+            self.finish()
+            return
+
+        first_last = gtermhost.file_range(filestat.st_size, self.byte_range)
+        if not first_last:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % filestat.st_size)
+            self.finish()
+            return
+
+        first, last = first_last
+        if self.byte_range:
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (first, last, filestat.st_size))
+        mime_type, encoding = mimetypes.guess_type(abspath)
+        if mime_type:
+            self.set_header("Content-Type", mime_type)
+        self.set_header("Content-Length", last-first+1)
+        if self.request.method == "HEAD":
+            self.finish()
+            return
+
+        self.local_file = open(abspath, "rb")
+        self.local_file.seek(first)
+        self.write_local_chunk(last-first+1)
+
+    def write_local_chunk(self, remaining):
+        """Write next chunk of local file (remaining bytes), flushing it to the client"""
+        if not self.local_file:
+            # Connection closed
+            return
+        if self.request.connection.stream.writing():
+            # Wait for previous chunk to be written, to limit memory usage
+            IO_loop.add_timeout(time.time()+gtermhost.FILE_CHUNK_RETRY, functools.partial(self.write_local_chunk, remaining))
+            return
+        data = self.local_file.read(min(gtermhost.FILE_CHUNK_BYTES, remaining))
+        remaining -= len(data)
+        if data:
+            self.write(data)
+        if not data or remaining <= 0:
+            self.local_file.close()
+            self.local_file = None
+            self.finish()
+        else:
+            self.flush()
+            IO_loop.add_callback(functools.partial(self.write_local_chunk, remaining))
+
+    def send_request(self, if_mod_since, send_content=False):
+        if self.timeout_callback:
+            IO_loop.remove_timeout(self.timeout_callback)
         self.async_id = self.get_async_id()
         self._async_requests[self.async_id] = self
 
         self.timeout_callback = IO_loop.add_timeout(time.time()+REQUEST_TIMEOUT, functools.partial(self.complete_request, self.async_id))
 
-        TerminalConnection.send_to_connection(host, "request", "", "", [["file_request", self.async_id, self.request.method, self.file_path, if_mod_since]])
+        try:
+            TerminalConnection.send_to_connection(self.host, "request", "", "", [["file_request", self.async_id, self.request.method, self.file_path, if_mod_since, send_content, self.byte_range, self.if_none_match]])
+        except Exception, excp:
+            # Fail request (and any collapsed followers)
+            logging.warning("ProxyFileHandler.send_request: %s", excp)
+            self.complete_request(self.async_id, status=(502, "Bad Gateway"))
+
+    def remove_follower(self):
+        """Stop waiting for the response to a collapsed request"""
+        followers = self._collapsed_requests.get(self.request_key)
+        if followers and self in followers:
+            followers.remove(self)
+
+    def follower_timeout(self):
+        self.timeout_callback = None
+        self.remove_follower()
+        self.complete_get()
+
+    def write_chunk(self, content, last):
+        """Write streamed content chunk, flushing it to the client"""
+        IO_loop.remove_timeout(self.timeout_callback)
+        if content:
+            self.write(content)
+        if last:
+            del self._async_requests[self.async_id]
+            self.streaming = False
+            self.finish()
+        else:
+            self.flush()
+            self.request_chunk()
+
+    def request_chunk(self):
+        """Request next content chunk from host, once the previous chunk has been written to the client
+        (so that a slow client limits the rate at which the host sends chunks)
+        """
+        if not self.streaming:
+            return
+        if self.request.connection.stream.writing():
+            IO_loop.add_timeout(time.time()+gtermhost.FILE_CHUNK_RETRY, self.request_chunk)
+            return
+        self.timeout_callback = IO_loop.add_timeout(time.time()+REQUEST_TIMEOUT, self.cancel_stream)
+        try:
+            TerminalConnection.send_to_connection(self.host, "request", "", "", [["file_next", self.async_id]])
+        except Exception, excp:
+            logging.warning("ProxyFileHandler.request_chunk: %s", excp)
+            self.cancel_stream()
 
-    def finish_write(self, headers, content, cache=False):
+    def cancel_stream(self):
+        """Stop streaming (on timeout or closed connection)"""
+        if not self.streaming:
+            return
+        self.streaming = False
+        self._async_requests.pop(self.async_id, None)
+        IO_loop.remove_timeout(self.timeout_callback)
+        try:
+            TerminalConnection.send_to_connection(self.host, "request", "", "", [["file_cancel", self.async_id]])
+        except Exception:
+            pass
+        if not self.request.connection.stream.closed():
+            self.finish()
+
+    def on_connection_close(self):
+        if self.local_file:
+            self.local_file.close()
+            self.local_file = None
+        if self.follower:
+            self.remove_follower()
+            if self.timeout_callback:
+                IO_loop.remove_timeout(self.timeout_callback)
+                self.timeout_callback = None
+        self.cancel_stream()
+
+    def finish_write(self, headers, content, cache=False, digest=None):
         for name, value in headers:
             self.set_header(name, value)
 
@@ -1806,20 +2071,21 @@ class ProxyFileHandler(tornado.web.RequestHandler):
 
         if cache:
             # Cache blob
-            Proxy_cache.add_blob(self.request.path, headers, content)
+            Proxy_cache.add_blob(self.request.path, headers, content, digest=digest, group=self.host)
 
     def complete_get(self, status=(), last_modified=None, etag=None, content_type=None, content_length=None,
-                     content_b64=""):
+                     content="", digest=None, content_range=None, chunked=False):
         # Callback for get
         if not status:
             # Timed out
             self.send_error(408)
             return
 
-        IO_loop.remove_timeout(self.timeout_callback)
+        if self.timeout_callback:
+            IO_loop.remove_timeout(self.timeout_callback)
 
         if status[0] == 304:
-            if self.cached_copy and self.request.method != "HEAD":
+            if self.cached_copy and not self.client_not_modified:
                 # Not modified since cached copy was created; return cached copy
                 self.finish_write(self.cached_copy[1], self.cached_copy[2])
                 return
@@ -1827,24 +2093,28 @@ class ProxyFileHandler(tornado.web.RequestHandler):
             self.finish()
             return
 
-        if status[0] != 200:
+        if status[0] == 404:
+            Proxy_not_found[self.request.path] = time.time() + NOT_FOUND_CACHE_TIME
+            if len(Proxy_not_found) > MAX_NOT_FOUND:
+                Proxy_not_found.popitem(last=False)
+
+        if status[0] == 416:
+            self.set_status(416)
+            self.set_header("Content-Range", content_range)
+            self.finish()
+            return
+
+        if status[0] not in (200, 206):
             # "Error" status
             self.send_error(status[0])
             return
 
         headers = []
-        content = ""
+        content = content or ""
 
         if self.request.method != "HEAD":
             # For HEAD request, content-length shold already have been set
-            if content_b64:
-                try:
-                    content = base64.b64decode(content_b64)
-                except Exception:
-                    logging.warning("gtermserver: Error in base64 decoding for %s", self.request.path)
-                    content = "Error in b64 decoding"
-                    content_type = "text/plain"
-            headers.append(("Content-Length", len(content)))
+            headers.append(("Content-Length", content_length if chunked else len(content)))
 
         if content_type:
             headers.append(("Content-Type", content_type))
@@ -1855,6 +2125,12 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         if etag:
             headers.append(("Etag", etag))
 
+        if content_range:
+            headers.append(("Content-Range", content_range))
+
+        if self.request.path.startswith(gterm.FILE_PREFIX):
+            headers.append(("Accept-Ranges", "bytes"))
+
         if self.request.path.startswith(gterm.BLOB_PREFIX):
             headers.append(("Expires", datetime.datetime.utcnow() +
                                       datetime.timedelta(seconds=MAX_CACHE_TIME)))
@@ -1862,9 +2138,22 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         elif last_modified and content_type:
             headers.append(("Cache-Control", "private, max-age=0, must-revalidate"))
 
-        cache = self.request.method != "HEAD" and (self.request.path.startswith(gterm.BLOB_PREFIX) or
-                                                     (Cache_files and last_modified) )
-        self.finish_write(headers, content, cache=cache)
+        if status[0] == 206:
+            self.set_status(206)
+
+        if chunked:
+            # Write headers; content chunks will follow
+            for name, value in headers:
+                self.set_header(name, value)
+            self.flush()
+            self.streaming = True
+            self._async_requests[self.async_id] = self
+            self.timeout_callback = IO_loop.add_timeout(time.time()+REQUEST_TIMEOUT, self.cancel_stream)
+            return
+
+        cache = not self.follower and self.request.method != "HEAD" and status[0] == 200 and (
+                    self.request.path.startswith(gterm.BLOB_PREFIX) or (Cache_files and (etag or last_modified)) )
+        self.finish_write(headers, content, cache=cache, digest=digest)
 
 def same_group(user1, user2):
     return Server_settings["user_groups"] and Server_settings["user_groups"].get(user1) and Server_settings["user_groups"].get(user1) == Server_settings["user_groups"].get(user2)
@@ -2078,7 +2367,8 @@ If you have not set up the GraphTerm web app for Google authentication, here is
                        "mathjax": not options.nomathjax, "max_terminals": options.max_terminals}
 
     Host_settings = {"lterm_params": {"nb_ext": options.nb_ext, "term_opts": options.term_opts,
-                                      "lc_export": options.lc_export},
+                                      "lc_export": options.lc_export, "scroll_archive": options.scroll_archive,
+                                      "max_pagelet_bytes": options.max_pagelet_bytes},
                      "term_type": options.term_type, "term_encoding": options.term_encoding,
                      "blob_host": options.blob_host, "command": options.shell_command,
                      "prompt_list": options.prompts.split(",") if options.prompts else gterm.DEFAULT_PROMPTS,
@@ -2225,7 +2515,8 @@ If you have not set up the GraphTerm web app for Google authentication, here is
     try:
         TCP_server = TerminalConnection.start_tcp_server(internal_host, internal_port, io_loop=IO_loop,
                                                          key_secret=key_secret, key_version=key_version,
-                                                         key_id=str(internal_port), ssl_options=internal_server_ssl)
+                                                         key_id=str(internal_port), ssl_options=internal_server_ssl,
+                                                         compress=True)
     except Exception, excp:
         logging.error("%s\nError in starting internal host server; port %s may be in use\nCheck if gtermserver is already running using 'ps -ef|grep gterm'", excp, internal_port)
         sys.exit(1)
@@ -2471,6 +2762,10 @@ def main():
                       help="Terminal character encoding (utf-8/latin-1/...)")
     parser.add_option("term_opts", default="",
                       help="Terminal options: no_colors,no_pyindent,no_untrusted,...")
+    parser.add_option("max_pagelet_bytes", default=0,
+                      help="Max. size of terminal graphics/pagelet output (default: 5000000)", opt_type="int")
+    parser.add_option("scroll_archive", default="",
+                      help="Directory for disk archive of lines evicted from terminal scroll buffers (default: none)")
     parser.add_option("term_settings", default="{}",
                       help="Terminal settings (JSON)")
     parser.add_option("max_terminals", default=10,
@@ -11,7 +11,7 @@ The contents of this file remain in the public-domain.
 
 from __future__ import with_statement
 
-import array, cgi, copy, fcntl, glob, logging, mimetypes, optparse, os, pty
+import array, cgi, copy, fcntl, glob, logging, mimetypes, mmap, optparse, os, pty
 import re, signal, select, socket, sys, threading, time, termios, tty, struct, pwd
 
 try:
@@ -24,6 +24,9 @@ try:
 except ImportError:
     import json
 
+import collections
+import heapq
+import itertools
 import random
 try:
     random = random.SystemRandom()
@@ -31,6 +34,7 @@ except NotImplementedError:
     import random
 
 import base64
+import binascii
 import errno
 import glob
 import hashlib
@@ -50,14 +54,33 @@ GT_PREFIX = gterm.GT_PREFIX
 
 ESCAPE_BUF_LEN = 256
 
+# VT escape sequence parsing (ECMA-48): printable text runs exclude ESC and the C0 controls in Terminal.esc_seq
+VT_TEXT_RE = re.compile(r"[^\x00\x05\x07-\x0f\x1b]+")
+VT_ESC_RE = re.compile(r"\x1b([\x20-\x2f]*)([\x30-\x7e]?)")                       # ESC intermediates final
+VT_CSI_RE = re.compile(r"\x1b\[([\x30-\x3f]*)([\x20-\x2f]*)([\x40-\x7e]?)")      # CSI params intermediates final
+VT_CSI_PARAMS_RE = re.compile(r"^\??([0-9;]*)$")
+VT_STRING_RE = re.compile(r"\x1b[\]PX^_]([^\x07\x1b]*)(\x07|\x1b\\)?")              # OSC/DCS/SOS/PM/APC string terminated by BEL or ST
+
+ECHO_SEGMENT_RE = re.compile(r"[\x00-\x7f]+|[\x80-\xff]+")    # ASCII or non-ASCII segments of printable text
+SURROGATE_RE = re.compile(u"[\ud800-\udfff]")
+
 MAX_SCROLL_LINES = 1000
+SCROLL_PAGE_LINES = 100       # Scroll lines sent on reconnect, and default page size for older lines
+ARCHIVE_SEGMENT_LINES = 64    # Lines per segment of scroll archive index
+MAX_ARCHIVE_MATCHES = 100     # Max. lines returned by scroll archive search
 
 CHUNK_BYTES = 4096            # Chunk size for receiving data in stdin
 
-MAX_PAGELET_BYTES = 5000000   # Max size for pagelet buffer
+MAX_PAGELET_BYTES = 5000000   # Max size for pagelet buffer (default; may be set per terminal)
+MAX_PAGELET_HEADER = 65536    # Max size of JSON headers parsed incrementally by PageletReader
+PAGELET_DECODE_TYPES = set(["create_blob", "display_data", "edit_file", "open_notebook"])  # Response types whose Base64 content is decoded
 
 IDLE_TIMEOUT = 300      # Idle timeout in seconds
 UPDATE_INTERVAL = 0.05  # Fullscreen update time interval
+WORKER_THREADS = 4      # Number of threads reading from/updating terminals
+FLOOD_BYTES_PER_SEC = 250000   # Output rate above which a terminal is treated as flooding (0 to disable)
+FLOOD_SCROLL_LINES = 100       # Max. plain scrolled lines sent per update while flooding (older lines are elided)
+FLOOD_RECHECK = 0.02           # Interval (sec) for re-checking writability while flooding terminal reads are paused
 TERM_TYPE = "xterm"     # "screen" may be a better default terminal, but arrow keys do not always work
 
 NO_COPY_ENV = set([GT_PREFIX+"EXPORT", "TERM_PROGRAM","TERM_PROGRAM_VERSION", "TERM_SESSION_ID"])
@@ -179,6 +202,9 @@ UNI24 = 24
 UNIMASK = 0xffffff
 ASCIIMASK = 0x7f
 
+STYLE_RUN_RE = re.compile(r"(.)\1*", re.DOTALL)   # Run of identical style codes (one byte per cell)
+CONTROL_RE = re.compile(u"[\x01-\x09\x0b-\x1f]")    # Non-NUL, non-newline control characters
+
 def make_lterm_cookie():
     return "%016d" % random.randrange(10**15, 10**16)
 
@@ -211,17 +237,44 @@ def create_array(fill_value, count):
     """Return array of 32-bit values"""
     return array.array('L', [fill_value]*count)
 
-def dump(data, trim=False, encoded=False):
-    """Return unicode string from array of long data, trimming NULs, and encoded to str, if need be"""
-    if ENCODING == "ascii":
-        ucodes = [(x & ASCIIMASK) for x in data]
-    else:
-        ucodes = [(x & UNIMASK) for x in data]
+def decode(data):
+    """Return unicode string (one character per cell) from array of long data, without cleaning up NULs/DELs"""
+    if ENCODING != "ascii" and sys.byteorder == "little":
+        # Fast path: mask out style byte and decode all cells at once as UTF-32
+        if not isinstance(data, array.array):
+            data = array.array('L', data)
+        itemsize = data.itemsize
+        raw = data.tostring()
+        ubytes = bytearray(4*len(data))
+        ubytes[0::4] = raw[0::itemsize]
+        ubytes[1::4] = raw[1::itemsize]
+        ubytes[2::4] = raw[2::itemsize]
+        try:
+            ustr = str(ubytes).decode("utf-32-le")
+        except UnicodeError:
+            # Invalid code point; use slow path
+            ustr = None
+        if ustr is not None and len(ustr) == len(data):
+            # (Length differs for non-BMP characters on narrow builds)
+            if CONTROL_RE.search(ustr):
+                # Replace non-NUL, non-newline control character by space
+                ustr = CONTROL_RE.sub(u" ", ustr)
+            return ustr
 
-    # Replace non-NUL, non-newline control character by space
-    ucodes = [(32 if (x < 32 and x and x != 10) else x) for x in ucodes]
+    mask = ASCIIMASK if ENCODING == "ascii" else UNIMASK
+    # Mask out style and replace non-NUL, non-newline control character by space
+    return u"".join([unichr(32 if (x < 32 and x and x != 10) else x) for x in [y & mask for y in data]])
 
-    return uclean( u"".join(map(unichr, ucodes)), trim=trim, encoded=encoded)
+def style_codes(data):
+    """Return str of style codes (one byte per cell) from array of long data"""
+    if not isinstance(data, array.array):
+        data = array.array('L', data)
+    offset = 3 if sys.byteorder == "little" else data.itemsize-4
+    return data.tostring()[offset::data.itemsize]
+
+def dump(data, trim=False, encoded=False):
+    """Return unicode string from array of long data, trimming NULs, and encoded to str, if need be"""
+    return uclean(decode(data), trim=trim, encoded=encoded)
 
 def uclean(ustr, trim=False, encoded=False):
     """Return cleaned up unicode string, trimmed and encoded to str, if need be"""
@@ -420,6 +473,147 @@ def parse_headers(text):
 
     return (headers, content)
 
+class PageletReader(object):
+    """Incremental reader for graphterm escape sequence output (headers followed by content).
+    JSON headers are parsed as soon as they are received. Content is then hashed (if x_gterm_digest)
+    and Base64 decoded (if x_gterm_encoding) chunk by chunk, into preallocated bytearrays.
+    For PAGELET_DECODE_TYPES, only decoded content is retained (and x_gterm_encoding is removed from the headers,
+    as is x_gterm_digest, if it matches). Other Base64 content is retained encoded, and decoded only to verify its length.
+    Other output (prompts, raw HTML, MIME headers) is buffered, and parsed by parse_headers when finished.
+    """
+    def __init__(self, max_bytes=MAX_PAGELET_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = ""          # Initial data, until JSON headers are parsed
+        self.chunks = None      # Buffered data (if not JSON headers)
+        self.headers = None     # Parsed JSON headers
+        self.md5 = None
+        self.encoded = False
+        self.decoding = False
+        self.b64_tail = ""      # Base64 characters not yet decoded
+        self.body = None        # Content (bytearray)
+        self.body_len = 0
+        self.decoded_len = 0
+        self.digest_ok = True   # False if digest does not match content (set when finished)
+        self.verified = False   # True if digest and (decoded) content length have been verified (set when finished)
+        self.decoded = False    # True if finished content has been Base64 decoded
+
+    @property
+    def overflow(self):
+        return self.size > self.max_bytes
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.overflow:
+            self.head = ""
+            self.chunks = None
+            self.body = None
+            return
+        if self.chunks is not None:
+            self.chunks.append(data)
+        elif self.headers is not None:
+            self.feed_body(data)
+        else:
+            self.head += data
+            head = self.head.lstrip()
+            if not head:
+                return
+            if not head.startswith("{"):
+                self.buffer()
+                return
+            offsets = [(head.find(sep), sep) for sep in ("\r\n\r\n", "\n\n", "\r\r")]
+            offsets = [(offset, sep) for offset, sep in offsets if offset >= 0]
+            if not offsets:
+                if len(self.head) > MAX_PAGELET_HEADER:
+                    self.buffer()
+                return
+            offset, sep = min(offsets)
+            try:
+                headers = json.loads(head[:offset])
+                assert isinstance(headers, dict)
+            except Exception:
+                # Let parse_headers report error
+                self.buffer()
+                return
+            self.head = ""
+            self.start_body(headers)
+            self.feed_body(head[offset+len(sep):])
+
+    def buffer(self):
+        """Switch to buffering all data"""
+        self.chunks = [self.head]
+        self.head = ""
+
+    def start_body(self, headers):
+        headers.setdefault("x_gterm_response", "")
+        headers.setdefault("x_gterm_parameters", {})
+        self.headers = headers
+        if headers.get("x_gterm_digest"):
+            self.md5 = hashlib.md5()
+        self.encoded = headers.get("x_gterm_encoding") == "base64"
+        self.decoding = self.encoded and headers["x_gterm_response"] in PAGELET_DECODE_TYPES
+        content_length = headers.get("content_length") or 0
+        if not isinstance(content_length, (int, long)) or content_length < 0 or content_length > self.max_bytes:
+            content_length = 0
+        if self.encoded and not self.decoding:
+            content_length = 4*((content_length+2)//3)
+        self.body = bytearray(content_length)
+
+    def append_body(self, data):
+        end = self.body_len + len(data)
+        self.body[self.body_len:end] = data    # (Extends body, if need be)
+        self.body_len = end
+
+    def feed_body(self, data):
+        if not data:
+            return
+        if self.md5:
+            self.md5.update(data)
+        if self.encoded:
+            b64_data = self.b64_tail + data.translate(None, " \t\r\n")
+            nb64 = len(b64_data) - len(b64_data) % 4
+            self.b64_tail = b64_data[nb64:]
+            try:
+                decoded_data = binascii.a2b_base64(b64_data[:nb64])
+            except binascii.Error:
+                decoded_data = ""
+                self.decoded_len = -self.max_bytes  # Invalid encoding; content length will not be verified
+            self.decoded_len += len(decoded_data)
+            if self.decoding:
+                self.append_body(decoded_data)
+                return
+        self.append_body(data)
+
+    def text(self):
+        """Returns all buffered data (for output that is not a pagelet)"""
+        return "".join(self.chunks) if self.chunks is not None else self.head
+
+    def finish(self):
+        """Returns (headers, content) (with content decoded, if self.decoded)"""
+        if self.headers is None:
+            headers, content = parse_headers(self.text().lstrip())
+            self.chunks = None
+            md5_digest = headers.get("x_gterm_digest", "")
+            self.digest_ok = not md5_digest or md5_digest == hashlib.md5(content).hexdigest()
+            return headers, content
+
+        if self.b64_tail:
+            self.decoded_len = -self.max_bytes  # Incomplete encoding
+        del self.body[self.body_len:]
+        content = str(self.body)
+        self.body = None
+        md5_digest = self.headers.get("x_gterm_digest", "")
+        self.digest_ok = not md5_digest or md5_digest == self.md5.hexdigest()
+        content_length = self.decoded_len if self.encoded else len(content)
+        self.verified = self.digest_ok and content_length == self.headers.get("content_length")
+        self.decoded = self.decoding
+        if self.decoded:
+            # Headers now describe decoded content
+            self.headers.pop("x_gterm_encoding", None)
+            if self.digest_ok:
+                self.headers.pop("x_gterm_digest", None)
+        return self.headers, content
+
 def shplit(line, delimiters=COMMAND_DELIMITERS, final_delim="&", index=None):
     """Split shell command line, returning all components as a list, including separators
     """
@@ -582,6 +776,151 @@ def command_markup(entry_index, current_dir, pre_offset, offset, line):
             marked_up += plain_markup(comp)
     return marked_up
 
+class ScrollLine(object):
+    """Compact scroll buffer entry; as_list() returns entry as [entry_index, offset, dir, row_params, line, markup].
+    Plain text row_params ["", {"add_class": add_class, "pagelet_id": pagelet_id}] are not stored,
+    but generated when required (row_params is None for such lines).
+    """
+    __slots__ = ("entry_index", "offset", "dir", "row_params", "add_class", "pagelet_id", "line", "markup")
+
+    def __init__(self, entry_index, offset, dir, row_params, line, markup):
+        self.entry_index = entry_index
+        self.offset = offset
+        self.dir = dir
+        self.set_params(row_params)
+        self.line = line
+        self.markup = markup
+
+    @classmethod
+    def from_list(cls, entry, entry_index=None):
+        return cls(entry[JINDEX] if entry_index is None else entry_index, entry[JOFFSET], entry[JDIR],
+                   entry[JPARAMS], entry[JLINE], entry[JMARKUP])
+
+    def set_params(self, row_params):
+        opts = row_params[JOPTS]
+        if not row_params[JTYPE] and (not opts or (len(opts) == 2 and "add_class" in opts and "pagelet_id" in opts)):
+            self.row_params = None
+            self.add_class = opts.get("add_class", "")
+            self.pagelet_id = opts.get("pagelet_id", "")
+        else:
+            self.row_params = row_params
+            self.add_class = ""
+            self.pagelet_id = ""
+
+    @property
+    def params(self):
+        if self.row_params is not None:
+            return self.row_params
+        return ["", self.compact_params or {}]
+
+    @property
+    def compact_params(self):
+        """Returns row_params in compact form: 0 for plain text lines without options,
+        just the options dict for other plain text lines, and the full row_params otherwise
+        """
+        if self.row_params is not None:
+            return self.row_params
+        if self.add_class or self.pagelet_id:
+            return {"add_class": self.add_class, "pagelet_id": self.pagelet_id}
+        return 0
+
+    @property
+    def plain(self):
+        return self.row_params is None or not self.row_params[JTYPE]
+
+    def as_list(self):
+        return [self.entry_index, self.offset, self.dir, self.params, self.line, self.markup]
+
+class ScrollArchive(object):
+    """Append-only disk log of scroll lines evicted from the scroll buffer (one JSON record per line).
+    The index file holds the log offset of every ARCHIVE_SEGMENT_LINES-th line (packed unsigned 64-bit),
+    and is memory-mapped for reading. Lines are numbered from 0 in order of archiving.
+    """
+    INDEX_FORMAT = "<Q"
+    INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+    def __init__(self, path_prefix):
+        self.log_path = path_prefix + ".log"
+        self.index_path = path_prefix + ".idx"
+        self.log_file = open(self.log_path, "w+b")
+        self.index_file = open(self.index_path, "w+b")
+        self.index_map = None
+        self.count = 0
+        self.log_size = 0
+
+    def append(self, scroll_line):
+        if not self.count % ARCHIVE_SEGMENT_LINES:
+            self.index_file.write(struct.pack(self.INDEX_FORMAT, self.log_size))
+        record = json.dumps([scroll_line.entry_index, scroll_line.offset, scroll_line.dir,
+                             scroll_line.compact_params, scroll_line.line, scroll_line.markup]) + "\n"
+        self.log_file.write(record)
+        self.log_size += len(record)
+        self.count += 1
+
+    def segment_offset(self, segment):
+        self.index_file.flush()
+        nbytes = (segment+1)*self.INDEX_SIZE
+        if not self.index_map or len(self.index_map) < nbytes:
+            # Remap grown index
+            if self.index_map:
+                self.index_map.close()
+            self.index_map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return struct.unpack_from(self.INDEX_FORMAT, self.index_map, segment*self.INDEX_SIZE)[0]
+
+    def records(self, start=0):
+        """Yield (line_number, record) for archived lines from start onwards"""
+        if start >= self.count:
+            return
+        segment = start // ARCHIVE_SEGMENT_LINES
+        self.log_file.flush()
+        with open(self.log_path, "rb") as f:
+            f.seek(self.segment_offset(segment))
+            line_number = segment*ARCHIVE_SEGMENT_LINES
+            for record in f:
+                if line_number >= self.count:
+                    break
+                if line_number >= start:
+                    yield line_number, record
+                line_number += 1
+
+    @staticmethod
+    def decode(record):
+        """Returns [entry_index, offset, dir, row_params, line, markup] for record"""
+        entry = json.loads(record)
+        if not isinstance(entry[JPARAMS], list):
+            # Compact plain text params
+            entry[JPARAMS] = ["", entry[JPARAMS] or {}]
+        return entry
+
+    def get_lines(self, start, count):
+        """Returns up to count archived lines from line number start"""
+        lines = []
+        for line_number, record in self.records(max(0, start)):
+            if len(lines) >= count:
+                break
+            lines.append(self.decode(record))
+        return lines
+
+    def search(self, pattern, max_matches=MAX_ARCHIVE_MATCHES):
+        """Returns [[line_number, line], ...] for the last max_matches archived lines whose text matches regexp pattern"""
+        regexp = re.compile(pattern)
+        matches = collections.deque(maxlen=max_matches)
+        for line_number, record in self.records():
+            entry = self.decode(record)
+            if regexp.search(entry[JLINE]):
+                matches.append([line_number, entry])
+        return list(matches)
+
+    def close(self):
+        if self.index_map:
+            self.index_map.close()
+            self.index_map = None
+        for f, path in ((self.log_file, self.log_path), (self.index_file, self.index_path)):
+            f.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 class ScreenBuf(object):
     def __init__(self, pdelim, fg_color=0, bg_color=7, colors=False):
@@ -608,6 +947,9 @@ class ScreenBuf(object):
         self.bold_style = 0x08
 
         self.default_nul = self.default_style << UNI24
+        self.style_cache = {}
+        self.dir_cache = {}     # Interned directory strings for scroll lines
+        self.archive = None     # Optional ScrollArchive for lines evicted from scroll buffer
         self.cur_note = 0
         self.blobs = {}
         self.delete_blob_ids = []
@@ -618,7 +960,7 @@ class ScreenBuf(object):
             self.blobs = {}
 
     def prefill_buf(self, scroll_lines, redisplay=False):
-        self.scroll_lines = scroll_lines[:]
+        self.scroll_lines = collections.deque(ScrollLine.from_list(entry) for entry in scroll_lines)
         if redisplay:
             self.last_scroll_count = self.current_scroll_count
         self.current_scroll_count += len(scroll_lines)
@@ -627,16 +969,32 @@ class ScreenBuf(object):
 
     def clear_buf(self):
         self.last_scroll_count = self.current_scroll_count
-        self.scroll_lines = []
+        self.scroll_lines = collections.deque()
         self.full_update = True
 
-    def add_blob(self, blob_id, content_type, content_b64):
-        self.blobs[blob_id] = (str(content_type), content_b64)
+    def get_lines(self):
+        """Returns all buffered scroll lines as lists"""
+        return [scroll_line.as_list() for scroll_line in self.scroll_lines]
+
+    def tail_lines(self, count):
+        """Returns last count scroll lines (ScrollLine instances)"""
+        if count >= len(self.scroll_lines):
+            return list(self.scroll_lines)
+        tail = list(itertools.islice(reversed(self.scroll_lines), count))
+        tail.reverse()
+        return tail
+
+    def intern_dir(self, dir):
+        return self.dir_cache.setdefault(dir, dir)
+
+    def add_blob(self, blob_id, content_type, content):
+        self.blobs[blob_id] = (str(content_type), content)
 
     def get_blob_data_uri(self, blob_id):
         if blob_id not in self.blobs:
             return ""
-        return "data:%s;base64,%s" % self.blobs[blob_id]
+        content_type, content = self.blobs[blob_id]
+        return "data:%s;base64,%s" % (content_type, base64encode(content))
 
     def delete_blob(self, blob_id):
         if not blob_id:
@@ -648,24 +1006,24 @@ class ScreenBuf(object):
     def clear_last_entry(self, last_entry_index=None):
         if not self.scroll_lines or self.entry_index <= 0:
             return
-        n = len(self.scroll_lines)-1
-        entry_index, offset, dir, row_params, line, markup = self.scroll_lines[n]
+        entry_index = self.scroll_lines[-1].entry_index
         if self.entry_index != entry_index:
             return
         if last_entry_index and last_entry_index != entry_index:
             return
         self.entry_index -= 1
-        while n > 0 and self.scroll_lines[n-1][JINDEX] == entry_index:
-            n -= 1
-        self.current_scroll_count -= len(self.scroll_lines) - n
+        cleared_lines = []
+        while self.scroll_lines and self.scroll_lines[-1].entry_index == entry_index:
+            cleared_lines.append(self.scroll_lines.pop())
+        cleared_lines.reverse()
+        self.current_scroll_count -= len(cleared_lines)
         self.cleared_last = True
         if self.cleared_current_dir is None:
-            self.cleared_current_dir = self.scroll_lines[n][JDIR]
+            self.cleared_current_dir = cleared_lines[0].dir
 
-        for scroll_line in self.scroll_lines[n:]:
-            self.delete_blob(scroll_line[JPARAMS][JOPTS].get("blob"))
+        for scroll_line in cleared_lines:
+            self.delete_blob(scroll_line.params[JOPTS].get("blob"))
 
-        self.scroll_lines[n:] = []
         if self.last_scroll_count > self.current_scroll_count:
             self.last_scroll_count = self.current_scroll_count
 
@@ -673,11 +1031,12 @@ class ScreenBuf(object):
         """Replace previous entry (usually edit or form) with blank pagelet"""
         if not self.scroll_lines:
             return
-        assert not self.scroll_lines[-1][JOFFSET]
-        self.scroll_lines[-1][JPARAMS] = ["pagelet", {"add_class": "",
-                                                      "pagelet_id": "%d-%d" % (self.cur_note, self.current_scroll_count)} ]
-        self.scroll_lines[-1][JLINE] = ""
-        self.scroll_lines[-1][JMARKUP] = ""
+        last_line = self.scroll_lines[-1]
+        assert not last_line.offset
+        last_line.set_params(["pagelet", {"add_class": "",
+                                          "pagelet_id": "%d-%d" % (self.cur_note, self.current_scroll_count)} ])
+        last_line.line = ""
+        last_line.markup = ""
         if self.current_scroll_count > 0 and self.last_scroll_count >= self.current_scroll_count:
             self.last_scroll_count = self.current_scroll_count - 1
 
@@ -709,9 +1068,11 @@ class ScreenBuf(object):
             ##logging.warning("ABCscroll_buf_up: overwrite=%s, %s", overwrite, markup)
 
         cur_pagelet_id = "%d-%d" % (self.cur_note, self.current_scroll_count)
-        prev_pagelet_opts = self.scroll_lines[-1][JPARAMS][JOPTS] if self.scroll_lines and self.scroll_lines[-1][JPARAMS][JTYPE] == "pagelet" else {}
+        last_line = self.scroll_lines[-1] if self.scroll_lines else None
+        last_type = last_line.row_params[JTYPE] if last_line and last_line.row_params else ""
+        prev_pagelet_opts = last_line.row_params[JOPTS] if last_type == "pagelet" else {}
         prev_blob_id = prev_pagelet_opts.get("blob", "")
-        prev_edit_file = self.scroll_lines and self.scroll_lines[-1][JPARAMS][JTYPE] == "edit_file"
+        prev_edit_file = last_type == "edit_file"
 
         row_params[JOPTS]["add_class"] = add_class
         ##logging.warning("ABCscroll_buf_up2: type=%s, line='%s', overwrite=%s, opts=%s, id=%s", row_params[JTYPE], line, overwrite, prev_pagelet_opts, cur_pagelet_id)
@@ -719,10 +1080,10 @@ class ScreenBuf(object):
         if overwrite and prev_pagelet_opts and prev_pagelet_opts["pagelet_id"] == cur_pagelet_id:
             # Overwrite previous pagelet entry
             row_params[JOPTS]["pagelet_id"] = cur_pagelet_id
-            self.scroll_lines[-1][JDIR] = current_dir
-            self.scroll_lines[-1][JPARAMS] = row_params
-            self.scroll_lines[-1][JLINE] = line
-            self.scroll_lines[-1][JMARKUP] = markup
+            last_line.dir = self.intern_dir(current_dir)
+            last_line.set_params(row_params)
+            last_line.line = line
+            last_line.markup = markup
             if prev_blob_id and prev_blob_id != new_blob_id:
                 self.delete_blob(prev_blob_id)
             if self.current_scroll_count > 0 and self.last_scroll_count >= self.current_scroll_count:
@@ -734,33 +1095,69 @@ class ScreenBuf(object):
 
             if prev_pagelet_opts and prev_pagelet_opts.get("autoerase"):
                 # Auto erase previous pagelet entry
-                self.scroll_lines[-1][JPARAMS] = ["", {}]
-                self.scroll_lines[-1][JLINE] = ""
-                self.scroll_lines[-1][JMARKUP] = None
+                last_line.set_params(["", {}])
+                last_line.line = ""
+                last_line.markup = None
                 if prev_blob_id and prev_blob_id != new_blob_id:
                     self.delete_blob(prev_blob_id)
 
             self.current_scroll_count += 1
             row_params[JOPTS]["pagelet_id"] = "%d-%d" % (self.cur_note, self.current_scroll_count)
-            self.scroll_lines.append([self.entry_index, offset, current_dir, row_params, line, markup])
+            self.scroll_lines.append(ScrollLine(self.entry_index, offset, self.intern_dir(current_dir), row_params, line, markup))
             if len(self.scroll_lines) > MAX_SCROLL_LINES:
-                old_entry_index, old_offset, old_dir, old_params, old_line, old_markup = self.scroll_lines.pop(0)
-                self.delete_blob(old_params[JOPTS].get("blob"))
-                while self.scroll_lines and self.scroll_lines[0][JINDEX] == old_entry_index:
-                    tem_entry_index, tem_offset, tem_dir, tem_params, tem_line, tem_markup = self.scroll_lines.pop(0)
-                    self.delete_blob(tem_params[JOPTS].get("blob"))
+                old_line = self.scroll_lines.popleft()
+                self.evict(old_line)
+                while self.scroll_lines and self.scroll_lines[0].entry_index == old_line.entry_index:
+                    self.evict(self.scroll_lines.popleft())
+
+    def evict(self, scroll_line):
+        """Discard line removed from scroll buffer (after archiving it, if archive is enabled)"""
+        if self.archive:
+            self.archive.append(scroll_line)
+        self.delete_blob(scroll_line.params[JOPTS].get("blob"))
 
 
     def append_scroll(self, scroll_lines):
-        tem_lines = scroll_lines[:]
-        for tem_line in tem_lines:
-            tem_line[JINDEX] = self.entry_index
-        self.scroll_lines += tem_lines
-        self.current_scroll_count += len(tem_lines)
+        for entry in scroll_lines:
+            self.scroll_lines.append(ScrollLine.from_list(entry, entry_index=self.entry_index))
+        self.current_scroll_count += len(scroll_lines)
+
+    def get_scroll_lines(self, first_count, count):
+        """Returns buffered scroll lines numbered first_count onwards (lines no longer in buffer are omitted)"""
+        start = first_count - (self.current_scroll_count - len(self.scroll_lines) + 1)
+        return [scroll_line.as_list() for scroll_line in itertools.islice(self.scroll_lines, max(0, start), max(0, start+count))]
+
+    def get_scroll_page(self, cursor, count=SCROLL_PAGE_LINES):
+        """Returns (next_cursor, lines) for up to count buffered lines preceding scroll count cursor.
+        next_cursor is the cursor for the preceding page (or 0, if there are no older lines in buffer).
+        """
+        first_count = self.current_scroll_count - len(self.scroll_lines) + 1
+        cursor = min(cursor, self.current_scroll_count+1)
+        start = max(first_count, cursor - count)
+        return (start if start > first_count else 0), self.get_scroll_lines(start, cursor - start)
+
+    def elide_scroll(self, tail_lines):
+        """Returns tail_lines as lists, replacing leading plain text lines beyond the last FLOOD_SCROLL_LINES with a marker line.
+        The marker row_params option elided=[first_count, count] identifies the lines for get_scroll_lines.
+        """
+        n = 0
+        max_elide = len(tail_lines) - FLOOD_SCROLL_LINES
+        while n < max_elide and not tail_lines[n].offset and tail_lines[n].plain:
+            n += 1
+        if n < 2:
+            return [scroll_line.as_list() for scroll_line in tail_lines]
+        first_count = self.current_scroll_count - len(tail_lines) + 1
+        marker = [tail_lines[0].entry_index, 0, "", ["", {"add_class": "gterm-elided", "elided": [first_count, n]}],
+                  "[%d lines elided]" % n, None]
+        return [marker] + [scroll_line.as_list() for scroll_line in tail_lines[n:]]
 
     def update(self, active_rows, width, height, cursorx, cursory, main_screen,
-               alt_screen=None, pdelim=[], reconnecting=False):
+               alt_screen=None, pdelim=[], reconnecting=False, dirty_rows=None, elide=False,
+               reconnect_lines=SCROLL_PAGE_LINES):
         """ Returns full_update, update_rows, update_scroll
+        dirty_rows: set of rows modified since last update (None for all rows)
+        elide: if True, elide older plain scroll lines (when flooding)
+        reconnect_lines: no. of scroll lines to send when reconnecting (None for all; older pages are sent on request)
         """
         full_update = self.full_update or reconnecting
 
@@ -784,22 +1181,23 @@ class ScreenBuf(object):
         cursor_moved = (cursorx != self.cursorx or cursory != self.cursory)
         update_rows = []
 
+        all_rows = full_update or old_screen is None or dirty_rows is None
         for j in range(row_count):
-            new_row = screen.data[width*j:width*(j+1)]
-            if full_update or old_screen is None:
-                row_update = True
-            else:
-                row_update = (new_row != old_screen.data[width*j:width*(j+1)])
+            row_update = all_rows or j in dirty_rows
             if row_update or (cursor_moved and (cursory == j or self.cursory == j)):
-                new_row_str = dump(new_row)
+                new_row_str = screen.dump_row(j)
                 opts = {"add_class": ""}
                 offset = prompt_offset(new_row_str, pdelim, screen.meta[j])
-                update_rows.append([j, offset, "", ["", opts], self.dumprichtext(new_row, trim=True), None])
+                update_rows.append([j, offset, "", ["", opts], self.dumprichtext(screen.rows[j], trim=True, ustr=screen.decode_row(j)), None])
 
         if reconnecting:
-            update_scroll = self.scroll_lines[:]
+            update_scroll = self.get_lines() if reconnect_lines is None else [scroll_line.as_list() for scroll_line in self.tail_lines(reconnect_lines)]
         elif self.last_scroll_count < self.current_scroll_count:
-            update_scroll = self.scroll_lines[self.last_scroll_count-self.current_scroll_count:]
+            tail_lines = self.tail_lines(self.current_scroll_count-self.last_scroll_count)
+            if elide and len(tail_lines) > FLOOD_SCROLL_LINES:
+                update_scroll = self.elide_scroll(tail_lines)
+            else:
+                update_scroll = [scroll_line.as_list() for scroll_line in tail_lines]
         else:
             update_scroll = []
 
@@ -808,18 +1206,18 @@ class ScreenBuf(object):
             self.full_update = False
             self.cursorx = cursorx
             self.cursory = cursory
-            self.main_screen = main_screen.make_copy() if main_screen else None
-            self.alt_screen = alt_screen.make_copy() if alt_screen else None
+            self.main_screen = main_screen
+            self.alt_screen = alt_screen
 
         return full_update, update_rows, update_scroll
 
-    def dumpmarkup(self, data, trim=False):
+    def dumpmarkup(self, data, trim=False, ustr=None):
         """ Returns html markup of line with styles, or None, if no markup is required (plain text line)
         NOTE: This operation should perhaps be carried out in graphterm.js?
         """
         marked_up = False
         html = ""
-        for style_list, text in self.dumprichtext(data, trim=trim):
+        for style_list, text in self.dumprichtext(data, trim=trim, ustr=ustr):
             escaped_text = cgi.escape(text)
             if style_list:
                 marked_up = True
@@ -828,45 +1226,48 @@ class ScreenBuf(object):
                 html += escaped_text
         return html if marked_up else None
         
-    def dumprichtext(self, data, trim=False):
-        """Returns [(style_list, utf8str), ...] for line data"""
-        if all((x >> UNI24) == self.default_style for x in data):
+    def dumprichtext(self, data, trim=False, ustr=None):
+        """Returns [(style_list, utf8str), ...] for line data (ustr: decoded data, if already available)"""
+        if ustr is None:
+            ustr = decode(data)
+        styles = style_codes(data)
+        if styles.count(chr(self.default_style)) == len(styles):
             # All default style (optimize)
-            return [([], dump(data, trim=trim, encoded=True))]
+            return [([], uclean(ustr, trim=trim, encoded=True))]
 
+        # Split decoded line into runs of the same style
         span_list = []
-        style_list = []
-        span_style, span_bg, span_fg = self.default_style, -1, -1
-        span = u""
-        for scode in data:
-            char_style = scode >> UNI24
-            ucode = scode & ASCIIMASK if ENCODING == "ascii" else scode & UNIMASK
-            if ucode < 32 and ucode and ucode != 10:
-                # Replace non-NUL, non-newline control character by space
-                ucode = 32
-            if span_style != char_style:
-                if span:
-                    span_list.append( (style_list, uclean(span, encoded=True)) )
-                    span = u""
-                span_style = char_style
-                style_list = []
-                if span_style & self.bold_style:
-                    style_list.append("bold")
-                if (span_style & 0x77) == self.inverse_style:
-                    style_list.append("inverse")
-                if self.colors:
-                    fg_color = span_style & 0x7
-                    bg_color = ((span_style >> STYLE4) & 0x7) ^ 0x7 # Bg color is XOR'ed
-                    if fg_color > 0 and fg_color <= 7:
-                        style_list.append("fgcolor%d" % fg_color)
-                    if bg_color >= 0 and bg_color < 7:
-                        style_list.append("bgcolor%d" % bg_color)
-            span += unichr(ucode)
-        cspan = uclean(span, trim=trim, encoded=True)
-        if cspan:
-            span_list.append( (style_list, cspan) )
+        for mo in STYLE_RUN_RE.finditer(styles):
+            offset, end = mo.span()
+            span_style = ord(mo.group(1))
+            style_list = [] if (not offset and span_style == self.default_style) else self.style_classes(span_style)
+            if end < len(styles):
+                span_list.append( (style_list, uclean(ustr[offset:end], encoded=True)) )
+            else:
+                cspan = uclean(ustr[offset:end], trim=trim, encoded=True)
+                if cspan:
+                    span_list.append( (style_list, cspan) )
         return span_list
 
+    def style_classes(self, span_style):
+        """Returns (memoized) list of CSS classes for style code"""
+        style_list = self.style_cache.get(span_style)
+        if style_list is None:
+            style_list = []
+            if span_style & self.bold_style:
+                style_list.append("bold")
+            if (span_style & 0x77) == self.inverse_style:
+                style_list.append("inverse")
+            if self.colors:
+                fg_color = span_style & 0x7
+                bg_color = ((span_style >> STYLE4) & 0x7) ^ 0x7 # Bg color is XOR'ed
+                if fg_color > 0 and fg_color <= 7:
+                    style_list.append("fgcolor%d" % fg_color)
+                if bg_color >= 0 and bg_color < 7:
+                    style_list.append("bgcolor%d" % bg_color)
+            self.style_cache[span_style] = style_list
+        return style_list
+
     def __repr__(self):
         if not self.main_screen:
             return ""
@@ -877,22 +1278,103 @@ class ScreenBuf(object):
         return r
 
 class Screen(object):
+    """Screen cells stored as a list of per-row arrays, so that scrolling moves row references, not cells.
+    Cell positions passed to peek/poke/zero are flat offsets (width*y + x), i.e., they may run across rows.
+    """
     def __init__(self, width, height, data=None, meta=None):
         self.width = width
         self.height = height
-        self.data = data or create_array(0, width*height)
-        self.meta = [None] * height
+        self.rows = [create_array(0, width) for j in range(height)]
+        self.text = [None] * height     # Decoded rows (None until decoded, and whenever row is written)
+        self.meta = meta or [None] * height
+        if data:
+            self.poke(0, 0, data)
+
+    @property
+    def data(self):
+        """Flat copy of all cells"""
+        return self.peek(0, 0, self.height, 0)
 
     def make_copy(self):
-        return Screen(self.width, self.height, data=copy.copy(self.data), meta=copy.copy(self.meta))
+        return Screen(self.width, self.height, data=self.data, meta=copy.copy(self.meta))
+
+    def decode_row(self, j):
+        """Return decoded row j (cached until the row is next written)"""
+        ustr = self.text[j]
+        if ustr is None:
+            ustr = self.text[j] = decode(self.rows[j])
+        return ustr
+
+    def dump_row(self, j, trim=False, encoded=False):
+        return uclean(self.decode_row(j), trim=trim, encoded=encoded)
+
+    def peek(self, y1, x1, y2, x2):
+        """Return copy of cells from (y1, x1) up to, but not including, (y2, x2)"""
+        start = self.width*y1 + x1
+        end = min(self.width*y2 + x2, self.width*self.height)
+        y, x = divmod(start, self.width)
+        if end - start <= self.width - x:
+            return self.rows[y][x:x+max(0, end-start)]
+        s = self.rows[y][x:]
+        start += self.width - x
+        while start < end:
+            y += 1
+            s += self.rows[y][:end-start]
+            start += self.width
+        return s
+
+    def poke(self, y, x, s):
+        """Overwrite cells starting at (y, x) with array s; returns last row written (or -1)"""
+        y, x = divmod(self.width*y + x, self.width)
+        offset = 0
+        count = len(s)
+        while offset < count and y < self.height:
+            n = min(count-offset, self.width-x)
+            self.rows[y][x:x+n] = s[offset:offset+n]
+            self.text[y] = None
+            offset += n
+            y += 1
+            x = 0
+        return y-1 if offset else -1
+
+    def zero(self, y1, x1, y2, x2):
+        """Zero cells from (y1, x1) to (y2, x2) inclusive; returns last row zeroed"""
+        count = self.width*(y2-y1) + x2 - x1 + 1
+        return self.poke(y1, x1, create_array(0, count))
+
+    def scroll_up(self, y1, y2):
+        """Scroll rows y1..y2 up by one, blanking row y2"""
+        row = self.rows.pop(y1)
+        row[:] = create_array(0, self.width)
+        self.rows.insert(y2, row)
+        del self.text[y1]
+        self.text.insert(y2, None)
+        del self.meta[y1]
+        self.meta.insert(y2, None)
+
+    def scroll_down(self, y1, y2):
+        """Scroll rows y1..y2 down by one, blanking row y1"""
+        row = self.rows.pop(y2)
+        row[:] = create_array(0, self.width)
+        self.rows.insert(y1, row)
+        del self.text[y2]
+        self.text.insert(y1, None)
+        del self.meta[y2]
+        self.meta.insert(y1, None)
 
 class Terminal(object):
     def __init__(self, term_name, fd, pid, screen_callback, height=25, width=80, winheight=0, winwidth=0,
-                 cookie=0, shared_secret="", host="", server_url="", pdelim=[], term_params={}, logfile=""):
+                 cookie=0, shared_secret="", host="", server_url="", pdelim=[], term_params={}, logfile="",
+                 schedule_update=None, flood_rate=0):
+        """schedule_update(term_name): optional callback invoked whenever the terminal needs updating
+        flood_rate: output rate (bytes/sec) above which terminal is flooding (0 to disable)
+        """
         self.term_name = term_name
         self.fd = fd
         self.pid = pid
         self.screen_callback = screen_callback
+        self.schedule_update = schedule_update
+        self.lock = threading.RLock()   # Held while reading from, writing to, or updating terminal
         self.width = width
         self.height = height
         self.winwidth = winwidth
@@ -905,8 +1387,17 @@ class Terminal(object):
         self.term_params = term_params
         tem_str = term_params.get("term_opts","").strip()
         self.term_opts = set(tem_str.split(",") if tem_str else [])
+        self.max_pagelet_bytes = int(term_params.get("max_pagelet_bytes") or MAX_PAGELET_BYTES)
         self.logfile = logfile
         self.screen_buf = ScreenBuf(pdelim, colors="no_colors" not in self.term_opts)
+        archive_dir = term_params.get("scroll_archive")
+        if archive_dir:
+            try:
+                if not os.path.isdir(archive_dir):
+                    os.makedirs(archive_dir)
+                self.screen_buf.archive = ScrollArchive(os.path.join(archive_dir, "%s-%d-%d" % (term_name, os.getpid(), pid)))
+            except Exception, excp:
+                logging.warning("lineterm: Unable to create scroll archive in %s: %s", archive_dir, excp)
 
         self.note_count = 0
         self.note_screen_buf = ScreenBuf("", colors="no_colors" not in self.term_opts)
@@ -918,6 +1409,10 @@ class Terminal(object):
         self.remote_dir = ""
         self.current_meta = None
         self.output_time = time.time()
+        self.flood_rate = flood_rate
+        self.flood_time = self.output_time
+        self.flood_bytes = 0
+        self.flooding = False
         self.buf = ""
         self.alt_mode = False
         self.screen = self.main_screen
@@ -983,15 +1478,15 @@ class Terminal(object):
         for k,v in self.esc_seq.items():
             if v==None:
                 self.esc_seq[k] = self.esc_ignore
-        # regex
-        d={
-                r'\[\??([0-9;]*)([@ABCDEFGHJKLMPXacdefghlmnqrstu`])' : self.csi_dispatch,
-                r'\]([^\x07]+)\x07' : self.esc_ignore,
+        # parsers for escape sequences introduced by ESC+char (all others are parsed by parse_esc)
+        self.esc_parsers={
+                "[": self.parse_csi,
+                "]": self.parse_string,
+                "P": self.parse_string,
+                "X": self.parse_string,
+                "^": self.parse_string,
+                "_": self.parse_string,
         }
-
-        self.esc_re=[]
-        for k,v in d.items():
-            self.esc_re.append((re.compile('\x1b'+k), v))
         # define csi sequences
         self.csi_seq={
                 '@': (self.csi_at,[1]),
@@ -1007,9 +1502,10 @@ class Terminal(object):
     def reset(self, s=""):
         # Reset screen buffers
         self.update_time = 0
-        self.needs_updating = True
+        self.request_update()
         self.main_screen = Screen(self.width, self.height)
         self.alt_screen  = Screen(self.width, self.height)
+        self.dirty_rows = set(range(self.height))
         self.scroll_top = 0
         self.scroll_bot = 0 if self.note_cells else self.height-1
         self.cursor_x_bak = self.cursor_x = 0
@@ -1022,7 +1518,6 @@ class Terminal(object):
         self.active_rows = 0
         self.gterm_code = None
         self.gterm_buf = None
-        self.gterm_buf_size = 0
         self.gterm_entry_index = None
         self.gterm_validated = False
         self.gterm_output_buf = []
@@ -1038,8 +1533,8 @@ class Terminal(object):
                 if self.active_rows > 1:
                     self.scroll_screen(self.active_rows-1)
                 # Save last line
-                line = dump(self.main_screen.data[:min_width])
-                saved_line = [len(line.rstrip(u'\x00')), self.main_screen.meta[0], self.main_screen.data[:min_width]]
+                line = self.main_screen.dump_row(0)[:min_width]
+                saved_line = [len(line.rstrip(u'\x00')), self.main_screen.meta[0], self.main_screen.rows[0][:min_width]]
             self.width = width
             self.height = height
             self.reset()
@@ -1049,10 +1544,10 @@ class Terminal(object):
                 self.active_rows = 1
                 self.cursor_x = saved_line[0]
                 self.main_screen.meta[0] = saved_line[1]
-                self.main_screen.data[:min_width] = saved_line[2]
+                self.main_screen.poke(0, 0, saved_line[2])
 
         self.screen = self.alt_screen if self.alt_mode else self.main_screen
-        self.needs_updating = True
+        self.request_update()
 
     def open_notebook(self, filepath, prompts=[], params={}, content=None):
         if prompts:
@@ -1074,7 +1569,7 @@ class Terminal(object):
         if not prompts:
             # Search buffer to use current prompt
             try:
-                line = dump(self.peek(self.cursor_y, 0, self.cursor_y, self.width), trim=True, encoded=True)
+                line = self.screen.dump_row(self.cursor_y, trim=True, encoded=True)
                 comps = line.split()
                 if comps and comps[0]:
                     prompts = [comps[0]+" "]
@@ -1290,7 +1785,7 @@ class Terminal(object):
                 cur_cell["cellInput"] = mod_input
                 modified = True
         if cur_cell["cellType"] not in MARKUP_TYPES:
-            mod_output = strip_prompt_lines(self.note_screen_buf.scroll_lines, self.note_prompts)
+            mod_output = strip_prompt_lines(self.note_screen_buf.get_lines(), self.note_prompts)
             if cur_cell["cellOutput"] != mod_output:
                 cur_cell["cellOutput"] = mod_output
                 modified = True
@@ -1975,7 +2470,7 @@ class Terminal(object):
         cur_cell = self.note_cells["cells"][cur_index]
         self.scroll_screen(self.active_rows)
         if cur_cell["cellType"] not in MARKUP_TYPES:
-            cur_cell["cellOutput"] = strip_prompt_lines(self.note_screen_buf.scroll_lines, self.note_prompts)
+            cur_cell["cellOutput"] = strip_prompt_lines(self.note_screen_buf.get_lines(), self.note_prompts)
             self.note_update_time = time.time()
         self.note_screen_buf.clear_buf()
         self.note_cells["curIndex"] = 0
@@ -2238,7 +2733,7 @@ class Terminal(object):
                     if cur_cell["cellParams"]["executed"]:
                         prev_cell["cellInput"] += ["", "**Your Output:**", ""]
                         self.scroll_screen(self.active_rows)
-                        scroll_lines = strip_prompt_lines(self.note_screen_buf.scroll_lines, self.note_prompts)
+                        scroll_lines = strip_prompt_lines(self.note_screen_buf.get_lines(), self.note_prompts)
 
                         expect_lines = []
                         for scroll_line in scroll_lines:
@@ -2449,7 +2944,7 @@ class Terminal(object):
 
     def clear(self):
         self.screen_buf.clear_buf()
-        self.needs_updating = True
+        self.request_update()
 
     def reconnect(self, response_id=""):
         self.update_callback(response_id=response_id)
@@ -2458,13 +2953,49 @@ class Terminal(object):
     def clear_last_entry(self, last_entry_index=None):
         self.screen_buf.clear_last_entry(last_entry_index=last_entry_index)
 
+    def get_archive(self, start, count, pattern="", response_id=""):
+        """Send count archived scroll lines from line number start, or the last lines matching pattern (if specified)"""
+        archive = self.screen_buf.archive
+        if not archive:
+            self.screen_callback(self.term_name, response_id, "archive_lines", [start, 0, []])
+        elif pattern:
+            try:
+                matches = archive.search(pattern, max_matches=min(count, MAX_ARCHIVE_MATCHES) or MAX_ARCHIVE_MATCHES)
+            except re.error, excp:
+                self.screen_callback(self.term_name, response_id, "alert", ["Invalid search pattern %s: %s" % (pattern, excp)])
+                return
+            self.screen_callback(self.term_name, response_id, "archive_matches", [pattern, archive.count, matches])
+        else:
+            self.screen_callback(self.term_name, response_id, "archive_lines", [start, archive.count, archive.get_lines(start, count)])
+
+    def close_archive(self):
+        if self.screen_buf.archive:
+            self.screen_buf.archive.close()
+            self.screen_buf.archive = None
+
+    def get_scroll_page(self, cursor, count=SCROLL_PAGE_LINES, response_id=""):
+        """Send page of scroll lines preceding scroll count cursor (from row_update scroll_cursor or previous scroll_page).
+        After the first buffered line, the archive line count is also sent (older lines may be fetched using get_archive).
+        """
+        next_cursor, lines = self.screen_buf.get_scroll_page(cursor, count)
+        archive_count = self.screen_buf.archive.count if (self.screen_buf.archive and not next_cursor) else 0
+        self.screen_callback(self.term_name, response_id, "scroll_page", [cursor, next_cursor, lines, archive_count])
+
+    def get_elided(self, first_count, count, response_id=""):
+        """Send scroll lines elided while flooding (if still buffered)"""
+        self.screen_callback(self.term_name, response_id, "elided_lines",
+                             [first_count, self.screen_buf.get_scroll_lines(first_count, count)])
+
     def scroll_screen(self, scroll_rows=None):
         pdelim = [] if self.note_cells else self.pdelim
         if scroll_rows == None:
             scroll_rows = 0
             for j in range(self.active_rows-1,-1,-1):
-                line = dump(self.main_screen.data[self.width*j:self.width*(j+1)])
-                if prompt_offset(line, pdelim, self.main_screen.meta[j]):
+                meta = self.main_screen.meta[j]
+                if not (meta and not meta[JCONTINUATION]) and not (pdelim and pdelim[0]):
+                    # Not a prompt line (no need to decode row)
+                    continue
+                if prompt_offset(self.main_screen.dump_row(j), pdelim, meta):
                     # Move rows before last prompt to buffer
                     scroll_rows = j
                     break
@@ -2474,18 +3005,22 @@ class Terminal(object):
         # Move scrolled active rows to buffer
         cursor_y = 0
         while cursor_y < scroll_rows:
-            row = self.main_screen.data[self.width*cursor_y:self.width*cursor_y+self.width]
+            row = self.main_screen.rows[cursor_y][:]
+            ustr = self.main_screen.decode_row(cursor_y)
             meta = self.main_screen.meta[cursor_y]
-            offset = prompt_offset(dump(row), pdelim, meta)
+            offset = prompt_offset(uclean(ustr), pdelim, meta)
             if meta:
                 # Concatenate rows for multiline command
                 while cursor_y < scroll_rows-1 and self.main_screen.meta[cursor_y+1] and self.main_screen.meta[cursor_y+1][JCONTINUATION]:
                     cursor_y += 1
-                    row += self.main_screen.data[self.width*cursor_y:self.width*cursor_y+self.width]
+                    row += self.main_screen.rows[cursor_y]
+                    ustr += self.main_screen.decode_row(cursor_y)
             if self.note_cells:
-                self.note_screen_buf.scroll_buf_up(dump(row, trim=True, encoded=True), meta, offset=offset)
+                self.note_screen_buf.scroll_buf_up(uclean(ustr, trim=True, encoded=True), meta, offset=offset)
             else:
-                self.screen_buf.scroll_buf_up(dump(row, trim=True, encoded=True), meta, offset=offset, markup=self.screen_buf.dumpmarkup(row, trim=True))
+                # Skip markup when flooding (most lines will be elided)
+                markup = None if self.flooding else self.screen_buf.dumpmarkup(row, trim=True, ustr=ustr)
+                self.screen_buf.scroll_buf_up(uclean(ustr, trim=True, encoded=True), meta, offset=offset, markup=markup)
             cursor_y += 1
 
         # Scroll and zero rest of screen
@@ -2500,9 +3035,27 @@ class Terminal(object):
             self.cursor_x = 0
             self.cursor_eol = 0
 
+    def meter_output(self, nbytes):
+        """Track output rate over UPDATE_INTERVAL windows, setting self.flooding if it exceeds flood_rate"""
+        cur_time = time.time()
+        self.flood_bytes += nbytes
+        elapsed = cur_time - self.flood_time
+        if elapsed >= UPDATE_INTERVAL:
+            self.flooding = bool(self.flood_rate) and self.flood_bytes > self.flood_rate*elapsed
+            self.flood_time = cur_time
+            self.flood_bytes = 0
+
+    def request_update(self):
+        self.needs_updating = True
+        if self.schedule_update:
+            self.schedule_update(self.term_name)
+
     def update(self):
         self.update_time = time.time()
         self.needs_updating = False
+        if self.flooding and self.update_time - self.output_time > 4*UPDATE_INTERVAL:
+            # Output has stopped
+            self.flooding = False
 
         if not self.alt_mode:
             self.scroll_screen()
@@ -2527,12 +3080,21 @@ class Terminal(object):
                                                                              self.main_screen,
                                                                              alt_screen=alt_screen,
                                                                              pdelim=self.pdelim,
-                                                                             reconnecting=reconnecting)
+                                                                             reconnecting=reconnecting,
+                                                                             dirty_rows=self.dirty_rows,
+                                                                             elide=self.flooding)
             pre_offset = len(self.pdelim[0]) if self.pdelim else 0
             command = os.path.basename(self.command_path) if self.command_path else ""
+            update_opts = dict(alt_mode=self.alt_mode, reset=full_update, command=command,
+                               active_rows=self.active_rows, pre_offset=pre_offset)
+            if reconnecting and len(self.screen_buf.scroll_lines) > len(update_scroll):
+                # Cursor for get_scroll_page (scroll count of first line sent)
+                update_opts["scroll_cursor"] = self.screen_buf.current_scroll_count - len(update_scroll) + 1
+            elif reconnecting and self.screen_buf.archive and self.screen_buf.archive.count:
+                # All buffered lines sent; older lines may be fetched using get_archive
+                update_opts["archive_count"] = self.screen_buf.archive.count
             self.screen_callback(self.term_name, response_id, "row_update",
-                                 [dict(alt_mode=self.alt_mode, reset=full_update, command=command,
-                                       active_rows=self.active_rows, pre_offset=pre_offset),
+                                 [update_opts,
                                   self.width, self.height,
                                   self.cursor_x, self.cursor_y,
                                   update_rows, update_scroll])
@@ -2544,9 +3106,10 @@ class Terminal(object):
                 self.screen_callback(self.term_name, response_id, "note_open", [self.note_params, "", self.note_share])
                 for cell_index in self.note_cells["cellIndices"]:
                     cell = self.note_cells["cells"][cell_index]
+                    # (Cell output is sent just once, via note_row_update)
                     self.screen_callback(self.term_name, response_id, "note_add_cell",
                                          [cell["cellIndex"], cell["cellType"], 0,
-                                         self.get_cell_input(cell_index), cell["cellOutput"]])
+                                         self.get_cell_input(cell_index)])
                     if cell["cellIndex"] != self.note_cells["curIndex"]:
                         # Current cell will be updated later
                         self.screen_callback(self.term_name, response_id, "note_row_update",
@@ -2565,7 +3128,9 @@ class Terminal(object):
                                                                              self.main_screen,
                                                                              alt_screen=False,
                                                                              pdelim=[],
-                                                                             reconnecting=reconnecting)
+                                                                             reconnecting=reconnecting,
+                                                                             dirty_rows=self.dirty_rows,
+                                                                             reconnect_lines=None)
 
             update_scroll = strip_prompt_lines(update_scroll, self.note_prompts)
 
@@ -2578,11 +3143,12 @@ class Terminal(object):
             if not reconnecting and (update_rows or update_scroll):
                 self.gterm_output_buf = []
 
+        if not reconnecting:
+            self.dirty_rows.clear()
+
     def zero(self, y1, x1, y2, x2, screen=None):
         if screen is None: screen = self.screen
-        w = self.width*(y2-y1) + x2 - x1 + 1
-        z = create_array(0, w)
-        screen.data[self.width*y1+x1:self.width*y2+x2+1] = z
+        self.dirty_rows.update(xrange(y1, screen.zero(y1, x1, y2, x2)+1))
 
     def zero_lines(self, y1, y2):
         self.zero(y1, 0, y2, self.width-1)
@@ -2592,26 +3158,25 @@ class Terminal(object):
         self.zero_lines(0, self.height-1)
 
     def peek(self, y1, x1, y2, x2):
-        return self.screen.data[self.width*y1+x1:self.width*y2+x2]
+        return self.screen.peek(y1, x1, y2, x2)
 
     def poke(self, y, x, s):
-        pos = self.width*y + x
-        self.screen.data[pos:pos+len(s)] = s
+        self.dirty_rows.update(xrange(y, self.screen.poke(y, x, s)+1))
         if not self.alt_mode:
             self.active_rows = max(y+1, self.active_rows)
 
     def scroll_up(self, y1, y2):
-        if y2 > y1:
-            self.poke(y1, 0, self.peek(y1+1, 0, y2, self.width))
-            self.screen.meta[y1:y2] = self.screen.meta[y1+1:y2+1]
-        self.zero_lines(y2, y2)
+        self.screen.scroll_up(y1, y2)
+        self.dirty_rows.update(xrange(y1, y2+1))
+        if y2 > y1 and not self.alt_mode:
+            self.active_rows = max(y1+1, self.active_rows)
         self.current_nul = self.screen_buf.default_nul
 
     def scroll_down(self, y1, y2):
-        if y2 > y1:
-            self.poke(y1+1, 0, self.peek(y1, 0, y2-1, self.width))
-            self.screen.meta[y1+1:y2+1] = self.screen.meta[y1:y2]
-        self.zero_lines(y1, y1)
+        self.screen.scroll_down(y1, y2)
+        self.dirty_rows.update(xrange(y1, y2+1))
+        if y2 > y1 and not self.alt_mode:
+            self.active_rows = max(y1+2, self.active_rows)
         self.current_nul = self.screen_buf.default_nul
 
     def scroll_right(self, y, x):
@@ -2623,7 +3188,7 @@ class Terminal(object):
         if not self.alt_mode and self.current_meta and not self.current_meta[1]:
             # Parse command line
             try:
-                line = dump(self.peek(self.cursor_y, 0, self.cursor_y, self.width), trim=True, encoded=True)
+                line = self.screen.dump_row(self.cursor_y, trim=True, encoded=True)
                 line += suffix
                 offset = prompt_offset(line, self.pdelim, self.current_meta)
                 args = shlex_split_str(line[offset:])
@@ -2643,13 +3208,13 @@ class Terminal(object):
                         # Do not buffer prompt continuation line
                         pass
                     else:
-                        row = self.peek(self.scroll_top, 0, self.scroll_top, self.width)
-                        self.note_screen_buf.scroll_buf_up(dump(row, trim=True, encoded=True), meta,
-                                    offset=prompt_offset(dump(row), self.pdelim, self.screen.meta[self.scroll_top]))
+                        ustr = self.screen.decode_row(self.scroll_top)
+                        self.note_screen_buf.scroll_buf_up(uclean(ustr, trim=True, encoded=True), meta,
+                                    offset=prompt_offset(uclean(ustr), self.pdelim, self.screen.meta[self.scroll_top]))
                 elif not self.alt_mode:
-                    row = self.peek(self.scroll_top, 0, self.scroll_top, self.width)
-                    self.screen_buf.scroll_buf_up(dump(row, trim=True, encoded=True), meta,
-                                    offset=prompt_offset(dump(row), self.pdelim, self.screen.meta[self.scroll_top]))
+                    ustr = self.screen.decode_row(self.scroll_top)
+                    self.screen_buf.scroll_buf_up(uclean(ustr, trim=True, encoded=True), meta,
+                                    offset=prompt_offset(uclean(ustr), self.pdelim, self.screen.meta[self.scroll_top]))
                 self.scroll_up(self.scroll_top, self.scroll_bot)
                 self.cursor_y = self.scroll_bot
             else:
@@ -2663,6 +3228,7 @@ class Terminal(object):
                 if self.current_meta and not self.screen.meta[self.active_rows-1]:
                     self.current_meta = (self.current_meta[JCURDIR], self.current_meta[JCONTINUATION]+1)
                     self.screen.meta[self.active_rows-1] = self.current_meta
+                    self.dirty_rows.add(self.active_rows-1)
 
     def cursor_right(self):
         q, r = divmod(self.cursor_x+1, self.width)
@@ -2679,6 +3245,88 @@ class Terminal(object):
         if not self.active_rows or self.cursor_y+1 == self.active_rows:
             self.current_meta = (self.current_dir, 0)
             self.screen.meta[self.cursor_y] = self.current_meta
+            self.dirty_rows.add(self.cursor_y)
+
+    def echo_text(self, text):
+        """Echo run of printable characters, writing complete characters in bulk"""
+        if self.logfile and self.logchars < MAX_LOG_CHARS:
+            # Log characters individually
+            for char in text:
+                self.echo(char)
+            return
+
+        if ENCODING != "utf-8":
+            self.echo_codes(bytearray(text))
+            return
+
+        for mo in ECHO_SEGMENT_RE.finditer(text):
+            segment = mo.group()
+            if segment[0] < "\x80":
+                # ASCII (does not affect any incomplete UTF-8 sequence)
+                self.echo_codes(bytearray(segment))
+                continue
+            try:
+                if self.echobuf:
+                    raise UnicodeError("Incomplete UTF-8 sequence")
+                useg = segment.decode("utf-8")
+                if sys.maxunicode == 0xffff and SURROGATE_RE.search(useg):
+                    raise UnicodeError("Surrogate pair")
+            except UnicodeError:
+                # Incomplete/invalid UTF-8 sequence; echo byte by byte
+                for char in segment:
+                    self.echo(char)
+                continue
+            self.echo_codes([ord(uchar) for uchar in useg])
+
+    def echo_codes(self, ucodes):
+        """Write sequence of unicode code points at cursor, wrapping lines as needed"""
+        count = len(ucodes)
+        offset = 0
+        # Row slices must stay within the row (else assignment would resize it)
+        self.cursor_x = min(max(0, self.cursor_x), self.width-1)
+        while offset < count:
+            if self.cursor_eol:
+                self.wrap_line()
+            row = self.screen.rows[self.cursor_y]
+            if self.cursor_eol:
+                # Cursor outside scroll region; cannot wrap, so overwrite one character at a time
+                row[self.cursor_x] = self.current_nul | ucodes[offset]
+                self.screen.text[self.cursor_y] = None
+                self.dirty_rows.add(self.cursor_y)
+                offset += 1
+                self.cursor_right()
+                continue
+            n = max(1, min(count-offset, self.width-self.cursor_x))
+            nul = self.current_nul
+            row[self.cursor_x:self.cursor_x+n] = array.array('L', [nul | ucode for ucode in ucodes[offset:offset+n]])
+            self.screen.text[self.cursor_y] = None
+            self.dirty_rows.add(self.cursor_y)
+            offset += n
+            if self.cursor_x+n >= self.width:
+                self.cursor_eol = 1
+                self.cursor_x = max(self.cursor_x, self.width-1)
+            else:
+                self.cursor_x += n
+        if not self.alt_mode:
+            self.active_rows = max(self.cursor_y+1, self.active_rows)
+
+    def wrap_line(self):
+        """Move cursor to start of next line (after writing past end of line)"""
+        nb_prompt = False
+        if self.note_cells and self.note_input:
+            line = self.screen.dump_row(self.cursor_y, trim=True, encoded=True)
+            if self.note_params["shell"]:
+                nb_prompt = bool(prompt_offset(line, self.pdelim, self.main_screen.meta[0]))
+            else:
+                nb_prompt = any(line.startswith(prompt) for prompt in self.note_prompts)
+
+        self.cursor_down()
+        self.cursor_x = 0
+
+        if nb_prompt:
+            # Mark overflow lines following a notebook prompt
+            self.screen.meta[self.cursor_y] = ("", 1)
+            self.dirty_rows.add(self.cursor_y)
 
     def echo(self, char):
         char_code = ord(char)
@@ -2723,22 +3371,11 @@ class Terminal(object):
                 if self.logchars == MAX_LOG_CHARS:
                     logf.write("\n")
         if self.cursor_eol:
-            nb_prompt = False
-            if self.note_cells and self.note_input:
-                line = dump(self.peek(self.cursor_y, 0, self.cursor_y, self.width), trim=True, encoded=True)
-                if self.note_params["shell"]:
-                    nb_prompt = bool(prompt_offset(line, self.pdelim, self.main_screen.meta[0]))
-                else:
-                    nb_prompt = any(line.startswith(prompt) for prompt in self.note_prompts)
-
-            self.cursor_down()
-            self.cursor_x = 0
+            self.wrap_line()
 
-            if nb_prompt:
-                # Mark overflow lines following a notebook prompt
-                self.screen.meta[self.cursor_y] = ("", 1)
-
-        self.screen.data[(self.cursor_y*self.width)+self.cursor_x] = self.current_nul | ord(uchar)
+        self.screen.rows[self.cursor_y][self.cursor_x] = self.current_nul | ord(uchar)
+        self.screen.text[self.cursor_y] = None
+        self.dirty_rows.add(self.cursor_y)
         self.cursor_right()
         if not self.alt_mode:
             self.active_rows = max(self.cursor_y+1, self.active_rows)
@@ -2816,10 +3453,8 @@ class Terminal(object):
         if Log_ignored or self.logfile:
             print >> sys.stderr, "lineterm:ignore: %s"%repr(s)
 
-    def csi_dispatch(self,seq,mo):
-        # CSI sequences
-        s = mo.group(1)
-        c = mo.group(2)
+    def csi_dispatch(self,seq,s,c):
+        # CSI sequences (s: numeric parameters, c: final character)
         f = self.csi_seq.get(c, None)
         if f:
             try:
@@ -2870,13 +3505,13 @@ class Terminal(object):
 
     def csi_G(self, l):
         """Cursor Character Absolute [column]"""
-        self.cursor_x = min(self.width, l[0])-1
+        self.cursor_x = min(self.width, max(1, l[0]))-1
 
     def csi_H(self, l):
         """Cursor Position [row;column]"""
         if len(l) < 2: l=[1,1]
-        self.cursor_x = min(self.width, l[1])-1
-        self.cursor_y = min(self.height, l[0])-1
+        self.cursor_x = min(self.width, max(1, l[1]))-1
+        self.cursor_y = min(self.height, max(1, l[0]))-1
         self.cursor_eol = 0
         if not self.alt_mode:
             self.active_rows = max(self.cursor_y+1, self.active_rows)
@@ -2943,7 +3578,7 @@ class Terminal(object):
 
     def csi_d(self, l):
         """Vertical Position Absolute [row]"""
-        self.cursor_y = min(self.height, l[0])-1
+        self.cursor_y = min(self.height, max(1, l[0]))-1
         if not self.alt_mode:
             self.active_rows = max(self.cursor_y+1, self.active_rows)
 
@@ -2961,14 +3596,13 @@ class Terminal(object):
             if not self.alt_mode:
                 self.gterm_code = l[0]
                 self.gterm_validated = (len(l) >= 2 and str(l[1]) == self.cookie)
-                self.gterm_buf = []
-                self.gterm_buf_size = 0
+                self.gterm_buf = PageletReader(self.max_pagelet_bytes)
                 self.gterm_entry_index = self.screen_buf.entry_index+1
                 if self.gterm_code != GRAPHTERM_SCREEN_CODES[0]:
                     scroll_rows = self.active_rows
                     if scroll_rows == 1 and self.cursor_y == 0:
                         # Special handling to skip echoed ^C before writing blank pagelet
-                        line = dump(self.peek(self.cursor_y, 0, self.cursor_y, self.width), trim=True, encoded=True)
+                        line = self.screen.dump_row(self.cursor_y, trim=True, encoded=True)
                         if line.endswith("^C"):
                             scroll_rows = 0
                     if scroll_rows:
@@ -3046,48 +3680,90 @@ class Terminal(object):
     def csi_u(self, l):
         self.esc_restore(0)
 
-    def escape(self):
-        e = self.buf
-        if len(e)>ESCAPE_BUF_LEN:
-            if Log_ignored or self.logfile:
-                print >> sys.stderr, "lineterm: escape error %r"%e
-            self.buf = ""
-        elif e in self.esc_seq:
+    def esc_dispatch(self, e):
+        """Invoke handler for complete escape sequence (or control character) e"""
+        f = self.esc_seq.get(e)
+        if f:
             if self.logfile:
                 with open(self.logfile, "a") as logf:
                     logf.write("SQ%02x%s\n" % (ord(e[0]), e[1:]))
-            self.esc_seq[e](e)
-            self.buf = ""
+            f(e)
             self.logchars = 0
         else:
-            for r,f in self.esc_re:
-                mo = r.match(e)
-                if mo:
-                    if self.logfile:
-                        with open(self.logfile, "a") as logf:
-                            logf.write("RE%02x%s\n" % (ord(e[0]), e[1:]))
-                    f(e,mo)
-                    self.buf = ""
-                    self.logchars = 0
-                    break
-#               if self.buf=='': print >> sys.stderr, "lineterm: ESC %r\n"%e
+            self.esc_ignore(e)
+
+    def parse_esc(self, s, k):
+        """Parse escape sequence starting at s[k] (ESC). Return offset following it, or -1 if incomplete"""
+        if k+1 >= len(s):
+            return -1
+        parser = self.esc_parsers.get(s[k+1])
+        if parser:
+            return parser(s, k)
+        mo = VT_ESC_RE.match(s, k)
+        if not mo.group(2):
+            if mo.end() >= len(s):
+                return -1
+            # Interrupted by control character; abort sequence
+            self.esc_ignore(mo.group())
+        else:
+            self.esc_dispatch(mo.group())
+        return mo.end()
+
+    def parse_csi(self, s, k):
+        """Parse Control Sequence Introducer (ESC [) sequence"""
+        mo = VT_CSI_RE.match(s, k)
+        if not mo.group(3):
+            if mo.end() >= len(s):
+                return -1
+            self.esc_ignore(mo.group())
+            return mo.end()
+        e = mo.group()
+        if e in self.esc_seq:
+            self.esc_dispatch(e)
+            return mo.end()
+        pmo = None if mo.group(2) else VT_CSI_PARAMS_RE.match(mo.group(1))
+        if pmo:
+            if self.logfile:
+                with open(self.logfile, "a") as logf:
+                    logf.write("RE%02x%s\n" % (ord(e[0]), e[1:]))
+            self.csi_dispatch(e, pmo.group(1), mo.group(3))
+            self.logchars = 0
+        else:
+            self.esc_ignore(e)
+        return mo.end()
+
+    def parse_string(self, s, k):
+        """Parse control string (OSC, DCS, ...) terminated by BEL or ST; all strings are ignored"""
+        if k+2 >= len(s):
+            return -1
+        if s[k+1:k+3] == "]R":
+            # Linux console palette reset (no terminator)
+            self.esc_dispatch(s[k:k+3])
+            return k+3
+        mo = VT_STRING_RE.match(s, k)
+        if not mo.group(2):
+            if mo.end()+1 >= len(s):
+                return -1
+            # ESC not followed by ST; abort string
+            self.esc_ignore(mo.group())
+            return mo.end()
+        self.esc_ignore(mo.group())
+        self.logchars = 0
+        return mo.end()
 
     def gterm_append(self, s):
         if '\x1b' in s:
             prefix, sep, suffix = s.partition('\x1b')
         else:
             prefix, sep, suffix = s, "", ""
-        self.gterm_buf_size += len(prefix)
-        if self.gterm_buf_size <= MAX_PAGELET_BYTES:
-            # Only append data if within buffer size limit
-            self.gterm_buf.append(prefix)
+        self.gterm_buf.feed(prefix)   # (Data is discarded if buffer size limit is exceeded)
         if not sep:
             return ""
         retval = sep + suffix
         # ESCAPE sequence encountered; terminate
-        if self.gterm_buf_size > MAX_PAGELET_BYTES:
+        if self.gterm_buf.overflow:
             # Buffer overflow
-            content = "ERROR pagelet size (%d bytes) exceeds limit (%d bytes)" % (self.gterm_buf_size,  MAX_PAGELET_BYTES)
+            content = "ERROR pagelet size (%d bytes) exceeds limit (%d bytes)" % (self.gterm_buf.size,  self.gterm_buf.max_bytes)
             headers = {}
             headers["x_gterm_response"] = "error_message"
             headers["x_gterm_parameters"] = {}
@@ -3098,7 +3774,7 @@ class Terminal(object):
 
         elif self.gterm_code == GRAPHTERM_SCREEN_CODES[0]:
             # Handle prompt command output
-            current_dir = "".join(self.gterm_buf)
+            current_dir = self.gterm_buf.text()
             if current_dir:
                 if self.gterm_validated:
                     self.remote_dir = ""
@@ -3106,11 +3782,11 @@ class Terminal(object):
                 else:
                     self.remote_dir = current_dir
                     self.expect_prompt("")
-        elif self.gterm_buf:
+        elif self.gterm_buf.size:
             # graphterm output ("pagelet")
             self.update()
-            gterm_output = "".join(self.gterm_buf).lstrip()
-            headers, content = parse_headers(gterm_output)
+            pagelet = self.gterm_buf
+            headers, content = pagelet.finish()
             response_type = headers["x_gterm_response"]
             response_params = headers["x_gterm_parameters"]
             screen_buf = self.note_screen_buf if self.note_cells else self.screen_buf
@@ -3127,7 +3803,7 @@ class Terminal(object):
                         new_params[key] = response_params.get(key, False)
                     headers["x_gterm_parameters"] = new_params
                     response_params = new_params
-                    self.blob_data(headers, content)  # Trust unvalidated images only
+                    self.blob_data(headers, content, verified=pagelet.verified)  # Trust unvalidated images only
                 elif not response_type or response_type == "pagelet":
                     # Raw HTML displayed as untrusted blob (via untrusted iframe)
                     handled_untrusted_content = True
@@ -3171,16 +3847,17 @@ class Terminal(object):
                             # Remote content provided
                             if response_type != "create_blob":
                                 # Check it (except for create_blob, which checks itself)
-                                md5_digest = headers.get("x_gterm_digest", "")  # Hash of encoded data
-                                if md5_digest and md5_digest != hashlib.md5(content).hexdigest():
+                                # (Hash of encoded data is checked by PageletReader)
+                                if not pagelet.digest_ok:
                                     raise Exception("File digest mismatch for %s: %s" % (response_type, filepath))
 
-                                # Only create blob content needs to remain encoded as Base64
+                                # (Content is usually decoded by PageletReader)
                                 encoding = headers.get("x_gterm_encoding", "")
                                 if encoding == "base64":
                                     headers.pop("x_gterm_encoding", None)
                                     headers.pop("x_gterm_digest", None)
-                                    content = base64.b64decode(content)
+                                    if not pagelet.decoded:
+                                        content = base64.b64decode(content)
                                 if len(content) != headers["content_length"]:
                                     raise Exception("Content length mismatch (%d!=%d) for %s: %s" % (len(content), headers["content_length"], response_type, filepath))
 
@@ -3193,8 +3870,8 @@ class Terminal(object):
                                 if not os.path.exists(fpath) or not os.path.isfile(fpath):
                                     raise Exception("File %s not found" % fpath)
                                 filestats = os.stat(fpath)
-                                if filestats.st_size > MAX_PAGELET_BYTES:
-                                    raise Exception("File size (%d bytes) exceeds pagelet limit (%d bytes) for %s" % (filestats.st_size,  MAX_PAGELET_BYTES, fpath))
+                                if filestats.st_size > self.max_pagelet_bytes:
+                                    raise Exception("File size (%d bytes) exceeds pagelet limit (%d bytes) for %s" % (filestats.st_size,  self.max_pagelet_bytes, fpath))
                                 with open(fpath) as f:
                                     content = f.read()
                             else:
@@ -3225,14 +3902,15 @@ class Terminal(object):
                     screen_buf.scroll_buf_up("", None, markup=content, row_params=row_params)
                     ##offset, directive, opt_dict = gterm.parse_gterm_directive(content) # Does nothing?
                 elif response_type == "display_data":
-                    self.blob_data(headers, content, untrusted=not self.gterm_validated)
+                    self.blob_data(headers, content, untrusted=not self.gterm_validated, verified=pagelet.verified)
                 elif response_type == "display_blob":
                     # Display blob as pagelet image
                     self.blob_data(headers, untrusted=not self.gterm_validated)
                 elif response_type == "create_blob":
                     blob_id = response_params.get("blob")
                     if blob_id:
-                        self.create_blob(content, blob_id, headers=headers, untrusted=not self.gterm_validated)
+                        self.create_blob(content, blob_id, headers=headers, untrusted=not self.gterm_validated,
+                                         verified=pagelet.verified)
                     else:
                         logging.error("No blob_id for create blob")
                 elif response_type == "frame_msg":
@@ -3267,14 +3945,13 @@ class Terminal(object):
                     self.graphterm_output(params, content)
         self.gterm_code = None
         self.gterm_buf = None
-        self.gterm_buf_size = 0
         self.gterm_validated = False
         self.gterm_entry_index = None
         return retval
 
-    def blob_data(self, headers, content=None, untrusted=False):
+    def blob_data(self, headers, content=None, untrusted=False, verified=False):
         """ Display image blobs and untrusted HTML blobs in fullwindow iframes
-            If blob_id is not provided, it will be generated.
+            If blob_id is not provided, it will be generated (verified is passed to create_blob).
             Blob_id is returned on successful return, or ""
             Create blob as needed and display in scroll buffer as needed.
         """
@@ -3284,7 +3961,7 @@ class Terminal(object):
         blob_id = response_params.get("blob", "")
         if not blob_id:
             assert content is not None, "No blob content for "+response_type
-            blob_id = self.create_blob(content, blob_id, headers=headers, untrusted=untrusted)
+            blob_id = self.create_blob(content, blob_id, headers=headers, untrusted=untrusted, verified=verified)
 
         if blob_id and response_type in ("display_data", "display_blob"):
             screen_buf = self.note_screen_buf if self.note_cells else self.screen_buf
@@ -3311,9 +3988,11 @@ class Terminal(object):
         return blob_id
 
 
-    def create_blob(self, content, blob_id="", headers=None, untrusted=False):
+    def create_blob(self, content, blob_id="", headers=None, untrusted=False, verified=False):
         """ If headers, content should be provided and maybe base64 encoded.
+            If verified, content digest and length have already been checked against headers (by PageletReader).
             Else, content should be of the data URI form: "image/png;base64,<base64>"
+            Blob content is decoded, and stored/transmitted as raw bytes (along with its SHA-256 digest).
             Return blob_id, creating one if need be. Null string on error.
             Within notebook, image blobs are appended to special buffer.
         """
@@ -3323,10 +4002,11 @@ class Terminal(object):
             response_params = headers.get("x_gterm_parameters", {})
             filepath = response_params.get("filepath", "")
             md5_digest = headers.get("x_gterm_digest", "")  # Hash of encoded data
-            if md5_digest and md5_digest != hashlib.md5(content).hexdigest():
+            if md5_digest and not verified and md5_digest != hashlib.md5(content).hexdigest():
                 logging.error("File digest mismatch for %s: %s", content_type, filepath)
                 return ""
         else:
+            verified = False
             filepath = ""
             content_type, sep, tail = content.partition(";")
             encoding, sep2, content = tail.partition(",")
@@ -3341,9 +4021,19 @@ class Terminal(object):
             logging.error("Invalid content type '%s", content_type)
             return ""
 
-        len_content = len(base64.b64decode(content)) if encoding else len(content)
+        if encoding:
+            try:
+                content = base64.b64decode(content)
+            except Exception:
+                logging.error("Invalid base64 encoding for blob: %s", filepath)
+                return ""
+            headers = dict(headers)
+            headers.pop("x_gterm_encoding", None)
+            headers.pop("x_gterm_digest", None)
+
+        len_content = len(content)
         if "content_length" in headers:
-            if len_content  != headers["content_length"]:
+            if not verified and len_content != headers["content_length"]:
                 logging.error("Content length mismatch (%d!=%d) for %s: %s" % (len_content, headers["content_length"], content_type, filepath))
                 return ""
         else:
@@ -3355,12 +4045,13 @@ class Terminal(object):
             logging.error("Not allowed to create trusted blob")
             return ""
 
-        blob_content = content if encoding else base64encode(content)
         if self.note_cells and content_type.startswith("image/"):
-            self.note_screen_buf.add_blob(blob_id, content_type, blob_content)
+            self.note_screen_buf.add_blob(blob_id, content_type, content)
 
+        # Content digest (blobs with identical content share a single copy in blob caches)
+        digest = hashlib.sha256(content).hexdigest()
         self.screen_callback(self.term_name, "", "create_blob",
-                             [blob_id, headers, blob_content])
+                             [blob_id, headers, content, digest])
         return blob_id
 
     def graphterm_output(self, params={}, content="", response_id="", from_buffer=False):
@@ -3470,7 +4161,7 @@ class Terminal(object):
         normalize = options.get("normalize", None)
         enter = options.get("enter", False)
 
-        line = dump(self.peek(self.active_rows-1, 0, self.active_rows-1, self.width), trim=True)
+        line = self.screen.dump_row(self.active_rows-1, trim=True)
         meta = self.screen.meta[self.active_rows-1]
         cwd = meta[JCURDIR] if meta else getcwd(self.pid)
         offset = prompt_offset(line, self.pdelim, (cwd, 0))
@@ -3605,19 +4296,40 @@ class Terminal(object):
         if not s:
             return
         assert self.gterm_buf is None
-        self.needs_updating = True
+        self.request_update()
 
-        for k, i in enumerate(s):
-            if self.gterm_buf is not None:
-                self.write(s[k:])
-                return
-            if len(self.buf) or (i in self.esc_seq):
-                self.buf += i
-                self.escape()
-            elif i == '\x1b':
-                self.buf += i
+        if self.buf:
+            # Prepend incomplete escape sequence from previous write
+            s = self.buf + s
+            self.buf = ""
+
+        k = 0
+        slen = len(s)
+        while k < slen:
+            mo = VT_TEXT_RE.match(s, k)
+            if mo:
+                # Run of printable characters
+                self.echo_text(mo.group())
+                k = mo.end()
+            elif s[k] != "\x1b":
+                # Control character
+                self.esc_dispatch(s[k])
+                k += 1
             else:
-                self.echo(i)
+                end = self.parse_esc(s, k)
+                if end < 0:
+                    # Incomplete escape sequence; save for next write
+                    if slen-k > ESCAPE_BUF_LEN:
+                        if Log_ignored or self.logfile:
+                            print >> sys.stderr, "lineterm: escape error %r" % s[k:]
+                    else:
+                        self.buf = s[k:]
+                    return
+                k = end
+                if self.gterm_buf is not None:
+                    # Graphterm escape sequence; switch to pagelet mode
+                    self.write(s[k:])
+                    return
 
     def read(self):
         b = self.outbuf
@@ -3675,7 +4387,7 @@ class Terminal(object):
             # Send terminal response
             os.write(self.fd, reply)
         if self.note_input or self.note_expect_prompt or self.note_start:
-            line = dump(self.peek(self.cursor_y, 0, self.cursor_y, self.width), trim=True, encoded=True)
+            line = self.screen.dump_row(self.cursor_y, trim=True, encoded=True)
             if self.note_input or self.note_expect_prompt:
                 if self.note_params["shell"]:
                     prompt_found = bool(prompt_offset(line, self.pdelim, self.main_screen.meta[0]))
@@ -3696,8 +4408,12 @@ class Terminal(object):
 class Multiplex(object):
     def __init__(self, screen_callback, command=None, shared_secret="",
                  host="", server_url="", term_type="linux", api_version="",
-                 widget_port=0, prompt_list=[], blob_server="", term_params={}, logfile="", app_name="graphterm"):
+                 widget_port=0, prompt_list=[], blob_server="", term_params={}, logfile="", app_name="graphterm",
+                 writable=None, flood_rate=FLOOD_BYTES_PER_SEC):
         """ prompt_list = [prefix, suffix, format, remote_format]
+        writable(): optional callback (invoked from worker threads) returning False while downstream output is congested;
+                    reads from flooding terminals are paused until it returns True
+        flood_rate: output rate (bytes/sec) above which a terminal is flooding (0 to disable)
         """
         ##signal.signal(signal.SIGCHLD, signal.SIG_IGN)
         self.screen_callback = screen_callback
@@ -3714,12 +4430,35 @@ class Multiplex(object):
         self.blob_server = blob_server
         self.logfile = logfile
         self.app_name = app_name
+        self.writable = writable
+        self.flood_rate = flood_rate
         self.proc = {}
         self.lock = threading.RLock()
         self.thread = threading.Thread(target=self.loop)
         self.alive = 1
         self.check_kill_idle = False
         self.name_count = 0
+
+        # Pty fds are registered once with the poller; updates are scheduled in a heap of (update_time, term_name)
+        self.poller = Poller()
+        self.fd_names = {}
+        self.update_lock = threading.Lock()
+        self.update_heap = []
+        self.update_pending = set()
+        self.paused_names = set()    # Flooding terminals whose reads are paused until output is writable
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+        self.poller.register(self.wakeup_fds[0])
+
+        # Terminal reads and updates are carried out by worker threads, holding the terminal lock.
+        # A pty fd is re-armed only after its read completes, so that each terminal has at most one read in progress.
+        self.work_queue = Queue.Queue()
+        self.rearm_fds = []
+        self.workers = [threading.Thread(target=self.work) for j in range(WORKER_THREADS)]
+        for worker in self.workers:
+            worker.start()
+
         self.thread.start()
 
     def terminal(self, term_name=None, height=25, width=80, winheight=0, winwidth=0, parent="", command=""):
@@ -3810,7 +4549,11 @@ class Multiplex(object):
                                                 server_url=self.server_url,
                                                 shared_secret=self.shared_secret,
                                                 pdelim=self.pdelim, term_params=self.term_params,
-                                                logfile=self.logfile)
+                                                logfile=self.logfile, schedule_update=self.schedule_update,
+                                                flood_rate=self.flood_rate)
+                self.fd_names[fd] = term_name
+                self.poller.register(fd, oneshot=True)
+                self.wakeup()
                 self.set_size(term_name, height, width, winheight, winwidth)
                 alert_msg = ""
                 if not is_executable(Gls_path) and not Exec_errmsg:
@@ -3880,8 +4623,10 @@ class Multiplex(object):
         return env
 
     def export_environment(self, term_name, profile=False):
-        term = self.proc.get(term_name)
-        if term:
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             if profile:
                 try:
                     with open(Exec_path+"/gprofile") as f:
@@ -3906,15 +4651,18 @@ class Multiplex(object):
 
     def set_size(self, term_name, height, width, winheight=0, winwidth=0):
         # python bug http://python.org/sf/1112949 on amd64
-        term = self.proc.get(term_name)
-        if term:
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.resize(height, width, winheight=winheight, winwidth=winwidth)
             # Hack for buggy TIOCSWINSZ handling: treat large unsigned positive int32 values as negative (same bits)
             winsz = termios.TIOCSWINSZ if termios.TIOCSWINSZ < 0 else struct.unpack('i',struct.pack('I',termios.TIOCSWINSZ))[0]
             fcntl.ioctl(term.fd, winsz, struct.pack("HHHH",height,width,0,0))
 
     def get_terminal(self, term_name):
-        return self.proc.get(term_name)
+        with self.lock:
+            return self.proc.get(term_name)
 
     def term_names(self):
         with self.lock:
@@ -3931,6 +4679,28 @@ class Multiplex(object):
             self.alive = 0
             self.kill_all()
 
+    def wakeup(self):
+        """Interrupt poll in loop thread (if called from another thread)"""
+        if threading.current_thread() is not self.thread:
+            with self.update_lock:
+                if not self.wakeup_fds:
+                    return
+                try:
+                    os.write(self.wakeup_fds[1], "x")
+                except OSError:
+                    pass   # Pipe full; loop will wake up anyway
+
+    def schedule_update(self, term_name):
+        """Schedule terminal update, no sooner than UPDATE_INTERVAL after the previous update"""
+        term = self.proc.get(term_name)
+        update_time = term.update_time + UPDATE_INTERVAL if term else 0
+        with self.update_lock:
+            if term_name in self.update_pending:
+                return
+            self.update_pending.add(term_name)
+            heapq.heappush(self.update_heap, (update_time, term_name))
+        self.wakeup()
+
     def kill_term(self, term_name):
         with self.lock:
             term = self.proc.get(term_name)
@@ -3938,6 +4708,7 @@ class Multiplex(object):
                 # "Idle" terminal
                 term.output_time = 0
             self.check_kill_idle = True
+        self.wakeup()
 
     def kill_all(self):
         with self.lock:
@@ -3945,31 +4716,44 @@ class Multiplex(object):
                 # "Idle" terminal
                 term.output_time = 0
             self.check_kill_idle = True
+        self.wakeup()
 
     def kill_idle(self):
         # Kill all "idle" terminals
+        idle_terms = []
         with self.lock:
             cur_time = time.time()
             for term_name in self.term_names():
                 term = self.proc.get(term_name)
                 if term:
                     if (cur_time-term.output_time) > IDLE_TIMEOUT:
-                        try:
-                            os.close(term.fd)
-                            os.kill(term.pid, signal.SIGTERM)
-                        except (IOError, OSError):
-                            pass
+                        idle_terms.append((term_name, term))
                         try:
                             del self.proc[term_name]
                         except Exception:
                             pass
-                        logging.warning("kill_idle: %s", term_name)
+
+        # (Terminal lock is acquired after releasing multiplex lock, to preserve lock ordering)
+        for term_name, term in idle_terms:
+            with term.lock:
+                try:
+                    self.poller.unregister(term.fd)
+                except (KeyError, IOError, OSError, ValueError):
+                    pass
+                self.fd_names.pop(term.fd, None)
+                try:
+                    os.close(term.fd)
+                    os.kill(term.pid, signal.SIGTERM)
+                except (IOError, OSError):
+                    pass
+                term.close_archive()
+            logging.warning("kill_idle: %s", term_name)
 
     def term_read(self, term_name):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             try:
                 data = os.read(term.fd, 65536)
                 if not data:
@@ -3977,16 +4761,20 @@ class Multiplex(object):
                     self.term_update(term_name)
                     self.kill_term(term_name)
                     return
+                term.meter_output(len(data))
                 term.pty_read(data)
             except (KeyError, IOError, OSError):
                 print >> sys.stderr, "lineterm: Error in reading from %s; closing it" % term_name
+                if term.needs_updating:
+                    # Display output received before error (scheduled update will not occur)
+                    self.term_update(term_name)
                 self.kill_term(term_name)
 
     def term_write(self, term_name, data):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             try:
                 term.pty_write(data)
             except (IOError, OSError), excp:
@@ -3994,199 +4782,325 @@ class Multiplex(object):
                 self.kill_term(term_name)
 
     def term_update(self, term_name):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if term:
+        term = self.get_terminal(term_name)
+        if term:
+            with term.lock:
                 term.update()
 
     def dump(self, term_name, data, trim=False, color=1):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             try:
                 return dump(data, trim=trim, encoded=True)
             except KeyError:
                 return "ERROR in dump"
 
     def save_data(self, term_name, save_params, filedata):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.save_data(save_params, filedata)
 
     def get_finder(self, term_name, kind, directory=""):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.get_finder(kind, directory=directory)
 
     def click_paste(self, term_name, text, file_url="", options={}):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.click_paste(text, file_url=file_url, options=options)
 
     def open_notebook(self, term_name, filepath, prompts, params, content):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.open_notebook(filepath, prompts, params, content)
 
     def close_notebook(self, term_name, discard):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.close_notebook(discard)
 
     def save_notebook(self, term_name, filepath, input_data, params):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.save_notebook(filepath, input_data, params)
 
     def note_lock(self, term_name, offset):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.note_lock(offset)
 
     def add_cell(self, term_name, new_cell_type, init_text, before_cell_number):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.add_cell(new_cell_type, init_text, before_cell_number)
 
     def select_cell(self, term_name, cell_index, move_up, next_code):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.select_cell(cell_index, move_up, next_code)
 
     def select_page(self, term_name, move_up, endpoint, slide):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.select_page(move_up, endpoint, slide)
 
     def move_cell(self, term_name, move_up):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.move_cell(move_up)
 
     def update_type(self, term_name, cell_type):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.update_type(cell_type)
 
     def delete_cell(self, term_name, move_up):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.delete_cell(move_up)
 
     def merge_above(self, term_name):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.merge_above()
 
     def complete_cell(self, term_name, incomplete):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.complete_cell(incomplete)
 
     def update_cell(self, term_name, cur_index, execute, save, input_data):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.update_cell(cur_index, execute, save, input_data)
 
     def erase_output(self, term_name, all_cells):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return ""
+        term = self.get_terminal(term_name)
+        if not term:
+            return ""
+        with term.lock:
             return term.erase_output(all_cells)
 
     def reconnect(self, term_name, response_id=""):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.reconnect(response_id=response_id)
 
     def clear(self, term_name):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.clear()
 
     def clear_last_entry(self, term_name, last_entry_index=None):
-        with self.lock:
-            term = self.proc.get(term_name)
-            if not term:
-                return
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
             term.clear_last_entry(last_entry_index=last_entry_index)
 
+    def get_archive(self, term_name, start, count, pattern="", response_id=""):
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
+            term.get_archive(start, count, pattern=pattern, response_id=response_id)
+
+    def get_scroll_page(self, term_name, cursor, count=SCROLL_PAGE_LINES, response_id=""):
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
+            term.get_scroll_page(cursor, count, response_id=response_id)
+
+    def get_elided(self, term_name, first_count, count, response_id=""):
+        term = self.get_terminal(term_name)
+        if not term:
+            return
+        with term.lock:
+            term.get_elided(first_count, count, response_id=response_id)
+
+    def work(self):
+        """Worker thread: read from or update terminals"""
+        while True:
+            job = self.work_queue.get()
+            if job is None:
+                break
+            action, term_name = job
+            try:
+                if action == "read":
+                    try:
+                        self.term_read(term_name)
+                    finally:
+                        self.rearm(term_name)
+                else:
+                    term = self.get_terminal(term_name)
+                    if term and (term.needs_updating or term.output_time > term.update_time):
+                        self.term_update(term_name)
+            except Exception, excp:
+                traceback.print_exc()
+                logging.warning("Multiplex.work: INTERNAL %s ERROR (%s) %s", action.upper(), term_name, excp)
+                self.kill_term(term_name)
+
+    def rearm(self, term_name):
+        """Re-enable polling for terminal fd (after read), unless terminal is flooding and output is not writable"""
+        term = self.get_terminal(term_name)
+        if term:
+            with self.update_lock:
+                if term.flooding and self.writable and not self.writable():
+                    # Backpressure: pause reading (loop re-checks writability every FLOOD_RECHECK sec)
+                    self.paused_names.add(term_name)
+                else:
+                    self.rearm_fds.append(term.fd)
+            self.wakeup()
+
+    def resume_paused(self):
+        """Re-arm paused terminals, if output is writable (invoked from loop)"""
+        if not self.writable():
+            return
+        with self.update_lock:
+            paused_names, self.paused_names = self.paused_names, set()
+        for term_name in paused_names:
+            term = self.get_terminal(term_name)
+            if term:
+                with self.update_lock:
+                    self.rearm_fds.append(term.fd)
+
     def loop(self):
         while self.running():
             try:
-                fd_dict = dict((term.fd, name) for name, term in self.proc.items())
-                if not fd_dict:
-                    time.sleep(0.02)
-                    continue
-                inputs, outputs, errors = select.select(fd_dict.keys(), [], [], 0.02)
-                for fd in inputs:
-                    try:
-                        self.term_read(fd_dict[fd])
-                    except Exception, excp:
-                        traceback.print_exc()
-                        term_name = fd_dict[fd]
-                        logging.warning("Multiplex.loop: INTERNAL READ ERROR (%s) %s", term_name, excp)
-                        self.kill_term(term_name)
+                if self.paused_names:
+                    self.resume_paused()
+                with self.update_lock:
+                    rearm_fds, self.rearm_fds = self.rearm_fds, []
+                    timeout = max(0, self.update_heap[0][0] - time.time()) if self.update_heap else None
+                    if self.paused_names:
+                        timeout = FLOOD_RECHECK if timeout is None else min(timeout, FLOOD_RECHECK)
+                for fd in rearm_fds:
+                    if fd in self.fd_names:
+                        self.poller.rearm(fd)
+                events = self.poller.poll(timeout)
+                for fd, event in events:
+                    if fd == self.wakeup_fds[0]:
+                        try:
+                            os.read(fd, 4096)
+                        except OSError:
+                            pass
+                        continue
+                    term_name = self.fd_names.get(fd)
+                    if term_name:
+                        # (fd is disarmed until read completes)
+                        self.work_queue.put(("read", term_name))
+
+                # Update terminals whose scheduled update time has arrived
                 cur_time = time.time()
-                for term_name in fd_dict.values():
-                    term = self.proc.get(term_name)
-                    if term:
-                        if (term.needs_updating or term.output_time > term.update_time) and cur_time-term.update_time > UPDATE_INTERVAL:
-                            try:
-                                self.term_update(term_name)
-                            except Exception, excp:
-                                traceback.print_exc()
-                                logging.warning("Multiplex.loop: INTERNAL UPDATE ERROR (%s) %s", term_name, excp)
-                                self.kill_term(term_name)
+                with self.update_lock:
+                    while self.update_heap and self.update_heap[0][0] <= cur_time:
+                        update_time, term_name = heapq.heappop(self.update_heap)
+                        self.update_pending.discard(term_name)
+                        self.work_queue.put(("update", term_name))
                 if self.check_kill_idle:
                     self.check_kill_idle = False
                     self.kill_idle()
-
-                if len(inputs):
-                    time.sleep(0.002)
             except Exception, excp:
                 traceback.print_exc()
                 logging.warning("Multiplex.loop: ERROR %s", excp)
                 break
         self.kill_all()
+        for worker in self.workers:
+            self.work_queue.put(None)
+        self.poller.close()
+        with self.update_lock:
+            for fd in self.wakeup_fds:
+                os.close(fd)
+            self.wakeup_fds = None
+
+class Poller(object):
+    """Minimal epoll interface (using poll, where epoll is not available) for readable fds; timeout in seconds.
+    A oneshot fd is disarmed after it is returned by poll, until rearm is called (from the polling thread).
+    """
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, "epoll") else None
+        self.poll_obj = None if self.epoll else select.poll()
+        self.oneshot_fds = set()
+
+    def register(self, fd, oneshot=False):
+        if oneshot:
+            self.oneshot_fds.add(fd)
+        if self.epoll:
+            self.epoll.register(fd, select.EPOLLIN|(select.EPOLLONESHOT if oneshot else 0))
+        else:
+            self.poll_obj.register(fd, select.POLLIN)
+
+    def rearm(self, fd):
+        if self.epoll:
+            self.epoll.modify(fd, select.EPOLLIN|select.EPOLLONESHOT)
+        else:
+            self.poll_obj.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        self.oneshot_fds.discard(fd)
+        if self.epoll:
+            self.epoll.unregister(fd)
+        else:
+            self.poll_obj.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Returns list of (fd, event) tuples"""
+        try:
+            if self.epoll:
+                return self.epoll.poll(-1 if timeout is None else timeout)
+            events = self.poll_obj.poll(None if timeout is None else 1000*timeout)
+            for fd, event in events:
+                if fd in self.oneshot_fds:
+                    self.poll_obj.unregister(fd)
+            return events
+        except (IOError, select.error), excp:
+            if excp.args and excp.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if self.epoll:
+            self.epoll.close()
 
 if __name__ == "__main__":
     ## Code to test LineTerm on regular terminal
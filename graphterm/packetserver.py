@@ -8,6 +8,7 @@ Packet server: for flash etc.
 import hashlib
 import time
 
+import collections
 import errno
 import functools
 import hmac
@@ -17,8 +18,10 @@ import socket
 import ssl
 import struct
 import thread
+import threading
 import traceback
 import uuid
+import zlib
 
 try:
     import ujson as json
@@ -28,6 +31,11 @@ except ImportError:
     except ImportError:
         import simplejson as json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from tornado import escape
 from tornado import ioloop
 from tornado import iostream
@@ -40,9 +48,18 @@ SIGN_HASH = hashlib.sha256
 FLASH_POLICY_PORT = 843
 FLASH_SOCKET_PORT = 8843
 
-FRAMELEN_FORMAT = "!L"    # Format for frame length prefix
+FRAMELEN_FORMAT = "!LL"   # Format for frame header (frame length, length of binary content at end of frame)
+MAX_PACKET_ID = 0x40000000  # Packet IDs wrap around
 FLASH_DELIMITER = "\0"
 
+ACK_PACKETS = 8           # Acknowledge after this many inbound RPC packets
+ACK_DELAY = 0.02          # Max. delay (sec) before acknowledging inbound RPC packets
+RESEND_PACKETS = 4*ACK_PACKETS  # Unacknowledged RPC frames buffered for resending on reconnect (must exceed ACK_PACKETS)
+
+COMPRESS_ZLIB = "zlib"    # Compression mode (negotiated during RPC validation)
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_BYTES = 256  # Smaller frames are not compressed
+
 POLICY_FILE_REQUEST = "<policy-file-request/>"
 MASTER_POLICY_XML_FORMAT = """<cross-domain-policy>
   <site-control permitted-cross-domain-policies="master-only"/>
@@ -71,18 +88,69 @@ class SystemMessage(Exception):
     """
     pass
 
+class JSONSerializer(object):
+    """ Encodes messages as JSON text (using ujson, if available).
+    A single binary _content value may be appended to the text (with its length in the frame header).
+    """
+    name = "json"
+    binary = False
+
+    @staticmethod
+    def dumps(obj):
+        return escape.utf8(json.dumps(obj))
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+class MsgpackSerializer(object):
+    """ Encodes messages using msgpack, with strings decoded as unicode (as for JSON).
+    Binary _content values (bytes, or a list of bytes) are encoded natively, as extension types.
+    """
+    name = "msgpack"
+    binary = True
+    EXT_BINARY = 1
+
+    @classmethod
+    def attachment(cls, content):
+        if isinstance(content, (list, tuple)):
+            return [msgpack.ExtType(cls.EXT_BINARY, x) for x in content]
+        return msgpack.ExtType(cls.EXT_BINARY, content)
+
+    @staticmethod
+    def ext_hook(code, data):
+        return data
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    @classmethod
+    def loads(cls, data):
+        return msgpack.unpackb(data, raw=False, ext_hook=cls.ext_hook)
+
+# Available serializers, in order of preference
+SERIALIZERS = collections.OrderedDict()
+if msgpack:
+    SERIALIZERS[MsgpackSerializer.name] = MsgpackSerializer
+SERIALIZERS[JSONSerializer.name] = JSONSerializer
+
 class PacketConnector(object):
     """ Serves Flash policy and other requests, delimited by "\0" or framed
-    by a frame length prefix (typically using "!L" unsigned 32-bit format)
+    by a frame header (typically using "!LL" unsigned 32-bit format for frame length and content length)
     Override process request method.
+    Framed packets may have binary content appended, which is read separately and passed to
+    process_packet as _content, without scanning or copying the frame.
     If max_packet_buf > 0, derived class must explicitly call resend_buffered_packets
     and clear_sent_packets as needed. Can also use self.packet_id to identify packets.
     If max_packet_buf < 0, connection is shutdown if buffer is full.
+    If set_compression is called, framed packets are compressed using a streaming zlib context
+    (buffered packets are stored uncompressed, and compressed when actually written).
     To ensure unique connection for each connection_id, call new_connection as soon as
     a new connection is created. (Any previous connection with the same id is closed).
     """
     _all_connections = None   # Must be re-defined to {} in final derived class
-    CONTENT_DELIM = "\r\n\r\n"
+    COMPRESS_PREFIX = "z"     # Prefix for compressed frame text (JSON text never starts with it)
 
     def __init__(self, client=False, server_type="", delimiter=None,
                  framelen_format=None, single_request=False, ssl_options={}, max_packet_buf=0):
@@ -101,18 +169,60 @@ class PacketConnector(object):
         self.delimiter = delimiter
         self.framelen_format = framelen_format
         self.fmt_size = struct.calcsize(framelen_format) if framelen_format else 0
+        self.content_header = bool(framelen_format) and len(struct.unpack(framelen_format, "\0"*self.fmt_size)) > 1
         self.single_request = single_request
         self.ssl_options = ssl_options
 
         self.expect_len = 0
+        self.content_len = 0
         self.closed = False
         self.stream = None
 
         self.max_packet_buf = max_packet_buf
         self.packet_id = 1           # ID of next packet to be sent (wraps around)
-        self.packet_buf = []
+        self.packet_buf = collections.deque()
         self.connection_id = ""      # Usually set first on client and then sent to server
         self.last_active_time = 0    # Time when data was last received or sent
+        self.reset_compression()
+
+    def reset_compression(self):
+        """Disables compression for outbound frames, and resets context for inbound frames (on new connection)
+        """
+        self.compressor = None
+        self.decompressor = zlib.decompressobj()
+
+    def set_compression(self, mode):
+        """Enables compression of outbound frames, if mode is COMPRESS_ZLIB
+        """
+        if mode == COMPRESS_ZLIB and self.framelen_format:
+            self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+        else:
+            self.compressor = None
+
+    def compress_packet(self, packet):
+        """Returns framed packet with text compressed (flushed, but retaining compression context),
+        unless text is shorter than COMPRESS_MIN_BYTES. Binary content is not compressed.
+        """
+        frame_len, content_len = self.unpack_header(packet[:self.fmt_size])
+        text_end = self.fmt_size + frame_len - content_len
+        if text_end - self.fmt_size < COMPRESS_MIN_BYTES:
+            return packet
+        data = self.COMPRESS_PREFIX + self.compressor.compress(packet[self.fmt_size:text_end]) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if content_len:
+            return self.pack_header(len(data)+content_len, content_len) + data + packet[text_end:]
+        return self.pack_header(len(data)) + data
+
+    def pack_header(self, frame_len, content_len=0):
+        if self.content_header:
+            return struct.pack(self.framelen_format, frame_len, content_len)
+        assert not content_len, "Binary content not allowed without content length in frame header"
+        return struct.pack(self.framelen_format, frame_len)
+
+    def unpack_header(self, data):
+        """Returns (frame_len, content_len)
+        """
+        header = struct.unpack(self.framelen_format, data)
+        return header[0], (header[1] if self.content_header else 0)
 
     def new_connection(self, connection_id):
         if self._all_connections is None:
@@ -154,25 +264,39 @@ class PacketConnector(object):
     def get_connection_ids(cls):
         return cls._all_connections.keys()
 
-    def process_packet(self, message):
+    def process_packet(self, message, _content=None):
         """ Processes packet; raises exception on error, leading to connection being closed.
         If single_request, will be called with None value if server closes connection.
         Otherwise, message is always non-None.
+        _content is binary content appended to the frame (if any).
         OVERRIDE
         """
         raise SystemMessage("NOT IMPLEMENTED")
 
     def receive_header(self, data=None):
-        """ Receives frame length header
+        """ Receives frame header
         """
         if not self.stream or not data or len(data) != self.fmt_size:
             self.on_close()
             return
-        self.expect_len = struct.unpack(self.framelen_format, data)[0]
-        self.stream.read_bytes(self.expect_len, self.receive_packet)
+        self.expect_len, self.content_len = self.unpack_header(data)
+        if self.content_len > self.expect_len:
+            logging.warning("PacketConnector: Invalid frame header: content length %d > frame length %d", self.content_len, self.expect_len)
+            self.on_close()
+            return
+        self.stream.read_bytes(self.expect_len - self.content_len, self.receive_packet)
+
+    def receive_content(self, data, _content=None):
+        """ Receives binary content following text of frame
+        """
+        if _content is None or len(_content) != self.content_len:
+            # Incomplete frame; close
+            self.on_close()
+            return
+        self.receive_packet(data, _content=_content)
 
-    def receive_packet(self, data=None, start=False):
-        """ Receives stream request, processes it, and waits for next one
+    def receive_packet(self, data=None, start=False, _content=None):
+        """ Receives stream request (and any binary content), processes it, and waits for next one
         """
         if not data and not start:
             self.on_close()
@@ -183,13 +307,28 @@ class PacketConnector(object):
             if self.delimiter:
                 # Strip out delimiter
                 data = data[:-len(self.delimiter)]
-            elif len(data) != self.expect_len:
-                # Incomplete frame; close
-                self.on_close()
-                return
+            else:
+                if len(data) != self.expect_len - self.content_len:
+                    # Incomplete frame; close
+                    self.on_close()
+                    return
+                if self.content_len and _content is None:
+                    # Read binary content separately
+                    self.stream.read_bytes(self.content_len, functools.partial(self.receive_content, data))
+                    return
+                if data.startswith(self.COMPRESS_PREFIX):
+                    try:
+                        data = self.decompressor.decompress(data[len(self.COMPRESS_PREFIX):])
+                    except Exception, excp:
+                        logging.warning("PacketConnector: Error in decompressing packet: %s", excp)
+                        self.on_close()
+                        return
 
             try:
-                self.process_packet(data)
+                if _content is None:
+                    self.process_packet(data)
+                else:
+                    self.process_packet(data, _content=_content)
             except Exception, excp:
                 logging.warning("PacketConnector: Error in processing packet: %s", excp, exc_info=True)
                 self.on_close()
@@ -211,28 +350,32 @@ class PacketConnector(object):
             else:
                 self.stream.read_until(self.delimiter, self.receive_packet)
 
-    def send_json(self, obj, _content=None, finish=False, buffer=False, nobuffer=False):
+    def send_json(self, obj, _content=None, finish=False, buffer=False, nobuffer=False, packets=1):
         """Keyword argument named _content with bytes data is treated specially, and transmitted without JSON encoding
         """
+        self.send_message(obj, JSONSerializer, _content=_content, finish=finish, buffer=buffer, nobuffer=nobuffer, packets=packets)
+
+    def send_message(self, obj, serializer, _content=None, finish=False, buffer=False, nobuffer=False, packets=1):
+        """Sends obj encoded using serializer, with _content bytes data (if any) appended
+        """
         if not self.closed:
             try:
-                raw_data = self.make_packet(json.dumps(obj), _content=_content, utf8=True)
-                self.send_raw_packet(raw_data, finish=finish, buffer=buffer, nobuffer=nobuffer)
+                raw_data = self.make_packet(serializer.dumps(obj), _content=_content)
+                self.send_raw_packet(raw_data, finish=finish, buffer=buffer, nobuffer=nobuffer, packets=packets)
             except Exception, excp:
-                logging.warning("PacketConnector.send_json: ERROR: %s", excp)
+                logging.warning("PacketConnector.send_message: ERROR: %s", excp)
                 raise
 
     def make_packet(self, text, _content=None, utf8=False):
-        """ _content is binary data to be appended to text, separated by a delimiter
+        """ _content is binary data to be appended to text (with its length in the frame header)
         """
         data = escape.utf8(text) if utf8 else text
 
         if self.framelen_format:
-            if _content is not None:
-                assert self.CONTENT_DELIM not in data, "Content delimiter not allowed in text"
-                data += self.CONTENT_DELIM + _content
-
-            packet = struct.pack(self.framelen_format, len(data)) + data
+            if _content:
+                packet = self.pack_header(len(data)+len(_content), len(_content)) + data + _content
+            else:
+                packet = self.pack_header(len(data)) + data
         else:
             assert _content is None, "Binary content not allowed in delimited packets"
             if self.delimiter in data:
@@ -242,7 +385,7 @@ class PacketConnector(object):
 
     def clear_sent_packets(self, packet_id):
         while self.packet_buf and self.packet_buf[0][0] <= packet_id:
-            self.packet_buf.pop(0)
+            self.packet_buf.popleft()
 
     def resend_buffered_packets(self):
         for packet_id, data, finish in self.packet_buf:
@@ -254,6 +397,11 @@ class PacketConnector(object):
     def is_writable(self):
         return self.connected or len(self.packet_buf) < abs(self.max_packet_buf)
 
+    def write_pending(self):
+        """Returns True if data written to stream has not yet been flushed (may be checked from any thread)"""
+        stream = self.stream
+        return bool(stream and stream.writing())
+
     def send_packet(self, data, finish=False, utf8=False, buffer=False, nobuffer=False):
         """
         If buffer, packet is not actually sent, just buffered.
@@ -261,10 +409,12 @@ class PacketConnector(object):
         """
         return self.send_raw_packet(self.make_packet(data,utf8=utf8), finish=finish, buffer=buffer, nobuffer=nobuffer)
 
-    def send_raw_packet(self, data, finish=False, buffer=False, nobuffer=False):
+    def send_raw_packet(self, data, finish=False, buffer=False, nobuffer=False, packets=1):
         """
         If buffer, packet is not actually sent, just buffered.
         If nobuffer, self.packet_id is not incremented.
+        packets > 1 if data is a batch of packets, with consecutive IDs starting at self.packet_id
+        (buffered using the ID of the last packet in the batch).
         """
         if self.closed:
             return
@@ -280,9 +430,10 @@ class PacketConnector(object):
                         # Buffer overflow; close
                         self.on_close()
                         return
-                    self.packet_buf.pop(0)
-                self.packet_buf.append( (self.packet_id, data, finish) )
-            self.packet_id = (self.packet_id + 1) % 0x40000000
+                    logging.warning("PacketConnector.send_raw_packet: Packet buffer full; dropped unacknowledged packet %s", self.packet_buf[0][0])
+                    self.packet_buf.popleft()
+                self.packet_buf.append( ((self.packet_id + packets - 1) % MAX_PACKET_ID, data, finish) )
+            self.packet_id = (self.packet_id + packets) % MAX_PACKET_ID
 
         if finish or self.single_request:
             callback = self.shutdown
@@ -290,6 +441,8 @@ class PacketConnector(object):
             callback = None
 
         if self.stream and not buffer:
+            if self.compressor:
+                data = self.compress_packet(data)
             try:
                 self.stream.write(data, callback)
             except Exception, excp:
@@ -596,25 +749,39 @@ class PacketConnection(PacketConnector):
 class RPCLink(object):
     """ Implements Remote Procedure Calls, using messages of the form
         [0, ["setup",    ["connection_id", key_version, nonce, server_token or None] ] for setup
-        [0, ["validate", [server/client_rpc_token, last_received_id], {state}] ] for validation
+        [0, ["validate", [server/client_rpc_token, last_received_id], {state}, {params}] ] for validation
+        (where params may include "compress" mode, offered by client and accepted by server, and
+         "serializers" offered by client, of which the server chooses the "serializer")
         [0, ["shutdown", [err_message] ]
-        [n, ["method", [args], {kwargs}]
+        [n, ["method", [args], {kwargs}], m], where optional m acknowledges packet m (piggybacked)
         [-n, retval], where -n acknowledges packet n, and non-null retval implies error message.
+        [[n, ["method", ...], m], [n+1, ["method", ...]], ...] for a batch of requests sent as one frame.
+        Requests made using send_request_threadsafe are batched until the next IOLoop iteration.
+        Handshake messages and acks are always JSON. Requests use the negotiated serializer,
+        and inbound frames are decoded as JSON if they start with "[", and using msgpack otherwise.
+        Acknowledgements are cumulative, i.e., acknowledging packet n also acknowledges all older packets.
+        Inbound packets are acknowledged after ACK_PACKETS packets or ACK_DELAY seconds, unless
+        the acknowledgement can be piggybacked on an outbound request before then.
+        Use max_packet_buf of at least RESEND_PACKETS, so that unacknowledged packets are resent on reconnect.
         Mixin *before* PacketConnection/PacketClient, and implement derived methods of the form
         remote_<method>(self, args, kwargs)
     """
     rpc_key_secret = None         # Set for server/client
     rpc_key_version = None        # Set for server/client
     rpc_key_id = None             # Set for server/client
+    rpc_compress = False          # Set for server/client
     def __init__(self, *args, **kwargs):
         """ Arguments:
         connection_id (str) required for clients.
         key_secret (str) optional
         key_version (int) optional
         key_id (str) optional
+        compress (bool) optional (client requests compression; server allows it)
               
         """
         self.connection_id = kwargs.pop("connection_id", "")
+        if "compress" in kwargs:
+            self.rpc_compress = kwargs.pop("compress")
         if "key_secret" in kwargs:
             self.rpc_key_secret = kwargs.pop("key_secret") 
         if "key_version" in kwargs:
@@ -630,6 +797,12 @@ class RPCLink(object):
         self.rpc_state = {}   # (Optional) Initial state variable for connection
         self.rpc_peer_state = {}     # Initial state variable for peer
         self.received_id = 0         # Last received packet ID
+        self.ack_count = 0           # Number of received packets not yet acknowledged
+        self.ack_timeout = None
+        self.batch_lock = threading.Lock()
+        self.batch_requests = []     # Requests to be sent as a batch in the next IOLoop iteration
+        self.batch_scheduled = False
+        self.rpc_serializer = JSONSerializer
         super(RPCLink, self).__init__(*args, **kwargs)
 
     def set_rpc_state(self, value={}):
@@ -642,6 +815,8 @@ class RPCLink(object):
             raise Exception("Must specify connection_id for RPC connection setup")
         self.rpc_nonce = uuid.uuid4().hex
         self.rpc_expect = "connect"
+        self.reset_compression()
+        self.rpc_serializer = JSONSerializer
         self.send_json([0, ["connect", [self.connection_id, self.rpc_key_version, self.rpc_nonce, None]] ],
                            nobuffer=True)
 
@@ -655,7 +830,11 @@ class RPCLink(object):
                 logging.error("RPCLink.rpc_connect: Invalid server token: s=%s", connection_id)
                 return
             self.rpc_client_token = client_token
-            self.send_json([0, ["validate", [self.rpc_client_token, self.received_id], self.rpc_state]], nobuffer=True)
+            self.ack_count = 0
+            link_params = {"serializers": SERIALIZERS.keys()}
+            if self.rpc_compress:
+                link_params["compress"] = COMPRESS_ZLIB
+            self.send_json([0, ["validate", [self.rpc_client_token, self.received_id], self.rpc_state, link_params]], nobuffer=True)
         else:
             # Server
             self.rpc_nonce = uuid.uuid4().hex
@@ -672,14 +851,21 @@ class RPCLink(object):
             self.send_json([0, ["connect", [None, None, self.rpc_nonce, server_token]] ],
                            nobuffer=True)
         
-    def rpc_server_validate(self, token):
+    def rpc_server_validate(self, token, link_params={}):
         if token != self.rpc_client_token:
             self.send_json([0, ["shutdown", ["Invalid client token: s=%s" % self.connection_id]] ], nobuffer=True)
             self.shutdown()
             logging.error("RPCLink.rpc_server_validate: Invalid client token: s=%s", self.connection_id)
             return False
         self.new_connection(self.rpc_unvalidated_id)
-        self.send_json([0, ["validate", [None, self.received_id], self.rpc_state]], nobuffer=True)
+        self.ack_count = 0
+        compress = COMPRESS_ZLIB if self.rpc_compress and link_params.get("compress") == COMPRESS_ZLIB else None
+        offered = link_params.get("serializers", [])
+        serializer = ([SERIALIZERS[name] for name in offered if name in SERIALIZERS] or [JSONSerializer])[0]
+        self.send_json([0, ["validate", [None, self.received_id], self.rpc_state,
+                            {"compress": compress, "serializer": serializer.name}]], nobuffer=True)
+        self.set_compression(compress)
+        self.rpc_serializer = serializer
         return True
 
     def sign_token(self, connection_id, client_nonce, server_nonce):
@@ -698,17 +884,73 @@ class RPCLink(object):
         return [hmac.new(str(key_secret), prefix+conn_type, digestmod=SIGN_HASH).hexdigest()[:SIGN_HEXDIGITS] for conn_type in ("client", "server")]
 
     def send_request_threadsafe(self, method, *args, **kwargs):
-        ioloop.IOLoop.instance().add_callback(functools.partial(self.send_request, method, *args, **kwargs))
+        """Queues request, to be sent along with any other queued requests in the next IOLoop iteration
+        """
+        with self.batch_lock:
+            self.batch_requests.append( (method, args, kwargs) )
+            if self.batch_scheduled:
+                return
+            self.batch_scheduled = True
+        ioloop.IOLoop.instance().add_callback(self.flush_requests)
+
+    def flush_requests(self):
+        """Sends all queued requests
+        """
+        with self.batch_lock:
+            requests = self.batch_requests
+            self.batch_requests = []
+            self.batch_scheduled = False
+        if requests:
+            self.send_batch(requests)
 
     def send_request(self, method, *args, **kwargs):
         """Keyword argument named _content with bytes data is treated specially, and transmitted without JSON encoding
         """
-        if isinstance(kwargs.get("_content"), bytes):
-            kwargs = kwargs.copy()
-            _content = kwargs.pop("_content")
-        else:
+        if self.batch_requests:
+            # Send queued requests first, to preserve ordering
+            self.flush_requests()
+        self.send_batch([(method, args, kwargs)])
+
+    def send_batch(self, requests):
+        """Sends list of (method, args, kwargs) requests, with as few frames as possible.
+        For JSON, a frame can carry only one _content value, which is attached to the last request in the frame.
+        For binary serializers, _content values (bytes, or list of bytes) are encoded natively in each request.
+        """
+        serializer = self.rpc_serializer
+        batch = []
+        for j, (method, args, kwargs) in enumerate(requests):
             _content = None
-        self.send_json([self.packet_id, [method, args, kwargs]], _content=_content, buffer=(not self.rpc_ready))
+            if serializer.binary and kwargs.get("_content") is not None:
+                kwargs = kwargs.copy()
+                kwargs["_content"] = serializer.attachment(kwargs["_content"])
+            elif isinstance(kwargs.get("_content"), bytes) and kwargs["_content"]:
+                # (Empty _content is JSON-encoded)
+                kwargs = kwargs.copy()
+                _content = kwargs.pop("_content")
+            packet = [(self.packet_id + len(batch)) % MAX_PACKET_ID, [method, args, kwargs]]
+            if self.ack_count and self.rpc_ready and self.stream:
+                # Piggyback acknowledgement
+                packet.append(self.received_id)
+                self.ack_count = 0
+            batch.append(packet)
+            if _content is not None or j == len(requests)-1:
+                self.send_message(batch[0] if len(batch) == 1 else batch, serializer, _content=_content,
+                                  buffer=(not self.rpc_ready), packets=len(batch))
+                batch = []
+
+    def send_ack(self, retval=None):
+        """Acknowledges all received packets (with optional error message)
+        """
+        self.ack_count = 0
+        try:
+            self.send_json([-self.received_id, retval], nobuffer=True)
+        except Exception, excp:
+            pass
+
+    def delayed_ack(self):
+        self.ack_timeout = None
+        if self.ack_count and self.rpc_ready:
+            self.send_ack()
 
     @classmethod
     def send_to_connection(cls, connection_id, method, *args, **kwargs):
@@ -725,15 +967,37 @@ class RPCLink(object):
         if conn:
             conn.shutdown()
 
-    def process_packet(self, data):
+    def decode_packet(self, data):
+        """Returns decoded packet (or batch of packets)
+        """
+        if data and not data.startswith("[") and msgpack:
+            # Binary _content values already decoded
+            return MsgpackSerializer.loads(data)
+        return json.loads(data)
+
+    def process_packet(self, data, _content=None):
         """Keyword argument named _content with bytes data is treated specially, and received without JSON encoding
         """
         try:
-            if data and PacketConnector.CONTENT_DELIM in data:
-                json_msg, sep, _content = data.partition(PacketConnector.CONTENT_DELIM)
-            else:
-                json_msg, _content = data, None
-            packet_id, msg_obj = json.loads(json_msg)
+            packet = self.decode_packet(data)
+        except Exception, excp:
+            logging.warning("RPCLink.process_packet: Error in RPC message decoding: %s", excp)
+            if not self.connection_id:
+                self.shutdown()
+            return
+
+        if packet and isinstance(packet[0], list):
+            # Batch of packets; any _content belongs to the last packet
+            for j, sub_packet in enumerate(packet):
+                if self.closed:
+                    break
+                self.process_message(sub_packet, _content if j == len(packet)-1 else None)
+        else:
+            self.process_message(packet, _content)
+
+    def process_message(self, packet, _content=None):
+        try:
+            packet_id, msg_obj = packet[:2]
             if (packet_id and self.rpc_expect) or (not packet_id and msg_obj[0] != self.rpc_expect and msg_obj[0] != "shutdown"):
                 # Drop packet
                 logging.info("RPCLink.process_packet: Dropped packet %s", msg_obj[0])
@@ -748,10 +1012,15 @@ class RPCLink(object):
                     self.rpc_connect(connection_id, key_version, nonce, token)
                 elif msg_obj[0] == "validate":
                     token, last_received_id = msg_obj[1]
+                    link_params = msg_obj[3] if len(msg_obj) > 3 else {}
                     if not self.client:
                         # Note: client-side validation already completed
-                        if not self.rpc_server_validate(token):
+                        if not self.rpc_server_validate(token, link_params):
                             return
+                    else:
+                        if self.rpc_compress:
+                            self.set_compression(link_params.get("compress"))
+                        self.rpc_serializer = SERIALIZERS.get(link_params.get("serializer"), JSONSerializer)
                     self.rpc_peer_state = msg_obj[2]
                     self.clear_sent_packets(last_received_id)
                     self.resend_buffered_packets()
@@ -775,6 +1044,9 @@ class RPCLink(object):
             raise packetserver.SystemMessage("Expected setup packet")
         else:
             # New inbound message of the form [method, args_array, kwargs_dict]
+            if len(packet) > 2:
+                # Piggybacked ack for outbound message
+                self.clear_sent_packets(packet[2])
             retval = None
             try:
                 args = msg_obj[1] if len(msg_obj) > 1 else []
@@ -791,12 +1063,13 @@ class RPCLink(object):
                 logging.error("RPCLink.process_packet: %s: %s", self.connection_id, retval)
 
             if packet_id > 0:
-                # Acknowledge message
+                # Acknowledge message (immediately, if error)
                 self.received_id = packet_id
-                try:
-                    self.send_json([-packet_id, retval])
-                except Exception, excp:
-                    pass
+                self.ack_count += 1
+                if retval is not None or self.ack_count >= ACK_PACKETS:
+                    self.send_ack(retval)
+                elif not self.ack_timeout:
+                    self.ack_timeout = ioloop.IOLoop.instance().add_timeout(time.time()+ACK_DELAY, self.delayed_ack)
 
     def connection_validated(self):
         """ Called after connection validation is completed
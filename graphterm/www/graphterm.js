@@ -37,6 +37,7 @@ var gPasteSpecialKeycode = 15;  // Control-O shortcut for Paste Special
 
 var MAX_LINE_BUFFER = 500;
 var MAX_COMMAND_BUFFER = 100;
+var SCROLL_PAGE_LINES = 100;   // Older scroll lines fetched per page
 
 var REPEAT_MILLISEC = 500;
 var POLL_SEC = 1.0;
@@ -906,6 +907,98 @@ function GTClearTerminal() {
     $("#session-bufscreen").children().remove();
 }
 
+function GTHistoryLineHtml(scroll_line, pre_offset) {
+    // Returns HTML for scroll line fetched on request (older page, elided or archived line)
+    var row_params = scroll_line[JPARAMS];
+    var row_opts = row_params[JOPTS] || {};
+    var classes = "entry gterm-history entry"+scroll_line[JINDEX]+(scroll_line[JINDEX] < gPromptIndex ? " oldentry " : " ")+(row_opts.add_class || "");
+    var markup = scroll_line[JMARKUP];
+    if (row_params[JTYPE] == "pagelet") {
+	markup = (markup || "").replace(/qauth=%\[qauth\]/g, "qauth="+getAuth());
+	if (row_opts.iframe)
+	    markup = gFrameDispatcher.createFrame(row_opts, markup, row_opts.url);
+	if (row_opts.untrusted)
+	    classes += " gterm-untrusted";
+	return '<div class="pagelet '+classes+'">'+markup+'</div>\n';
+    } else if (row_params[JTYPE] == "markdown") {
+	return '<div class="gterm-notecell-buffered gterm-notecell-markdown '+classes+'">\n'+math_md2html(markup)+'\n</div>';
+    }
+    var prompt_offset = scroll_line[JOFFSET];
+    if (prompt_offset)
+	classes += " promptrow";
+    var row_escaped = (markup == null) ? GTEscape(scroll_line[JLINE], pre_offset, prompt_offset) : markup;
+    return '<pre class="row '+classes+'">'+(row_escaped || "\n")+"\n</pre>";
+}
+
+function GTInsertHistoryLines(markerElem, scroll_lines, after) {
+    // Insert scroll lines fetched on request before (or after) marker element
+    // (Fetched lines are not counted or trimmed as part of the line buffer)
+    var pre_offset = gParams.update_opts ? gParams.update_opts.pre_offset : 0;
+    var htmlList = [];
+    for (var j=0; j<scroll_lines.length; j++)
+	htmlList.push(GTHistoryLineHtml(scroll_lines[j], pre_offset));
+    var newElems = $(htmlList.join(""));
+    if (after)
+	newElems.insertAfter(markerElem);
+    else
+	newElems.insertBefore(markerElem);
+    newElems.find(".gterm-link:not(.gterm-download)").bindclick(gtermLinkClickHandler);
+    newElems.find(".gterm-togglelink").bindclick(gtermLinkClickHandler);
+    newElems.find(".gterm-click").bindclick(gtermPageletClickHandler);
+}
+
+function GTElidedMarker(markerElem, elided) {
+    // Marker for scroll lines elided while flooding, elided = [first_count, count]
+    markerElem.attr("data-gtermelided", elided[0]+"-"+elided[1]);
+    markerElem.bindclick(GTElidedHandler);
+}
+
+function GTElidedHandler(evt) {
+    var markerElem = $(this);
+    if (!markerElem.hasClass("gterm-loading")) {
+	markerElem.addClass("gterm-loading");
+	var elided = markerElem.attr("data-gtermelided").split("-");
+	gWebSocket.write([["get_elided", parseInt(elided[0]), parseInt(elided[1])]]);
+    }
+    return false;
+}
+
+function GTScrollMoreMarker(scroll_cursor, archive_end) {
+    // Display marker above scroll lines sent on reconnect, to fetch older lines
+    $("#session-bufscreen .gterm-scroll-more").remove();
+    var markerElem = $('<pre class="row gterm-history gterm-scroll-more"></pre>').prependTo("#session-bufscreen");
+    markerElem.bindclick(GTScrollMoreHandler);
+    GTUpdateScrollMore(markerElem, scroll_cursor, archive_end);
+}
+
+function GTUpdateScrollMore(markerElem, scroll_cursor, archive_end) {
+    // Older lines are fetched from the scroll buffer (preceding scroll_cursor), and then from the archive (preceding archive_end)
+    if (!scroll_cursor && !archive_end) {
+	// No older lines
+	markerElem.remove();
+	return;
+    }
+    markerElem.attr("data-gtermcursor", scroll_cursor || 0);
+    markerElem.attr("data-gtermarchive", archive_end || 0);
+    markerElem.removeClass("gterm-loading").text(scroll_cursor ? "[Show older lines]" : "[Show archived lines]");
+}
+
+function GTScrollMoreHandler(evt) {
+    var markerElem = $(this);
+    if (!markerElem.hasClass("gterm-loading")) {
+	markerElem.addClass("gterm-loading").text("[Loading older lines...]");
+	var scroll_cursor = parseInt(markerElem.attr("data-gtermcursor"));
+	if (scroll_cursor) {
+	    gWebSocket.write([["get_scroll_page", scroll_cursor, SCROLL_PAGE_LINES]]);
+	} else {
+	    var archive_end = parseInt(markerElem.attr("data-gtermarchive"));
+	    var start = Math.max(0, archive_end-SCROLL_PAGE_LINES);
+	    gWebSocket.write([["get_archive", start, archive_end-start, ""]]);
+	}
+    }
+    return false;
+}
+
 function GTAppendPagelet(parentElem, row_params, entry_class, classes, markup) {
     //console.log("GTAppendPagelet:", row_params);
     var row_opts = row_params[JOPTS];
@@ -1771,6 +1864,36 @@ GTWebSocket.prototype.onmessage = function(evt) {
 		    if (gNotebook)
 			gNotebook.output(update_opts, update_rows, update_scroll);
 
+		} else if (cmd_type == "scroll_page") {
+		    // Older scroll lines: [cursor, next_cursor, lines, archive_count]
+		    var markerElem = $('#session-bufscreen .gterm-scroll-more[data-gtermcursor="'+cmd_arg[0]+'"]');
+		    if (markerElem.length) {
+			GTInsertHistoryLines(markerElem, cmd_arg[2]);
+			GTUpdateScrollMore(markerElem, cmd_arg[1], cmd_arg[3]);
+		    }
+
+		} else if (cmd_type == "elided_lines") {
+		    // Elided scroll lines (still in buffer): [first_count, lines]
+		    var markerElem = $('#session-bufscreen .gterm-elided.gterm-loading[data-gtermelided^="'+cmd_arg[0]+'-"]');
+		    if (markerElem.length) {
+			var missing = parseInt(markerElem.attr("data-gtermelided").split("-")[1]) - cmd_arg[1].length;
+			GTInsertHistoryLines(markerElem, cmd_arg[1], true);
+			if (missing > 0) {
+			    // Older elided lines are no longer buffered
+			    markerElem.unbind().removeClass("gterm-elided gterm-loading").text("["+missing+" lines elided]");
+			} else {
+			    markerElem.remove();
+			}
+		    }
+
+		} else if (cmd_type == "archive_lines") {
+		    // Archived scroll lines: [start, archive_count, lines]
+		    var markerElem = $('#session-bufscreen .gterm-scroll-more.gterm-loading[data-gtermcursor="0"]');
+		    if (markerElem.length) {
+			GTInsertHistoryLines(markerElem, cmd_arg[2]);
+			GTUpdateScrollMore(markerElem, 0, cmd_arg[1] ? cmd_arg[0] : 0);
+		    }
+
 		} else if (cmd_type == "row_update") {
 		    gtermShowClickEnd();
                     var update_opts = cmd_arg[0];
@@ -1901,15 +2024,18 @@ GTWebSocket.prototype.onmessage = function(evt) {
 
 		    if (update_scroll.length) {
 			for (var j=0; j<update_scroll.length; j++) {
-			    var delCommands = $("#session-bufscreen .promptrow").length - MAX_COMMAND_BUFFER;
-			    var delOutput = $("#session-bufscreen .entry:not(.promptrow):not(.gterm-ellipsis)").length - MAX_LINE_BUFFER;
+			    var delCommands = $("#session-bufscreen .promptrow:not(.gterm-history)").length - MAX_COMMAND_BUFFER;
+			    var delOutput = $("#session-bufscreen .entry:not(.promptrow):not(.gterm-ellipsis):not(.gterm-history)").length - MAX_LINE_BUFFER;
 			    if (delCommands > 0 || delOutput > 0) {
 				var bufRows = $("#session-bufscreen").children();
 				var deletingCommand = delCommands > 0;
 				var outputCount = 0;
 				for (var k=0; k<bufRows.length; k++) {
 				    var rowElem = $(bufRows[k]);
-				    if (rowElem.hasClass("promptrow")) {
+				    if (rowElem.hasClass("gterm-history")) {
+					// Lines fetched on request are retained
+					continue;
+				    } else if (rowElem.hasClass("promptrow")) {
 					outputCount = 0;
 					if (delCommands > 0) {
 					    delCommands -= 1;
@@ -1981,13 +2107,18 @@ GTWebSocket.prototype.onmessage = function(evt) {
 				if (!row_escaped)
 				    row_escaped = "\n";
 				row_html = '<pre '+id_attr+' class="row entry '+entry_class+' '+add_class+'">'+row_escaped+"\n</pre>";
-				$(row_html).appendTo("#session-bufscreen");
+				var lineElem = $(row_html).appendTo("#session-bufscreen");
+				if (row_params[JOPTS].elided)
+				    GTElidedMarker(lineElem, row_params[JOPTS].elided);
 			    }
 			    $("#"+entry_id+" .gterm-link:not(.gterm-download)").bindclick(gtermLinkClickHandler);
 			    $("#session-bufscreen ."+entry_class+" .gterm-toggleblock .gterm-togglelink").bindclick(gtermLinkClickHandler);
 			}
 		    }
 
+		    if (update_opts.scroll_cursor || update_opts.archive_count)
+			GTScrollMoreMarker(update_opts.scroll_cursor, update_opts.archive_count);
+
 		    if (gScrollTop) {
 			gScrollTop = false;
 			ScrollTop(0);
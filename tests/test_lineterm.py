@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Tests for the lineterm screen and scroll buffer archive
+
+Run from the top-level directory using: python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from graphterm import lineterm
+
+class TerminalScreenTest(unittest.TestCase):
+    height = 5
+    width = 10
+
+    def setUp(self):
+        self.term = lineterm.Terminal("test", -1, 0, lambda *args, **kwargs: None,
+                                      height=self.height, width=self.width)
+
+    def assertScreen(self, data, rows, cursor=None):
+        self.term.write(data)
+        screen = self.term.screen
+        self.assertEqual([len(row) for row in screen.rows], [self.width]*self.height)
+        self.assertEqual([screen.dump_row(j) for j in range(self.height)], [row.ljust(self.width) for row in rows])
+        if cursor:
+            self.assertEqual((self.term.cursor_y, self.term.cursor_x), cursor)
+
+    def test_cursor_movement(self):
+        self.assertScreen("abc\x1b[2;4Hxy\x1b[Bz\x1b[2Dw\x1b[Aq",
+                          ["abc", "   xyq", "    wz", "", ""], (1, 6))
+
+    def test_zero_cursor_params(self):
+        self.assertScreen("hello\x1b[0Gabc", ["abclo", "", "", "", ""], (0, 3))
+        self.assertScreen("\x1b[3;0Hxy", ["abclo", "", "xy", "", ""], (2, 2))
+        self.assertScreen("\x1b[0;0Hz", ["zbclo", "", "xy", "", ""], (0, 1))
+        self.assertScreen("\x1b[0dw", ["zwclo", "", "xy", "", ""], (0, 2))
+
+    def test_wrap(self):
+        self.assertScreen("0123456789abcdef", ["0123456789", "abcdef", "", "", ""], (1, 6))
+
+    def test_full_line(self):
+        self.assertScreen("0123456789\r\nx", ["0123456789", "x", "", "", ""], (1, 1))
+
+    def test_scroll(self):
+        self.assertScreen("1\r\n2\r\n3\r\n4\r\n5\r\n6\r\n7", ["3", "4", "5", "6", "7"], (4, 1))
+
+    def test_scroll_region(self):
+        self.assertScreen("1\r\n2\r\n3\r\n4\r\n5\x1b[2;4r\x1b[4;1H\nA\nB",
+                          ["1", "4", "A", " B", "5"], (3, 2))
+
+    def test_insert_lines(self):
+        self.assertScreen("1\r\n2\r\n3\r\n4\r\n5\x1b[2;1H\x1b[2L", ["1", "", "", "2", "3"], (1, 0))
+
+    def test_delete_lines(self):
+        self.assertScreen("1\r\n2\r\n3\r\n4\r\n5\x1b[2;1H\x1b[2M", ["1", "4", "5", "", ""], (1, 0))
+
+    def test_insert_delete_chars(self):
+        self.assertScreen("abcdef\x1b[1;3H\x1b[2P\x1b[1;2H\x1b[3@", ["a   bef", "", "", "", ""], (0, 1))
+
+    def test_alt_screen_scroll(self):
+        self.assertScreen("main\x1b[?1049h\r1\r\n2\r\n3\r\n4\r\n5\r\n6\r\n7", ["3", "4", "5", "6", "7"], (4, 1))
+        self.assertTrue(self.term.alt_mode)
+        self.assertScreen("\x1b[2;4r\x1b[4;1H\nA\nB", ["3", "6", "A", " B", "7"], (3, 2))
+        self.assertScreen("\x1b[?1049l", ["main", "", "", "", ""])
+        self.assertFalse(self.term.alt_mode)
+
+class ScrollArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive = lineterm.ScrollArchive(os.path.join(self.temp_dir, "archive"))
+
+    def tearDown(self):
+        self.archive.log_file.close()
+        self.archive.index_file.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_params_round_trip(self):
+        entries = [[1, 0, "", ["", {}], "plain", False],
+                   [2, 0, "", ["", {"add_class": "gterm-cmd-prompt", "pagelet_id": ""}], "prompt", True],
+                   [3, 0, "", ["pagelet", {"add_class": "", "pagelet_id": "p1"}], "<b>html</b>", False],
+                   [4, 0, "", ["", {"elided": 12}], "elided", False]]
+        for entry in entries:
+            self.archive.append(lineterm.ScrollLine.from_list(entry))
+        self.assertEqual(self.archive.get_lines(0, 10), entries)
+        self.assertEqual(self.archive.get_lines(2, 1), entries[2:3])
+
+    def test_segments(self):
+        count = 2*lineterm.ARCHIVE_SEGMENT_LINES + 3
+        for j in range(count):
+            self.archive.append(lineterm.ScrollLine.from_list([j, 0, "", ["", {}], "line %d" % j, False]))
+        lines = self.archive.get_lines(lineterm.ARCHIVE_SEGMENT_LINES+1, 3)
+        self.assertEqual([x[lineterm.JLINE] for x in lines],
+                         ["line %d" % j for j in range(lineterm.ARCHIVE_SEGMENT_LINES+1, lineterm.ARCHIVE_SEGMENT_LINES+4)])
+        self.assertEqual(len(self.archive.get_lines(count-1, 10)), 1)
+        self.assertEqual(self.archive.get_lines(count, 10), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Tests for RPC links between a packetserver.PacketConnection server and a PacketClient
+(both run in the same IOLoop, connected over a local TCP socket)
+
+Run from the top-level directory using: python -m unittest discover -s tests
+"""
+
+import time
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+
+from graphterm import packetserver
+
+KEY_SECRET = "0123456789abcdef"
+
+class EchoLink(packetserver.RPCLink):
+    def init_echo(self):
+        self.received = []       # (method, value, _content) for each inbound request
+        self.acks_sent = 0
+        self.frames_sent = []    # Number of packets in each outbound request frame
+
+    def remote_note(self, value, _content=None):
+        self.received.append(("note", value, _content))
+
+    def remote_echo(self, value, _content=None):
+        self.received.append(("echo", value, _content))
+        if _content is None:
+            self.send_request("note", value)
+        else:
+            self.send_request("note", value, _content=_content)
+
+    def send_ack(self, retval=None):
+        self.acks_sent += 1
+        super(EchoLink, self).send_ack(retval)
+
+    def send_message(self, obj, serializer, _content=None, finish=False, buffer=False, nobuffer=False, packets=1):
+        if isinstance(obj[0], list) or obj[0] > 0:
+            # Request (or batch of requests)
+            self.frames_sent.append(packets)
+        super(EchoLink, self).send_message(obj, serializer, _content=_content, finish=finish, buffer=buffer,
+                                           nobuffer=nobuffer, packets=packets)
+
+class EchoConnection(EchoLink, packetserver.PacketConnection):
+    _all_connections = {}
+    def __init__(self, stream, address, server_address, key_secret=None, compress=False):
+        super(EchoConnection, self).__init__(stream, address, server_address, server_type="frame",
+                                             key_secret=key_secret, max_packet_buf=packetserver.RESEND_PACKETS,
+                                             compress=compress)
+        self.init_echo()
+
+class EchoClient(EchoLink, packetserver.PacketClient):
+    _all_connections = {}
+    def __init__(self, host, port, io_loop=None, key_secret=None, compress=False, reconnect_sec=0):
+        super(EchoClient, self).__init__(host, port, io_loop=io_loop, server_type="frame",
+                                         key_secret=key_secret, max_packet_buf=packetserver.RESEND_PACKETS,
+                                         compress=compress, reconnect_sec=reconnect_sec)
+        self.init_echo()
+
+class PacketServerTestCase(tornado.testing.AsyncTestCase):
+    server_compress = False
+    client_compress = False
+    client_reconnect_sec = 0
+
+    def get_new_ioloop(self):
+        # RPC links schedule callbacks on the IOLoop instance
+        return tornado.ioloop.IOLoop.instance()
+
+    def setUp(self):
+        super(PacketServerTestCase, self).setUp()
+        sock, port = tornado.testing.bind_unused_port()
+        sock.close()
+        self.tcp_server = EchoConnection.start_tcp_server("127.0.0.1", port, io_loop=self.io_loop,
+                                                          key_secret=KEY_SECRET, compress=self.server_compress)
+        self.client = EchoClient.get_client("client1", connect=("127.0.0.1", port),
+                                            connect_kw=dict(io_loop=self.io_loop, key_secret=KEY_SECRET,
+                                                            compress=self.client_compress,
+                                                            reconnect_sec=self.client_reconnect_sec))
+        self.wait_until(lambda: self.client.rpc_ready and EchoConnection.get_connection("client1")
+                                and EchoConnection.get_connection("client1").rpc_ready)
+        self.server = EchoConnection.get_connection("client1")
+
+    def tearDown(self):
+        EchoClient.shutdown_all()
+        EchoConnection.shutdown_all()
+        EchoConnection.stop_tcp_server(self.tcp_server, io_loop=self.io_loop)
+        super(PacketServerTestCase, self).tearDown()
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        def poll():
+            if condition() or time.time() > deadline:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(time.time()+0.01, poll)
+        poll()
+        self.wait(timeout=timeout+1)
+        self.assertTrue(condition())
+
+    def echo(self, value, **kwargs):
+        """Sends echo request from client and returns (value, _content) echoed back by server"""
+        count = len(self.client.received)
+        self.client.send_request("echo", value, **kwargs)
+        self.wait_until(lambda: len(self.client.received) > count)
+        return self.client.received[count][1:]
+
+class AckTest(PacketServerTestCase):
+    def test_cumulative_acks(self):
+        count = 3 * packetserver.ACK_PACKETS + 1
+        for j in range(count):
+            self.client.send_request("note", j)
+        self.wait_until(lambda: len(self.server.received) == count and not self.client.packet_buf)
+        self.assertEqual([x[1] for x in self.server.received], range(count))
+        self.assertTrue(1 <= self.server.acks_sent <= count // packetserver.ACK_PACKETS + 1)
+
+    def test_delayed_ack(self):
+        self.client.send_request("note", 1)
+        self.wait_until(lambda: self.server.received)
+        self.assertEqual(self.server.acks_sent, 0)
+        self.wait_until(lambda: not self.client.packet_buf)
+        self.assertEqual(self.server.acks_sent, 1)
+
+    def test_piggybacked_ack(self):
+        self.client.send_request("note", 1)
+        self.wait_until(lambda: self.server.received)
+        self.server.send_request("note", 2)
+        self.wait_until(lambda: not self.client.packet_buf and not self.server.packet_buf)
+        self.assertEqual(self.server.acks_sent, 0)
+
+class ReconnectTest(PacketServerTestCase):
+    client_reconnect_sec = 0.05
+
+    def test_unacknowledged_packets_resent(self):
+        count = 2 * packetserver.ACK_PACKETS + 1
+        for j in range(count // 2):
+            self.client.send_request("note", j)
+        # Drop connection mid-burst, before server reads any packets
+        self.server.shutdown()
+        for j in range(count // 2, count):
+            self.client.send_request("note", j)
+        self.wait_until(lambda: EchoConnection.get_connection("client1") not in (None, self.server)
+                                and len(EchoConnection.get_connection("client1").received) == count)
+        self.assertEqual(self.server.received, [])
+        self.assertEqual([x[1] for x in EchoConnection.get_connection("client1").received], range(count))
+        self.wait_until(lambda: not self.client.packet_buf)
+
+class BatchTest(PacketServerTestCase):
+    def test_threadsafe_requests_batched(self):
+        for j in range(5):
+            self.client.send_request_threadsafe("note", j)
+        self.wait_until(lambda: len(self.server.received) == 5)
+        self.assertEqual([x[1] for x in self.server.received], range(5))
+        self.assertEqual(self.client.frames_sent, [5])
+        self.assertEqual(self.client.packet_id, 6)
+
+    def test_batched_content(self):
+        contents = ["abc", "", "\0\xff"*100, None]
+        for j, content in enumerate(contents):
+            if content is None:
+                self.client.send_request_threadsafe("note", j)
+            else:
+                self.client.send_request_threadsafe("note", j, _content=content)
+        self.wait_until(lambda: len(self.server.received) == len(contents))
+        self.assertEqual([x[1:] for x in self.server.received], list(enumerate(contents)))
+        self.assertEqual(sum(self.client.frames_sent), len(contents))
+
+    def test_request_order_preserved(self):
+        self.client.send_request_threadsafe("note", 0)
+        self.client.send_request("note", 1)
+        self.wait_until(lambda: len(self.server.received) == 2)
+        self.assertEqual([x[1] for x in self.server.received], [0, 1])
+
+class CompressionTest(PacketServerTestCase):
+    server_compress = True
+    client_compress = True
+
+    def test_compression_negotiated(self):
+        self.assertTrue(self.client.compressor)
+        self.assertTrue(self.server.compressor)
+
+    def test_compressed_echo(self):
+        text = "compressible text " * 1000
+        self.assertEqual(self.echo(text), (text, None))
+        self.assertEqual(self.echo("short"), ("short", None))
+        content = "\0\xff" * 1000
+        self.assertEqual(self.echo(text, _content=content), (text, content))
+
+    def test_compressed_frames_smaller(self):
+        text = "compressible text " * 1000
+        sizes = []
+        orig_write = self.client.stream.write
+        def write(data, callback=None):
+            sizes.append(len(data))
+            return orig_write(data, callback)
+        self.client.stream.write = write
+        self.echo(text)
+        self.assertTrue(sizes and sizes[0] < len(text) // 10)
+
+class CompressionRefusedTest(PacketServerTestCase):
+    server_compress = False
+    client_compress = True
+
+    def test_compression_refused(self):
+        self.assertEqual(self.client.compressor, None)
+        self.assertEqual(self.server.compressor, None)
+        text = "compressible text " * 1000
+        self.assertEqual(self.echo(text), (text, None))
+
+@unittest.skipUnless(packetserver.msgpack, "msgpack not installed")
+class MsgpackTest(PacketServerTestCase):
+    def test_msgpack_negotiated(self):
+        self.assertIs(self.client.rpc_serializer, packetserver.MsgpackSerializer)
+        self.assertIs(self.server.rpc_serializer, packetserver.MsgpackSerializer)
+
+    def test_msgpack_echo(self):
+        value = {u"text": u"caf\xe9", u"list": [1, 2.5, None, True]}
+        self.assertEqual(self.echo(value), (value, None))
+        self.assertEqual(self.echo(u"x", _content="\0\xff"), (u"x", "\0\xff"))
+        self.assertEqual(self.echo(u"x", _content=["a", "", "\0"]), (u"x", ["a", "", "\0"]))
+
+class JSONFallbackTest(PacketServerTestCase):
+    def setUp(self):
+        # Client that offers only JSON
+        self.orig_serializers = packetserver.SERIALIZERS
+        packetserver.SERIALIZERS = {packetserver.JSONSerializer.name: packetserver.JSONSerializer}
+        try:
+            super(JSONFallbackTest, self).setUp()
+        finally:
+            packetserver.SERIALIZERS = self.orig_serializers
+
+    def test_json_negotiated(self):
+        self.assertIs(self.client.rpc_serializer, packetserver.JSONSerializer)
+        self.assertIs(self.server.rpc_serializer, packetserver.JSONSerializer)
+        value = {u"text": u"caf\xe9"}
+        self.assertEqual(self.echo(value), (value, None))
+
+class FramingTest(PacketServerTestCase):
+    def test_header(self):
+        conn = self.client
+        self.assertEqual(conn.framelen_format, "!LL")
+        self.assertEqual(conn.fmt_size, 8)
+        self.assertEqual(conn.pack_header(10, 4), "\0\0\0\x0a\0\0\0\x04")
+        self.assertEqual(conn.unpack_header(conn.pack_header(10, 4)), (10, 4))
+        self.assertEqual(conn.unpack_header(conn.pack_header(3)), (3, 0))
+
+    def test_make_packet(self):
+        packet = self.client.make_packet("text", _content="\0\xff")
+        self.assertEqual(packet, self.client.pack_header(6, 2) + "text\0\xff")
+        self.assertEqual(self.client.make_packet("text"), self.client.pack_header(4) + "text")
+
+    def test_binary_content(self):
+        content = "".join(chr(j) for j in range(256)) * 100
+        self.assertEqual(self.echo("bin", _content=content), ("bin", content))
+        self.assertEqual(self.echo("empty", _content=""), ("empty", ""))
+        self.assertEqual(self.echo("none"), ("none", None))
+
+    def test_invalid_header_closes(self):
+        self.client.stream.write(self.client.pack_header(2, 4) + "xx")
+        self.wait_until(lambda: self.server.closed)
+
+if __name__ == "__main__":
+    unittest.main()
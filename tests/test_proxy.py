@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+Tests for blob/file requests proxied by gtermserver.ProxyFileHandler from a gtermhost connection
+(host and server run in the same IOLoop, connected over a local TCP socket)
+
+Run from the top-level directory using: python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+
+from graphterm import gtermhost
+from graphterm import gtermserver
+from graphterm.bin import gterm
+
+HOST_NAME = "testhost"
+HOST_SECRET = "0123456789abcdef"
+
+class AlwaysContains(dict):
+    def __contains__(self, key):
+        return True
+
+class ProxyTestCase(tornado.testing.AsyncHTTPTestCase):
+    def get_new_ioloop(self):
+        # RPC links schedule callbacks on the IOLoop instance
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        return tornado.web.Application([(gterm.BLOB_PREFIX+r"([\w\-]+/"+gterm.TRUSTED_PREFIX+r".*)", gtermserver.ProxyFileHandler, {}),
+                                        (gterm.FILE_PREFIX+r"(.*)", gtermserver.ProxyFileHandler, {})])
+
+    def setUp(self):
+        super(ProxyTestCase, self).setUp()
+        gtermserver.IO_loop = self.io_loop
+        gtermserver.Local_client = None
+        gtermserver.Proxy_cache = gtermhost.BlobCache(max_bytes=gtermserver.PROXY_CACHE_BYTES,
+                                                      max_group_bytes=gtermserver.PROXY_HOST_CACHE_BYTES)
+        gtermserver.Proxy_not_found.clear()
+        gtermhost.IO_loop = self.io_loop
+
+        sock, port = tornado.testing.bind_unused_port()
+        sock.close()
+        self.tcp_server = gtermserver.TerminalConnection.start_tcp_server("127.0.0.1", port, io_loop=self.io_loop,
+                                                                          key_id=str(port), compress=True)
+        self.host = gtermhost.TerminalClient.get_client(HOST_NAME, connect=("127.0.0.1", port, HOST_SECRET),
+                                                        connect_kw=dict(io_loop=self.io_loop, key_id=str(port), compress=True))
+        self.wait_until(lambda: gtermserver.TerminalConnection.get_host_param(HOST_NAME, "host_secret"))
+
+        self.sent_requests = []
+        self.orig_send_to_connection = gtermserver.TerminalConnection.send_to_connection
+        def send_to_connection(connection_id, method, *args, **kwargs):
+            if method == "request":
+                self.sent_requests.extend(req[0] for req in args[2])
+            self.orig_send_to_connection(connection_id, method, *args, **kwargs)
+        gtermserver.TerminalConnection.send_to_connection = staticmethod(send_to_connection)
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        gtermserver.TerminalConnection.send_to_connection = self.orig_send_to_connection
+        gtermhost.TerminalClient.shutdown_all()
+        gtermserver.TerminalConnection.shutdown_all()
+        gtermserver.TerminalConnection._host_params.clear()
+        gtermserver.TerminalConnection.stop_tcp_server(self.tcp_server, io_loop=self.io_loop)
+        gtermserver.ProxyFileHandler._async_requests.clear()
+        gtermserver.ProxyFileHandler._collapsed_requests.clear()
+        shutil.rmtree(self.temp_dir)
+        super(ProxyTestCase, self).tearDown()
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        def poll():
+            if condition() or time.time() > deadline:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(time.time()+0.01, poll)
+        poll()
+        self.wait(timeout=timeout+1)
+        self.assertTrue(condition())
+
+    def add_blob(self, blob_id, content, content_type="text/plain"):
+        self.host.blob_cache.add_blob(blob_id, {"content_type": content_type, "content_length": len(content)}, content)
+        return gterm.BLOB_PREFIX + HOST_NAME + "/" + blob_id
+
+    def write_file(self, filename, content):
+        filepath = os.path.join(self.temp_dir, filename)
+        with open(filepath, "wb") as f:
+            f.write(content)
+        return filepath
+
+    def file_url(self, filepath):
+        return gterm.FILE_PREFIX + HOST_NAME + filepath + "?hmac=" + gterm.file_hmac(filepath, HOST_SECRET)
+
+    def fetch_file(self, filepath, headers={}):
+        headers = headers.copy()
+        headers["Cookie"] = "GRAPHTERM_HOST_%s=%s" % (gtermhost.get_normalized_host(HOST_NAME), HOST_SECRET)
+        return self.fetch(self.file_url(filepath), headers=headers)
+
+class BlobTest(ProxyTestCase):
+    def test_blob(self):
+        response = self.fetch(self.add_blob("t-blob1", "blob content"))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "blob content")
+
+    def test_duplicate_content_not_resent(self):
+        self.fetch(self.add_blob("t-blob1", "same content"))
+        self.assertEqual(self.host.blob_cache.get_digest("t-blob1") in self.host.sent_digests, True)
+        response = self.fetch(self.add_blob("t-blob2", "same content"))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "same content")
+        self.assertEqual(self.sent_requests.count("file_request"), 2)
+
+    def test_zero_length_blob(self):
+        for blob_id in ("t-empty1", "t-empty2"):
+            response = self.fetch(self.add_blob(blob_id, ""))
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, "")
+        self.assertEqual(self.sent_requests.count("file_request"), 2)
+        self.assertFalse(gtermserver.ProxyFileHandler._async_requests)
+
+    def test_omitted_content_requested_again(self):
+        for blob_id, content in (("t-blob1", "some content"), ("t-empty1", "")):
+            self.fetch(self.add_blob(blob_id, content))
+        # Server no longer has the content that the host has already sent
+        gtermserver.Proxy_cache = gtermhost.BlobCache()
+        for blob_id, content in (("t-blob2", "some content"), ("t-empty2", "")):
+            del self.sent_requests[:]
+            response = self.fetch(self.add_blob(blob_id, content))
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, content)
+            self.assertEqual(self.sent_requests.count("file_request"), 2)
+
+    def test_content_omitted_again(self):
+        self.fetch(self.add_blob("t-blob1", "some content"))
+        gtermserver.Proxy_cache = gtermhost.BlobCache()
+        # Host that ignores requests to send content
+        orig_remote_request = self.host.remote_request
+        def remote_request(term_name, from_user, req_list, _content=None):
+            for req in req_list:
+                if req[0] == "file_request":
+                    req[5] = False
+            return orig_remote_request(term_name, from_user, req_list, _content=_content)
+        self.host.remote_request = remote_request
+        self.host.sent_digests = AlwaysContains()
+        response = self.fetch(self.add_blob("t-blob2", "some content"))
+        self.assertEqual(response.code, 502)
+        self.assertEqual(self.sent_requests.count("file_request"), 3)
+        self.assertFalse(gtermserver.ProxyFileHandler._async_requests)
+
+class FileTest(ProxyTestCase):
+    def test_file(self):
+        filepath = self.write_file("small.txt", "file content")
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "file content")
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+    def test_range(self):
+        content = "".join(chr(j % 256) for j in range(1000))
+        filepath = self.write_file("range.bin", content)
+        for range_header, first, last in (("bytes=100-199", 100, 199), ("bytes=900-", 900, 999),
+                                          ("bytes=-50", 950, 999), ("bytes=990-2000", 990, 999)):
+            response = self.fetch_file(filepath, headers={"Range": range_header})
+            self.assertEqual(response.code, 206)
+            self.assertEqual(response.body, content[first:last+1])
+            self.assertEqual(response.headers["Content-Range"], "bytes %d-%d/1000" % (first, last))
+
+    def test_range_not_satisfiable(self):
+        filepath = self.write_file("range.bin", "x"*1000)
+        for range_header in ("bytes=1000-", "bytes=2000-3000", "bytes=-0"):
+            response = self.fetch_file(filepath, headers={"Range": range_header})
+            self.assertEqual(response.code, 416)
+            self.assertEqual(response.headers["Content-Range"], "bytes */1000")
+
+    def test_invalid_range_ignored(self):
+        content = "".join(chr(j % 256) for j in range(1000))
+        filepath = self.write_file("range.bin", content)
+        for range_header in ("bytes=5-3", "bytes=-", "bytes=1-2,4-5", "lines=1-2"):
+            response = self.fetch_file(filepath, headers={"Range": range_header})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, content)
+            self.assertFalse("Content-Range" in response.headers)
+
+    def test_streamed_file(self):
+        content = os.urandom(3*gtermhost.FILE_CHUNK_BYTES + 10)
+        filepath = self.write_file("large.bin", content)
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, content)
+        # First chunk is sent with the response; the server requests each of the others
+        self.assertEqual(self.sent_requests.count("file_next"), 3)
+        self.assertFalse(self.host.file_streams)
+
+    def test_streamed_range(self):
+        content = os.urandom(2*gtermhost.FILE_CHUNK_BYTES)
+        filepath = self.write_file("large.bin", content)
+        first, last = 1000, len(content)-1000
+        response = self.fetch_file(filepath, headers={"Range": "bytes=%d-%d" % (first, last)})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, content[first:last+1])
+        self.assertFalse(self.host.file_streams)
+
+class ETagTest(ProxyTestCase):
+    def test_etag(self):
+        filepath = self.write_file("etag.txt", "file content")
+        response = self.fetch_file(filepath)
+        etag = response.headers["Etag"]
+        self.assertEqual(etag, gtermhost.file_etag(os.stat(filepath)))
+
+        response = self.fetch_file(filepath, headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+
+        response = self.fetch_file(filepath, headers={"If-None-Match": '"other", '+etag})
+        self.assertEqual(response.code, 304)
+
+        # Cached copy is revalidated with host
+        del self.sent_requests[:]
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "file content")
+        self.assertEqual(self.sent_requests, ["file_request"])
+
+        self.write_file("etag.txt", "new file content")
+        os.utime(filepath, (time.time()+10, time.time()+10))
+        response = self.fetch_file(filepath, headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "new file content")
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+class ProxyCacheTest(ProxyTestCase):
+    def test_not_found_cached(self):
+        filepath = os.path.join(self.temp_dir, "missing.txt")
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 404)
+
+        self.write_file("missing.txt", "file content")
+        del self.sent_requests[:]
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 404)
+        self.assertEqual(self.sent_requests, [])
+
+        for path in gtermserver.Proxy_not_found:
+            gtermserver.Proxy_not_found[path] = time.time() - 1
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 200)
+
+    def test_collapsed_requests(self):
+        filepath = self.write_file("collapse.txt", "file content")
+        responses = []
+        def callback(response):
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+        headers = {"Cookie": "GRAPHTERM_HOST_%s=%s" % (gtermhost.get_normalized_host(HOST_NAME), HOST_SECRET)}
+        for j in range(3):
+            self.http_client.fetch(self.get_url(self.file_url(filepath)), callback, headers=headers)
+        self.wait()
+        self.assertEqual([response.code for response in responses], [200]*3)
+        self.assertEqual([response.body for response in responses], ["file content"]*3)
+        self.assertEqual(self.sent_requests.count("file_request"), 1)
+        self.assertFalse(gtermserver.ProxyFileHandler._collapsed_requests)
+
+    def test_host_disconnected(self):
+        filepath = self.write_file("disconnect.txt", "file content")
+        gtermhost.TerminalClient.shutdown_all()
+        self.wait_until(lambda: not gtermserver.TerminalConnection.get_connection(HOST_NAME))
+        response = self.fetch_file(filepath)
+        self.assertEqual(response.code, 502)
+        self.assertFalse(gtermserver.ProxyFileHandler._collapsed_requests)
+        self.assertFalse(gtermserver.ProxyFileHandler._async_requests)
+
+    def test_follower_timeout(self):
+        filepath = self.write_file("timeout.txt", "file content")
+        orig_timeout = gtermserver.REQUEST_TIMEOUT
+        gtermserver.REQUEST_TIMEOUT = 0.2
+        try:
+            # Leader request that is never answered
+            request_key = ("GET", gterm.FILE_PREFIX + HOST_NAME + filepath, None, None, ())
+            gtermserver.ProxyFileHandler._collapsed_requests[request_key] = []
+            response = self.fetch_file(filepath)
+        finally:
+            gtermserver.REQUEST_TIMEOUT = orig_timeout
+        self.assertEqual(response.code, 408)
+        self.assertEqual(gtermserver.ProxyFileHandler._collapsed_requests[request_key], [])
+
+if __name__ == "__main__":
+    unittest.main()